@@ -43,6 +43,124 @@ def add_tsdf_fusion_parameters(parser):
         help=("The depth maps are offsetted using "
               "depth_offset_factor*voxel_size.")
     )
+    parser.add_argument(
+        "--resolutions",
+        type=lambda x: list(map(int, x.split(","))),
+        default=None,
+        help=("Comma separated list of resolutions, e.g. 64,128,256. The "
+              "mesh is rendered once and one watertight mesh is stored per "
+              "resolution, named as <name>_<resolution>.<ext>")
+    )
+    parser.add_argument(
+        "--fusion_method",
+        default="tsdf",
+        choices=["tsdf", "zach_tvl1", "visual_hull"],
+        help=("Average the truncated distances (tsdf), refine their "
+              "histogram with TV-L1 (zach_tvl1) or compute the distance to "
+              "the carved visual hull (visual_hull)")
+    )
+    parser.add_argument(
+        "--n_bins",
+        type=int,
+        default=10,
+        help="Number of histogram bins for the zach_tvl1 fusion"
+    )
+    parser.add_argument(
+        "--tvl1_lambda",
+        type=float,
+        default=1.0,
+        help="Weight of the data term for the zach_tvl1 fusion"
+    )
+    parser.add_argument(
+        "--tvl1_iterations",
+        type=int,
+        default=500,
+        help="Maximum number of iterations for the zach_tvl1 fusion"
+    )
+    parser.add_argument(
+        "--tvl1_tolerance",
+        type=float,
+        default=1e-4,
+        help="Stop the zach_tvl1 fusion when the updates are smaller"
+    )
+    parser.add_argument(
+        "--hist_dtype",
+        default="float32",
+        choices=["float32", "uint16", "uint8", "sparse"],
+        help="Type used to store the histogram of the zach_tvl1 fusion"
+    )
+    parser.add_argument(
+        "--adaptive_grid",
+        action="store_true",
+        help=("Only fuse the bounding box of the mesh instead of the whole "
+              "unit cube, which saves memory for flat or elongated objects")
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help=("Cache the depth maps, the fused volumes and the raw meshes in "
+              "this directory and reuse them across runs")
+    )
+    parser.add_argument(
+        "--cache_size_gb",
+        type=float,
+        default=None,
+        help="Maximum size of the cache, the oldest entries are evicted"
+    )
+    parser.add_argument(
+        "--render_chunk_size",
+        type=int,
+        default=None,
+        help=("Stream the meshes from disk and render them in batches of "
+              "this many faces, for meshes that do not fit in memory")
+    )
+
+
+def add_sequence_parameters(parser):
+    parser.add_argument(
+        "--sequence_mode",
+        action="store_true",
+        help=("Convert the frames of every sequence (e.g. of dynamic_faust "
+              "or deforming_things_4d) in order in the same process, "
+              "reusing the renderer and the views across frames")
+    )
+    parser.add_argument(
+        "--incremental_fusion",
+        action="store_true",
+        help=("With --sequence_mode only fuse the region that moved since "
+              "the previous frame again")
+    )
+    parser.add_argument(
+        "--keyframe_interval",
+        type=int,
+        default=10,
+        help=("With --incremental_fusion fuse the whole volume at least "
+              "every that many frames")
+    )
+    parser.add_argument(
+        "--motion_tolerance",
+        type=float,
+        default=0,
+        help=("With --sequence_mode consider the vertices that moved at "
+              "most this many voxels static. A frame without other motion "
+              "reuses the previous mesh")
+    )
+
+
+def add_visual_hull_parameters(parser):
+    parser.add_argument(
+        "--visual_hull_views",
+        type=int,
+        default=20,
+        help="Number of views per model for the visual_hull method"
+    )
+    parser.add_argument(
+        "--visual_hull_image_scale",
+        type=float,
+        default=0.5,
+        help=("Scale of the image size, the focal length and the principal "
+              "point of the depth maps for the visual_hull method")
+    )
 
 
 def add_manifoldplus_parameters(parser):
@@ -57,3 +175,133 @@ def add_manifoldplus_parameters(parser):
         default=10,
         help="Number of depth values used in the Manifold algorithm"
     )
+    parser.add_argument(
+        "--manifoldplus_timeout",
+        type=float,
+        default=None,
+        help="Seconds after which a ManifoldPlus call is killed"
+    )
+
+
+def add_pipeline_parameters(parser):
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help=("Overlap loading and writing the meshes with the conversion, "
+              "using --num_cpus worker processes for the conversion")
+    )
+    parser.add_argument(
+        "--num_loaders",
+        type=int,
+        default=4,
+        help="Number of threads loading the meshes with --pipelined"
+    )
+    parser.add_argument(
+        "--num_writers",
+        type=int,
+        default=2,
+        help="Number of threads exporting the meshes with --pipelined"
+    )
+    parser.add_argument(
+        "--load_queue_depth",
+        type=int,
+        default=8,
+        help="Maximum number of loaded meshes waiting to be converted"
+    )
+    parser.add_argument(
+        "--write_queue_depth",
+        type=int,
+        default=8,
+        help="Maximum number of converted meshes waiting to be exported"
+    )
+
+
+def add_sharding_parameters(parser):
+    parser.add_argument(
+        "--num_shards", "--num-shards",
+        type=int,
+        default=1,
+        help=("Split the meshes into this many shards, e.g. to convert them "
+              "on several machines")
+    )
+    parser.add_argument(
+        "--shard_index", "--shard-index",
+        type=int,
+        default=0,
+        help="The shard to convert, in [0, num_shards)"
+    )
+    parser.add_argument(
+        "--manifest_dir",
+        default=None,
+        help=("Directory to store the completion manifest of the shard in, "
+              "see merge_shard_manifests.py")
+    )
+
+
+def add_scheduling_parameters(parser):
+    parser.add_argument(
+        "--timing_history",
+        default=None,
+        help=("JSON file with the measured conversion times, used to "
+              "estimate the cost of every mesh and updated after the run. "
+              "By default timing_history.json in the output directory")
+    )
+    parser.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        default=None,
+        help=("Only start a conversion when its estimated peak memory fits "
+              "in this many GB together with the running ones. By default "
+              "the memory available when the run starts")
+    )
+
+
+def add_metrics_parameters(parser):
+    parser.add_argument(
+        "--metrics_textfile",
+        default=None,
+        help=("Periodically write the metrics of the run to this Prometheus "
+              "textfile, e.g. in the directory of the textfile collector of "
+              "the node exporter")
+    )
+    parser.add_argument(
+        "--metrics_json",
+        default=None,
+        help="Periodically write the status of the run to this JSON file"
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        default=15,
+        help="Seconds between two writes of the metrics"
+    )
+
+
+def add_supervision_parameters(parser):
+    parser.add_argument(
+        "--mesh_timeout",
+        type=float,
+        default=None,
+        help=("Kill the conversion of a mesh after this many seconds and "
+              "quarantine the mesh")
+    )
+    parser.add_argument(
+        "--worker_memory_limit_gb",
+        type=float,
+        default=None,
+        help=("Limit the virtual memory of every worker process to this "
+              "many GB, conversions exceeding it fail")
+    )
+    parser.add_argument(
+        "--quarantine",
+        default=None,
+        help=("JSON lines file with the meshes that timed out, crashed "
+              "their worker or ran out of memory, together with their "
+              "errors, which are skipped in later runs. By default "
+              "quarantine.jsonl in the dataset or output directory")
+    )
+    parser.add_argument(
+        "--retry_quarantined",
+        action="store_true",
+        help="Also convert the meshes in the quarantine"
+    )
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""Script for benchmarking the speed and the quality of the visual_hull
+conversion against tsdf_fusion.
+
+Every mesh is converted with tsdf_fusion and with visual_hull for every
+combination of the given numbers of views and image scales. For every
+configuration we report the mean conversion time, the speedup over
+tsdf_fusion, the Chamfer distance to the input mesh, the volumetric IoU with
+the tsdf_fusion mesh and the fraction of watertight outputs.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+from simple_3dviz import Mesh
+from watertight_transformer import WatertightTransformerFactory
+from watertight_transformer.watertightness import is_watertight
+
+from arguments import add_tsdf_fusion_parameters
+from utils import chamfer_distance, normalize_mesh, volumetric_iou
+
+
+def timed_conversion(wat_transformer, mesh):
+    start = time.perf_counter()
+    wat_mesh = wat_transformer.to_watertight(mesh)
+    return wat_mesh, time.perf_counter() - start
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Compare the visual_hull conversion with tsdf_fusion"
+    )
+    parser.add_argument(
+        "path_to_meshes",
+        help="Path to a mesh or to a folder containing the meshes"
+    )
+    parser.add_argument(
+        "--visual_hull_views",
+        type=lambda x: list(map(int, x.split(","))),
+        default="10,20,40",
+        help="Comma separated list of the numbers of views to benchmark"
+    )
+    parser.add_argument(
+        "--visual_hull_image_scales",
+        type=lambda x: list(map(float, x.split(","))),
+        default="0.25,0.5,1.0",
+        help="Comma separated list of the image scales to benchmark"
+    )
+    parser.add_argument(
+        "--n_points",
+        type=int,
+        default=100000,
+        help="Number of points used for the Chamfer distance and the IoU"
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Store the results of every mesh in this JSON file"
+    )
+    add_tsdf_fusion_parameters(parser)
+    args = parser.parse_args(argv)
+    # Disable trimesh's logger
+    logging.getLogger("trimesh").setLevel(logging.ERROR)
+
+    if os.path.isdir(args.path_to_meshes):
+        path_to_meshes = [
+            os.path.join(args.path_to_meshes, mi)
+            for mi in sorted(os.listdir(args.path_to_meshes))
+            if mi.endswith(".obj") or mi.endswith(".off")
+        ]
+    else:
+        path_to_meshes = [args.path_to_meshes]
+
+    def factory(name, **kwargs):
+        return WatertightTransformerFactory(
+            name,
+            image_height=args.image_size[0],
+            image_width=args.image_size[1],
+            focal_length_x=args.focal_point[0],
+            focal_length_y=args.focal_point[1],
+            principal_point_x=args.principal_point[0],
+            principal_point_y=args.principal_point[1],
+            resolution=args.resolution,
+            truncation_factor=args.truncation_factor,
+            n_views=args.n_views,
+            depth_offset_factor=args.depth_offset_factor,
+            **kwargs
+        )
+
+    configurations = [("tsdf_fusion", factory("tsdf_fusion"))]
+    for n_views in args.visual_hull_views:
+        for scale in args.visual_hull_image_scales:
+            configurations.append((
+                f"visual_hull views={n_views} scale={scale:g}",
+                factory(
+                    "visual_hull",
+                    visual_hull_views=n_views,
+                    visual_hull_image_scale=scale
+                )
+            ))
+
+    rng = np.random.default_rng(0)
+    results = {name: [] for name, _ in configurations}
+    for path in path_to_meshes:
+        mesh = normalize_mesh(Mesh.from_file(path), unit_cube=True)
+        points = rng.uniform(-0.55, 0.55, size=(args.n_points, 3))
+        reference = None
+        for name, wat_transformer in configurations:
+            wat_mesh, seconds = timed_conversion(wat_transformer, mesh)
+            if reference is None:
+                reference = wat_mesh
+            results[name].append({
+                "path": path,
+                "seconds": seconds,
+                "chamfer": chamfer_distance(mesh, wat_mesh, args.n_points),
+                "iou": volumetric_iou(reference, wat_mesh, points),
+                "watertight": is_watertight(wat_mesh.faces),
+            })
+
+    reference_seconds = np.mean([r["seconds"] for r in results["tsdf_fusion"]])
+    print("{:<36} {:>9} {:>8} {:>9} {:>7} {:>10}".format(
+        "method", "time (s)", "speedup", "chamfer", "iou", "watertight"
+    ))
+    for name, _ in configurations:
+        seconds = np.mean([r["seconds"] for r in results[name]])
+        print("{:<36} {:9.2f} {:7.1f}x {:9.5f} {:7.3f} {:9.0f}%".format(
+            name,
+            seconds,
+            reference_seconds / seconds,
+            np.mean([r["chamfer"] for r in results[name]]),
+            np.mean([r["iou"] for r in results[name]]),
+            100 * np.mean([r["watertight"] for r in results[name]])
+        ))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1, default=float)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
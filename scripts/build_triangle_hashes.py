@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Script for storing the triangle hashes of the watertight meshes of a
+dataset next to them, so that containment queries skip building them.
+"""
+import argparse
+import logging
+import os
+import sys
+from functools import partial
+
+import trimesh
+from tqdm.contrib.concurrent import process_map
+from watertight_transformer.datasets import ModelCollectionBuilder
+from watertight_transformer.external.libmesh import MeshIntersector, \
+    triangle_hash_path
+
+
+def build_triangle_hash(path_to_file, resolution):
+    # The hash is only built if the stored one is missing or stale
+    mesh = trimesh.load(path_to_file, force="mesh")
+    MeshIntersector(mesh, resolution, triangle_hash_path(path_to_file))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=("Store the triangle hashes used by the containment "
+                     "queries next to the watertight meshes")
+    )
+    parser.add_argument(
+        "dataset_directory",
+        help="Path to the directory containing the dataset"
+    )
+    parser.add_argument(
+        "--dataset_type",
+        default="shapenet_v1",
+        choices=["shapenet_v1", "dynamic_faust", "freihand", "3d_future",
+                 "deforming_things_4d"],
+        help="The type of the dataset type to be used",
+    )
+    parser.add_argument(
+        "--model_tags",
+        type=lambda x: x.split(","),
+        default=[],
+        help="Tags to the models to be used",
+    )
+    parser.add_argument(
+        "--category_tags",
+        type=lambda x: x.split(","),
+        default=[],
+        help="Category tags to the models to be used",
+    )
+    parser.add_argument(
+        "--hash_resolution",
+        type=int,
+        default=512,
+        help="The number of cells of the hash along each axis"
+    )
+    parser.add_argument(
+        "--num_cpus",
+        type=int,
+        default=1,
+        help="Number of processes to be used for the multiprocessing setup"
+    )
+
+    args = parser.parse_args(argv)
+    # Disable trimesh's logger
+    logging.getLogger("trimesh").setLevel(logging.ERROR)
+
+    dataset = (
+        ModelCollectionBuilder()
+        .with_dataset(args.dataset_type)
+        .filter_category_tags(args.category_tags)
+        .filter_tags(args.model_tags)
+        .build(args.dataset_directory)
+    )
+
+    paths = [sample.path_to_watertight_mesh_file for sample in dataset]
+    missing = [p for p in paths if not os.path.exists(p)]
+    for path_to_file in missing:
+        print(f"File does not exist in location: {path_to_file}")
+    pending = [p for p in paths if p not in missing]
+    print(f"Storing the triangle hashes of {len(pending)}/{len(paths)} meshes")
+
+    process_map(
+        partial(build_triangle_hash, resolution=args.hash_resolution),
+        pending,
+        max_workers=args.num_cpus,
+        chunksize=max(1, len(pending) // (args.num_cpus * 16))
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
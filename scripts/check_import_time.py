@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Script for checking that importing the package stays fast and that the
+heavy backends (the renderer, the fusion, marching cubes, trimesh, SciPy etc.)
+are only loaded when they are used."""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Modules that should only be loaded when a conversion needs them
+HEAVY_MODULES = [
+    "trimesh",
+    "scipy",
+    "h5py",
+    "PIL",
+    "simple_3dviz",
+    "pymeshlab",
+    "watertight_transformer.external.librender.pyrender",
+    "watertight_transformer.external.libfusioncpu.cyfusion",
+    "watertight_transformer.external.libmcubes.mcubes",
+]
+
+# Statements that should neither exceed the budget nor load a heavy module
+CHECKS = [
+    ("import", "import watertight_transformer"),
+    ("datasets", "import watertight_transformer.datasets"),
+    ("watertightness", "import watertight_transformer.watertightness"),
+    (
+        "manifoldplus",
+        "from watertight_transformer import WatertightTransformerFactory; "
+        "WatertightTransformerFactory('manifoldplus', "
+        "manifoldplus_script='manifoldplus')"
+    ),
+]
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(statement, repeats):
+    """Run the statement in fresh interpreters and return the fastest time
+    and the modules it loaded. Raises a RuntimeError if it fails."""
+    best, modules = float("inf"), []
+    for _ in range(repeats):
+        process = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(statement=statement)],
+            capture_output=True,
+            text=True
+        )
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr.strip().splitlines()[-1])
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        best = min(best, result["seconds"])
+        modules = result["modules"]
+    return best, modules
+
+
+def heavy_modules(modules):
+    return sorted(
+        m for m in HEAVY_MODULES
+        if any(x == m or x.startswith(m + ".") for x in modules)
+    )
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check the import time of watertight_transformer"
+    )
+    parser.add_argument(
+        "--budget_ms",
+        type=float,
+        default=200,
+        help="The maximum time in milliseconds of every check"
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="Run every check this many times and keep the fastest"
+    )
+    parser.add_argument(
+        "--history",
+        default=None,
+        help="Append the measured times to this JSON file to track them"
+    )
+    args = parser.parse_args(argv)
+
+    failed = False
+    timings = {}
+    for name, statement in CHECKS:
+        try:
+            seconds, modules = measure(statement, args.repeats)
+        except RuntimeError as e:
+            print(f"{name:<16} failed: {e}")
+            failed = True
+            continue
+        timings[name] = seconds
+        heavy = heavy_modules(modules)
+        over_budget = seconds * 1000 > args.budget_ms
+        failed = failed or over_budget or len(heavy) > 0
+        print("{:<16} {:8.1f} ms{}{}".format(
+            name,
+            seconds * 1000,
+            " over budget" if over_budget else "",
+            " loads " + ", ".join(heavy) if heavy else ""
+        ))
+
+    if args.history is not None:
+        history = []
+        if os.path.exists(args.history):
+            with open(args.history, "r") as f:
+                history = json.load(f)
+        history.append({"time": time.time(), "timings": timings})
+        with open(args.history, "w") as f:
+            json.dump(history, f, indent=1)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""Script for checking the ManifoldPlus conversions with stub executables that
+accept the command line of ManifoldPlus: one that copies the input to the
+output, one that fails and one that hangs in a child process, which has to be
+killed together with the stub on timeout. The conversions are checked with
+ManifoldPlusPool, with ManifoldPlus one mesh at a time and with ManifoldPlus
+in supervised workers, which are killed on timeout instead. Optionally the
+pool is also run with the actual ManifoldPlus executable."""
+
+import argparse
+import os
+import stat
+import subprocess
+import sys
+import time
+from functools import partial
+from tempfile import TemporaryDirectory
+
+import trimesh
+from watertight_transformer.manifoldplus import ManifoldPlus, \
+    ManifoldPlusPool
+
+from supervision import SupervisedPool, WorkerTimeout
+
+# The arguments are "--input path --output path --depth n"
+STUBS = {
+    "copy": 'cp "$2" "$4"\n',
+    "fail": 'echo "stub failure" >&2\nexit 3\n',
+    # sleep runs in a child process that keeps stderr open, the pids of both
+    # are recorded to check that they are killed
+    "hang": (
+        'echo $$ >> "{pids}"\n'
+        'sleep {sleep} &\n'
+        'echo $! >> "{pids}"\n'
+        'wait\n'
+        'cp "$2" "$4"\n'
+    ),
+}
+
+
+def write_stub(directory, name, body):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n" + body)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+def test_meshes(n):
+    return [
+        trimesh.creation.box(extents=(1.0, 0.5 + 0.1 * i, 0.25))
+        for i in range(n)
+    ]
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            # The killed processes may linger as zombies
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return False
+
+
+def convert_pool(script, meshes, concurrency, timeout):
+    pool = ManifoldPlusPool(
+        script, max_concurrency=concurrency, timeout=timeout
+    )
+    return pool.map(meshes)
+
+
+def convert_sync(script, meshes, concurrency, timeout):
+    # One mesh at a time, as the factory and the scripts convert them
+    converter = ManifoldPlus(script, timeout=timeout)
+    results = []
+    for mesh in meshes:
+        try:
+            results.append(converter.mesh_to_watertight(mesh))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def convert_supervised(script, meshes, concurrency, timeout):
+    # The workers are killed on timeout, not ManifoldPlus itself
+    converter = ManifoldPlus(script)
+    with SupervisedPool(concurrency, timeout=timeout) as pool:
+        futures = [
+            pool.submit(converter.mesh_to_watertight, mesh)
+            for mesh in meshes
+        ]
+        return [f.exception() or f.result() for f in futures]
+
+
+def check_copy(convert, script, meshes, concurrency):
+    results = convert(script, meshes, concurrency, 60)
+    for mesh, result in zip(meshes, results):
+        if isinstance(result, Exception):
+            return f"conversion failed: {result!r}"
+        if len(result.faces) != len(mesh.faces) or \
+                not (abs(result.bounds - mesh.bounds) < 1e-5).all():
+            return "the output differs from the input"
+
+
+def check_fail(convert, script, meshes, concurrency):
+    for result in convert(script, meshes, concurrency, 60):
+        if not isinstance(result, RuntimeError) or \
+                "stub failure" not in str(result) or \
+                "code 3" not in str(result):
+            return (
+                "expected a RuntimeError with the exit code and the stderr, "
+                f"got {result!r}"
+            )
+
+
+def check_hang(convert, script, meshes, concurrency, timeout, pids):
+    start = time.time()
+    results = convert(script, meshes, concurrency, timeout)
+    elapsed = time.time() - start
+    for result in results:
+        if not isinstance(result, (subprocess.TimeoutExpired, WorkerTimeout)):
+            return f"expected a timeout, got {result!r}"
+    # Every batch of concurrent conversions is killed after the timeout
+    rounds = -(-len(meshes) // concurrency)
+    if elapsed > rounds * timeout + 5:
+        return "the timeouts took {:.1f} s instead of ~{} s".format(
+            elapsed, rounds * timeout
+        )
+    with open(pids, "r") as f:
+        running = [int(pid) for pid in f.read().split()]
+    # The killed processes take a moment to exit
+    deadline = time.time() + 1
+    while len(running) > 0 and time.time() < deadline:
+        time.sleep(0.05)
+        running = [pid for pid in running if is_running(pid)]
+    if len(running) > 0:
+        return f"the processes {running} were not killed"
+
+
+def check_manifoldplus(script, meshes, concurrency, timeout):
+    for result in convert_pool(script, meshes, concurrency, timeout):
+        if isinstance(result, Exception):
+            return f"conversion failed: {result!r}"
+        if not result.is_watertight:
+            return "the output is not watertight"
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check the ManifoldPlus conversions with stub executables"
+    )
+    parser.add_argument(
+        "--n_meshes",
+        type=int,
+        default=3,
+        help="The number of meshes converted by every check"
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=2,
+        help="The maximum number of concurrent processes"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=1,
+        help="The timeout in seconds of the hanging stub"
+    )
+    parser.add_argument(
+        "--manifoldplus_script",
+        default=None,
+        help="Also check the pool with this ManifoldPlus executable"
+    )
+    args = parser.parse_args(argv)
+
+    meshes = test_meshes(args.n_meshes)
+    failed = False
+    with TemporaryDirectory() as tmp_dir:
+        checks = []
+        for mode, convert, concurrency in [
+            ("pool", convert_pool, args.max_concurrency),
+            ("sync", convert_sync, 1),
+            ("supervised", convert_supervised, args.max_concurrency),
+        ]:
+            pids = os.path.join(tmp_dir, f"{mode}_pids")
+            stubs = {
+                name: write_stub(
+                    tmp_dir,
+                    f"{mode}_{name}",
+                    body.format(sleep=30 * args.timeout, pids=pids)
+                )
+                for name, body in STUBS.items()
+            }
+            checks += [
+                (f"{mode} copy", partial(
+                    check_copy, convert, stubs["copy"], meshes, concurrency
+                )),
+                (f"{mode} fail", partial(
+                    check_fail, convert, stubs["fail"], meshes, concurrency
+                )),
+                (f"{mode} hang", partial(
+                    check_hang, convert, stubs["hang"], meshes, concurrency,
+                    args.timeout, pids
+                )),
+            ]
+        if args.manifoldplus_script is not None:
+            checks.append(("manifoldplus", partial(
+                check_manifoldplus, args.manifoldplus_script, meshes,
+                args.max_concurrency, 600
+            )))
+        for name, check in checks:
+            start = time.time()
+            error = check()
+            failed = failed or error is not None
+            print("{:<18} {:6.1f} s {}".format(
+                name, time.time() - start, error or "ok"
+            ))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -6,10 +6,10 @@ import logging
 import os
 import sys
 
-import numpy as np
-import trimesh
-from tqdm import tqdm
+from tqdm.contrib.concurrent import process_map
 from watertight_transformer.datasets import ModelCollectionBuilder
+from watertight_transformer.watertightness import VerdictStore, \
+    check_watertightness
 
 
 def ensure_parent_directory_exists(filepath):
@@ -43,6 +43,18 @@ def main(argv):
         default=[],
         help="Category tags to the models to be used",
     )
+    parser.add_argument(
+        "--num_cpus",
+        type=int,
+        default=1,
+        help="Number of processes to be used for the multiprocessing setup"
+    )
+    parser.add_argument(
+        "--verdict_store",
+        default=None,
+        help=("Path to the file used to cache the verdicts between runs. "
+              "By default it is stored in the text_directory")
+    )
 
     args = parser.parse_args(argv)
     # Disable trimesh's logger
@@ -56,28 +68,41 @@ def main(argv):
         .build(args.dataset_directory)
     )
 
-    count = 0
-    with open(f"{args.text_directory}/non_watertight_list.txt", "w") as f:
-        for sample in tqdm(dataset):
-            # Assemble the target path and ensure the parent dir exists
-            path_to_file = sample.path_to_watertight_mesh_file
+    if args.verdict_store is None:
+        args.verdict_store = os.path.join(
+            args.text_directory, "watertightness_verdicts.json"
+        )
+    store = VerdictStore(args.verdict_store)
 
-            # If path does not exist we need to log that
-            if not os.path.exists(path_to_file):
-                print(f"File does not exist in location: {path_to_file}")
+    paths = [sample.path_to_watertight_mesh_file for sample in dataset]
+    missing = {p for p in paths if not os.path.exists(p)}
+    for path_to_file in paths:
+        if path_to_file in missing:
+            print(f"File does not exist in location: {path_to_file}")
+    # Only check the files that changed since the last run
+    pending = [
+        p for p in paths if p not in missing and store.get(p) is None
+    ]
+    print(f"Checking {len(pending)}/{len(paths)} meshes")
 
-            try:
-                # Load mesh using Trimesh to check watertightness
-                tr_mesh = trimesh.load(path_to_file, process=False, force="mesh")
-            except Exception as e:
-                print(f"Error raised while loading file {path_to_file}")
-                raise
-            if not tr_mesh.is_watertight:
+    verdicts = process_map(
+        check_watertightness,
+        pending,
+        max_workers=args.num_cpus,
+        chunksize=max(1, len(pending) // (args.num_cpus * 16))
+    )
+    for path_to_file, watertight in zip(pending, verdicts):
+        store.set(path_to_file, watertight)
+    store.save()
+
+    count = 0
+    with open(f"{args.text_directory}/non_watertight_list.txt", "w") as f:
+        for path_to_file in paths:
+            if path_to_file in missing or not store.get(path_to_file):
                 count += 1
                 f.write(path_to_file + "\n")
     if not count:
         print("All meshes in the relevant directory are watertight!")
 
-
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -4,19 +4,32 @@ script is intended for meshes organized in datasets."""
 
 import argparse
 import logging
+import os
 import sys
+import time
 from functools import partial
 
 import trimesh
-from tqdm.contrib.concurrent import process_map
+from simple_3dviz import Mesh
 from watertight_transformer import WatertightTransformerFactory
 from watertight_transformer.datasets import ModelCollectionBuilder
 from watertight_transformer.datasets.model_collections import \
     BaseModel, ModelCollection
+from watertight_transformer.watertightness import VerdictStore
 
 from arguments import add_manifoldplus_parameters, \
-    add_tsdf_fusion_parameters
-from utils import mesh_to_watertight
+    add_pipeline_parameters, add_scheduling_parameters, \
+    add_metrics_parameters, add_sequence_parameters, \
+    add_sharding_parameters, add_supervision_parameters, \
+    add_tsdf_fusion_parameters, add_visual_hull_parameters
+from manifests import manifest_entry, write_shard_manifest
+from metrics import METRICS, MetricsExporter
+from pipeline import PipelinedRunner
+from scheduling import CostModel, available_memory, longest_first, \
+    report_memory, run_longest_first
+from supervision import Quarantine
+from utils import convert_mesh, export_watertight, mesh_to_watertight, \
+    multires_path, normalize_mesh, output_paths, target_num_faces
 
 
 def distribute_files(
@@ -28,9 +41,26 @@ def distribute_files(
     num_target_faces: int = None,
     ratio_target_faces: float = None,
     num_cpus: int = 1,
+    verdict_store: VerdictStore = None,
+    resolutions: list = None,
+    cost_model: CostModel = None,
+    memory_budget: int = None,
+    timeout: float = None,
+    memory_limit: int = None,
+    quarantine: Quarantine = None,
 ):
     # Assuming that dataset iterator contains only one instance of each path
-    process_map(
+    cost_model = cost_model or CostModel()
+    # Skip the converted samples here, so that only actual conversions are
+    # timed
+    dataset = [
+        sample for sample in dataset
+        if not all(
+            os.path.exists(p) for p in
+            output_paths(sample.path_to_watertight_mesh_file, resolutions)
+        )
+    ]
+    verdicts = run_longest_first(
         partial(
             ds_sample_to_watertight,
             wat_transformer=wat_transformer,
@@ -39,10 +69,296 @@ def distribute_files(
             simplify=simplify,
             num_target_faces=num_target_faces,
             ratio_target_faces=ratio_target_faces,
+            check_watertight=verdict_store is not None,
+            resolutions=resolutions,
         ),
         dataset,
-        max_workers=num_cpus,
+        cost_model,
+        lambda sample: sample.path_to_mesh_file,
+        num_cpus=num_cpus,
+        estimate_memory=lambda sample: wat_transformer.estimate_peak_memory(
+            cost_model.faces(sample.path_to_mesh_file), resolutions
+        ),
+        memory_budget=memory_budget,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        quarantine=quarantine,
+    )
+    failed = [v for v in verdicts if isinstance(v, Exception)]
+    if verdict_store is not None:
+        for sample_verdicts in verdicts:
+            # Skipped and failed samples have no verdicts
+            if sample_verdicts is None or \
+                    isinstance(sample_verdicts, Exception):
+                continue
+            for path_to_file, watertight in sample_verdicts:
+                if watertight is not None:
+                    verdict_store.set(path_to_file, watertight)
+        verdict_store.save()
+    return len(failed)
+
+
+def distribute_files_pipelined(
+    dataset: ModelCollection,
+    wat_transformer,
+    bbox: list = None,
+    unit_cube: bool = False,
+    simplify: bool = None,
+    num_target_faces: int = None,
+    ratio_target_faces: float = None,
+    num_cpus: int = 1,
+    verdict_store: VerdictStore = None,
+    resolutions: list = None,
+    num_loaders: int = 4,
+    num_writers: int = 2,
+    load_queue_depth: int = 8,
+    write_queue_depth: int = 8,
+    cost_model: CostModel = None,
+    memory_budget: int = None,
+    timeout: float = None,
+    memory_limit: int = None,
+    quarantine: Quarantine = None,
+):
+    # Same as distribute_files() but loading and exporting the meshes happens
+    # in threads, while the worker processes only run the conversion
+    cost_model = cost_model or CostModel()
+    estimate_memory = lambda sample: wat_transformer.estimate_peak_memory(
+        cost_model.faces(sample.path_to_mesh_file), resolutions
+    )
+    measured = []
+
+    def on_converted(sample, seconds, peak):
+        estimated = estimate_memory(sample)
+        measured.append((sample.path_to_mesh_file, estimated, peak))
+        cost_model.record(sample.path_to_mesh_file, seconds, estimated, peak)
+
+    runner = PipelinedRunner(
+        load=partial(
+            load_sample,
+            bbox=bbox,
+            unit_cube=unit_cube,
+            resolutions=resolutions,
+        ),
+        convert=partial(
+            convert_sample,
+            wat_transformer=wat_transformer,
+            resolutions=resolutions,
+        ),
+        write=partial(
+            write_sample,
+            simplify=simplify,
+            num_target_faces=num_target_faces,
+            ratio_target_faces=ratio_target_faces,
+            check_watertight=verdict_store is not None,
+            resolutions=resolutions,
+        ),
+        num_loaders=num_loaders,
+        num_workers=num_cpus,
+        num_writers=num_writers,
+        load_queue_depth=load_queue_depth,
+        write_queue_depth=write_queue_depth,
+        estimate_memory=estimate_memory,
+        memory_budget=memory_budget,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        on_converted=on_converted,
+    )
+    # The loaders take the samples in order, thus start the most expensive
+    # conversions first
+    dataset = list(dataset)
+    dataset = longest_first(
+        dataset, [cost_model.predict(s.path_to_mesh_file) for s in dataset]
     )
+    results = runner.run(dataset)
+    cost_model.save()
+    if len(measured) > 0:
+        report_memory(*map(list, zip(*measured)))
+
+    failed = [(s, r) for s, r in results if isinstance(r, Exception)]
+    for sample, error in failed:
+        print(f"Failed to convert {sample.path_to_mesh_file}: {error}")
+        if quarantine is not None and quarantine.accepts(error):
+            quarantine.add(sample.path_to_mesh_file, error)
+    if verdict_store is not None:
+        for _, sample_verdicts in results:
+            # Skipped and failed samples have no verdicts
+            if sample_verdicts is None or \
+                    isinstance(sample_verdicts, Exception):
+                continue
+            for path_to_file, watertight in sample_verdicts:
+                verdict_store.set(path_to_file, watertight)
+        verdict_store.save()
+    return len(failed)
+
+
+def distribute_sequences(
+    dataset: ModelCollection,
+    wat_transformer,
+    bbox: list = None,
+    unit_cube: bool = False,
+    simplify: bool = None,
+    num_target_faces: int = None,
+    ratio_target_faces: float = None,
+    num_cpus: int = 1,
+    verdict_store: VerdictStore = None,
+    incremental: bool = False,
+    keyframe_interval: int = 10,
+    tolerance_factor: float = 0,
+    cost_model: CostModel = None,
+    memory_budget: int = None,
+    timeout: float = None,
+    memory_limit: int = None,
+    quarantine: Quarantine = None,
+):
+    # Every process converts whole sequences, so that the frames of a
+    # sequence reuse the state of the previous frame
+    cost_model = cost_model or CostModel()
+    sequences = {}
+    for sample in dataset:
+        if not os.path.exists(sample.path_to_watertight_mesh_file):
+            sequences.setdefault(sample.category, []).append(sample)
+    sequences = list(sequences.values())
+    convert = partial(
+        sequence_to_watertight,
+        wat_transformer=wat_transformer,
+        bbox=bbox,
+        unit_cube=unit_cube,
+        simplify=simplify,
+        num_target_faces=num_target_faces,
+        ratio_target_faces=ratio_target_faces,
+        check_watertight=verdict_store is not None,
+        incremental=incremental,
+        keyframe_interval=keyframe_interval,
+        tolerance_factor=tolerance_factor,
+    )
+    # The frames are converted one after the other, thus a sequence needs
+    # the memory of its largest frame
+    verdicts = run_longest_first(
+        convert,
+        sequences,
+        cost_model,
+        lambda sequence: [s.path_to_mesh_file for s in sequence],
+        num_cpus=num_cpus,
+        estimate_memory=lambda sequence: max(
+            wat_transformer.estimate_peak_memory(
+                cost_model.faces(s.path_to_mesh_file)
+            )
+            for s in sequence
+        ),
+        memory_budget=memory_budget,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        quarantine=quarantine,
+    )
+    failed = sum(
+        len(sequence)
+        for sequence, sequence_verdicts in zip(sequences, verdicts)
+        if isinstance(sequence_verdicts, Exception)
+    )
+    if verdict_store is not None:
+        for sequence_verdicts in verdicts:
+            if isinstance(sequence_verdicts, Exception):
+                continue
+            for path_to_file, watertight in sequence_verdicts:
+                verdict_store.set(path_to_file, watertight)
+        verdict_store.save()
+    return failed
+
+
+def sequence_to_watertight(
+    samples: list,
+    wat_transformer,
+    bbox: list = None,
+    unit_cube: bool = False,
+    simplify: bool = None,
+    num_target_faces: int = None,
+    ratio_target_faces: float = None,
+    check_watertight: bool = False,
+    incremental: bool = False,
+    keyframe_interval: int = 10,
+    tolerance_factor: float = 0,
+):
+    n_faces = []
+
+    def load():
+        for sample in samples:
+            # Load the frames without keeping them in the samples
+            with METRICS.time("load"):
+                tr_mesh = normalize_mesh(
+                    Mesh.from_file(sample.path_to_mesh_file), bbox, unit_cube
+                )
+            n_faces.append(len(tr_mesh.faces))
+            yield tr_mesh
+
+    wat_meshes = wat_transformer.to_watertight_sequence(
+        load(),
+        incremental=incremental,
+        keyframe_interval=keyframe_interval,
+        tolerance_factor=tolerance_factor,
+    )
+    verdicts = []
+    for sample, wat_mesh in zip(samples, wat_meshes):
+        path_to_file = sample.path_to_watertight_mesh_file
+        num_faces = None
+        if simplify:
+            num_faces = target_num_faces(
+                n_faces[-1], num_target_faces, ratio_target_faces
+            )
+        with METRICS.time("write"):
+            watertight = export_watertight(
+                [wat_mesh], [path_to_file], num_faces, check_watertight
+            )
+        if watertight is not None:
+            verdicts.append((path_to_file, watertight[0]))
+    return verdicts
+
+
+def load_sample(
+    sample: BaseModel,
+    bbox: list = None,
+    unit_cube: bool = False,
+    resolutions: list = None,
+):
+    paths_to_files = output_paths(
+        sample.path_to_watertight_mesh_file, resolutions
+    )
+    # Check optimistically if the file already exists
+    if all(os.path.exists(p) for p in paths_to_files):
+        return None
+    return normalize_mesh(sample.groundtruth_mesh, bbox, unit_cube)
+
+
+def convert_sample(tr_mesh, wat_transformer, resolutions: list = None):
+    return (
+        convert_mesh(tr_mesh, wat_transformer, resolutions=resolutions),
+        len(tr_mesh.faces)
+    )
+
+
+def write_sample(
+    sample: BaseModel,
+    result,
+    simplify: bool = None,
+    num_target_faces: int = None,
+    ratio_target_faces: float = None,
+    check_watertight: bool = False,
+    resolutions: list = None,
+):
+    wat_meshes, n_faces = result
+    paths_to_files = output_paths(
+        sample.path_to_watertight_mesh_file, resolutions
+    )
+    num_faces = None
+    if simplify:
+        num_faces = target_num_faces(
+            n_faces, num_target_faces, ratio_target_faces
+        )
+    verdicts = export_watertight(
+        wat_meshes, paths_to_files, num_faces, check_watertight
+    )
+    if verdicts is None:
+        return [(p, None) for p in paths_to_files]
+    return list(zip(paths_to_files, verdicts))
 
 
 def ds_sample_to_watertight(
@@ -53,10 +369,13 @@ def ds_sample_to_watertight(
     simplify: bool = None,
     num_target_faces: int = None,
     ratio_target_faces: float = None,
+    check_watertight: bool = False,
+    resolutions: list = None,
 ):
-    mesh = sample.groundtruth_mesh
+    with METRICS.time("load"):
+        mesh = sample.groundtruth_mesh
     path_to_file = sample.path_to_watertight_mesh_file
-    mesh_to_watertight(
+    watertight = mesh_to_watertight(
         mesh=mesh,
         wat_transformer=wat_transformer,
         path_to_file=path_to_file,
@@ -65,7 +384,16 @@ def ds_sample_to_watertight(
         simplify=simplify,
         num_target_faces=num_target_faces,
         ratio_target_faces=ratio_target_faces,
+        check_watertight=check_watertight,
+        resolutions=resolutions,
     )
+    # Return a (path, verdict) pair for every exported file
+    if resolutions is None:
+        return [(path_to_file, watertight)]
+    paths_to_files = [multires_path(path_to_file, r) for r in resolutions]
+    if watertight is None:
+        return [(p, None) for p in paths_to_files]
+    return list(zip(paths_to_files, watertight))
 
 
 def main(argv):
@@ -105,6 +433,7 @@ def main(argv):
         default="tsdf_fusion",
         choices=[
             "tsdf_fusion",
+            "visual_hull",
             "manifoldplus"
         ]
     )
@@ -143,10 +472,34 @@ def main(argv):
         default=1,
         help="Number of processes to be used for the multiprocessing setup"
     )
+    parser.add_argument(
+        "--verdict_store",
+        default=None,
+        help=("Check the watertightness of every converted mesh and store "
+              "the verdicts in this file (see check_watertightness.py)")
+    )
 
     add_tsdf_fusion_parameters(parser)
+    add_visual_hull_parameters(parser)
     add_manifoldplus_parameters(parser)
+    add_pipeline_parameters(parser)
+    add_sequence_parameters(parser)
+    add_sharding_parameters(parser)
+    add_scheduling_parameters(parser)
+    add_metrics_parameters(parser)
+    add_supervision_parameters(parser)
     args = parser.parse_args(argv)
+    if args.sequence_mode:
+        if args.dataset_type not in ["dynamic_faust", "deforming_things_4d"]:
+            parser.error("--sequence_mode needs a dataset of sequences")
+        if args.resolutions is not None or args.pipelined:
+            parser.error(
+                "--sequence_mode cannot be combined with --resolutions or "
+                "--pipelined"
+            )
+    if args.resolutions is not None and \
+            args.watertight_method == "manifoldplus":
+        parser.error("--resolutions is not supported by manifoldplus")
     # Disable trimesh's logger
     logging.getLogger("trimesh").setLevel(logging.ERROR)
 
@@ -155,8 +508,16 @@ def main(argv):
         .with_dataset(args.dataset_type)
         .filter_category_tags(args.category_tags)
         .filter_tags(args.model_tags)
+        .shard(
+            args.shard_index,
+            args.num_shards,
+            # Every sequence is converted by a single shard, so that its
+            # frames reuse the state of the previous frame
+            group=(lambda m: m.category) if args.sequence_mode else None
+        )
         .build(args.dataset_directory)
     )
+    started = time.time()
 
     wat_transformer = WatertightTransformerFactory(
         args.watertight_method,
@@ -170,21 +531,147 @@ def main(argv):
         truncation_factor=args.truncation_factor,
         n_views=args.n_views,
         depth_offset_factor=args.depth_offset_factor,
+        fusion_method=args.fusion_method,
+        n_bins=args.n_bins,
+        tvl1_lambda=args.tvl1_lambda,
+        tvl1_iterations=args.tvl1_iterations,
+        tvl1_tolerance=args.tvl1_tolerance,
+        hist_dtype=args.hist_dtype,
+        adaptive_grid=args.adaptive_grid,
+        cache_dir=args.cache_dir,
+        cache_size_gb=args.cache_size_gb,
+        render_chunk_size=args.render_chunk_size,
+        visual_hull_views=args.visual_hull_views,
+        visual_hull_image_scale=args.visual_hull_image_scale,
         manifoldplus_script=args.manifoldplus_script,
         depth=args.depth,
+        manifoldplus_timeout=args.manifoldplus_timeout,
     )
 
-    distribute_files(
-        dataset=dataset,
-        wat_transformer=wat_transformer,
-        bbox=args.bbox,
-        unit_cube=args.unit_cube,
-        simplify=args.simplify,
-        num_target_faces=args.num_target_faces,
-        ratio_target_faces=args.ratio_target_faces,
-        num_cpus=args.num_cpus,
+    verdict_store = (
+        VerdictStore(args.verdict_store)
+        if args.verdict_store is not None else None
+    )
+    cost_model = CostModel(
+        args.timing_history or os.path.join(
+            args.dataset_directory, "timing_history.json"
+        ),
+        method=args.watertight_method,
+        resolutions=args.resolutions or [args.resolution],
+        n_views=(
+            args.visual_hull_views
+            if args.watertight_method == "visual_hull" else args.n_views
+        ),
     )
+    memory_budget = (
+        args.memory_budget_gb * 1024**3
+        if args.memory_budget_gb is not None else available_memory()
+    )
+    memory_limit = (
+        int(args.worker_memory_limit_gb * 1024**3)
+        if args.worker_memory_limit_gb is not None else None
+    )
+    quarantine = Quarantine(
+        args.quarantine or os.path.join(
+            args.dataset_directory, "quarantine.jsonl"
+        )
+    )
+    # The manifest still lists the quarantined samples as missing
+    samples = [
+        sample for sample in dataset
+        if args.retry_quarantined or sample.path_to_mesh_file not in quarantine
+    ]
+    if len(samples) < len(dataset):
+        print(f"Skipping {len(dataset) - len(samples)} quarantined meshes")
+    # The metrics of the run are written periodically while converting
+    with MetricsExporter(
+        args.metrics_textfile, args.metrics_json, args.metrics_interval
+    ):
+        if args.sequence_mode:
+            failed = distribute_sequences(
+                dataset=samples,
+                wat_transformer=wat_transformer,
+                bbox=args.bbox,
+                unit_cube=args.unit_cube,
+                simplify=args.simplify,
+                num_target_faces=args.num_target_faces,
+                ratio_target_faces=args.ratio_target_faces,
+                num_cpus=args.num_cpus,
+                verdict_store=verdict_store,
+                incremental=args.incremental_fusion,
+                keyframe_interval=args.keyframe_interval,
+                tolerance_factor=args.motion_tolerance,
+                cost_model=cost_model,
+                memory_budget=memory_budget,
+                timeout=args.mesh_timeout,
+                memory_limit=memory_limit,
+                quarantine=quarantine,
+            )
+        elif args.pipelined:
+            failed = distribute_files_pipelined(
+                dataset=samples,
+                wat_transformer=wat_transformer,
+                bbox=args.bbox,
+                unit_cube=args.unit_cube,
+                simplify=args.simplify,
+                num_target_faces=args.num_target_faces,
+                ratio_target_faces=args.ratio_target_faces,
+                num_cpus=args.num_cpus,
+                verdict_store=verdict_store,
+                resolutions=args.resolutions,
+                num_loaders=args.num_loaders,
+                num_writers=args.num_writers,
+                load_queue_depth=args.load_queue_depth,
+                write_queue_depth=args.write_queue_depth,
+                cost_model=cost_model,
+                memory_budget=memory_budget,
+                timeout=args.mesh_timeout,
+                memory_limit=memory_limit,
+                quarantine=quarantine,
+            )
+        else:
+            failed = distribute_files(
+                dataset=samples,
+                wat_transformer=wat_transformer,
+                bbox=args.bbox,
+                unit_cube=args.unit_cube,
+                simplify=args.simplify,
+                num_target_faces=args.num_target_faces,
+                ratio_target_faces=args.ratio_target_faces,
+                num_cpus=args.num_cpus,
+                verdict_store=verdict_store,
+                resolutions=args.resolutions,
+                cost_model=cost_model,
+                memory_budget=memory_budget,
+                timeout=args.mesh_timeout,
+                memory_limit=memory_limit,
+                quarantine=quarantine,
+            )
+
+    if args.num_shards > 1 or args.manifest_dir is not None:
+        path = write_shard_manifest(
+            args.manifest_dir or args.dataset_directory,
+            args.shard_index,
+            args.num_shards,
+            [
+                manifest_entry(
+                    sample.tag,
+                    output_paths(
+                        sample.path_to_watertight_mesh_file,
+                        args.resolutions
+                    )
+                )
+                for sample in dataset
+            ],
+            started
+        )
+        print(f"Stored the manifest of the shard in {path}")
+
+    if failed > 0:
+        print(f"Failed to convert {failed} meshes")
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
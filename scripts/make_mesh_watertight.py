@@ -3,15 +3,26 @@ import argparse
 import logging
 import os
 import sys
+import tempfile
+import time
+from contextlib import nullcontext
 from functools import partial
 
 import trimesh
 from simple_3dviz import Mesh
-from tqdm.contrib.concurrent import process_map
-from watertight_transformer import WatertightTransformerFactory
+from watertight_transformer import ChunkedMesh, WatertightTransformerFactory
+from watertight_transformer.datasets.model_collections import assign_shards
 
-from arguments import add_manifoldplus_parameters, add_tsdf_fusion_parameters
-from utils import ensure_parent_directory_exists, mesh_to_watertight
+from arguments import add_manifoldplus_parameters, add_metrics_parameters, \
+    add_scheduling_parameters, add_sharding_parameters, \
+    add_supervision_parameters, add_tsdf_fusion_parameters, \
+    add_visual_hull_parameters
+from manifests import manifest_entry, write_shard_manifest
+from metrics import METRICS, MetricsExporter
+from scheduling import CostModel, available_memory, run_longest_first
+from supervision import Quarantine
+from utils import ensure_parent_directory_exists, mesh_to_watertight, \
+    output_paths
 
 
 def distribute_files(
@@ -24,9 +35,29 @@ def distribute_files(
     num_target_faces: int = None,
     ratio_target_faces: float = None,
     num_cpus: int = 1,
+    resolutions: list = None,
+    single_mesh: bool = True,
+    cost_model: CostModel = None,
+    memory_budget: int = None,
+    timeout: float = None,
+    memory_limit: int = None,
+    quarantine: Quarantine = None,
+    render_chunk_size: int = None,
 ):
     # Assuming that dataset iterator contains only one instance of each path
-    process_map(
+    cost_model = cost_model or CostModel()
+    # Skip the converted meshes here, so that only actual conversions are
+    # timed
+    mesh_paths = [
+        p for p in mesh_paths
+        if not all(
+            os.path.exists(o) for o in output_paths(
+                watertight_mesh_path(p, output_folder_path, single_mesh),
+                resolutions
+            )
+        )
+    ]
+    results = run_longest_first(
         partial(
             mesh_path_to_watertight,
             output_folder_path=output_folder_path,
@@ -36,10 +67,31 @@ def distribute_files(
             simplify=simplify,
             num_target_faces=num_target_faces,
             ratio_target_faces=ratio_target_faces,
+            resolutions=resolutions,
+            single_mesh=single_mesh,
+            render_chunk_size=render_chunk_size,
         ),
         mesh_paths,
-        max_workers=num_cpus,
+        cost_model,
+        lambda mesh_path: mesh_path,
+        num_cpus=num_cpus,
+        estimate_memory=lambda mesh_path: wat_transformer.estimate_peak_memory(
+            cost_model.faces(mesh_path), resolutions
+        ),
+        memory_budget=memory_budget,
+        timeout=timeout,
+        memory_limit=memory_limit,
+        quarantine=quarantine,
     )
+    return sum(isinstance(r, Exception) for r in results)
+
+
+def watertight_mesh_path(mesh_path, output_folder_path, single_mesh=True):
+    if single_mesh:
+        return os.path.join(output_folder_path, "model_watertight.obj")
+    # Several meshes are converted into the same directory
+    file_name = mesh_path.split("/")[-1].split(".")[0]
+    return os.path.join(output_folder_path, f"{file_name}_watertight.obj")
 
 
 def mesh_path_to_watertight(
@@ -51,21 +103,37 @@ def mesh_path_to_watertight(
     simplify: bool = None,
     num_target_faces: int = None,
     ratio_target_faces: float = None,
+    resolutions: list = None,
+    single_mesh: bool = True,
+    render_chunk_size: int = None,
 ):
-    file_name = mesh_path.split("/")[-1].split(".")[0]
-    # path_to_file = os.path.join(output_folder_path, f"{file_name}.obj")
-    path_to_file = os.path.join(output_folder_path, "model_watertight.obj")
-    raw_mesh = Mesh.from_file(mesh_path)
-    mesh_to_watertight(
-        mesh=raw_mesh,
-        wat_transformer=wat_transformer,
-        path_to_file=path_to_file,
-        bbox=bbox,
-        unit_cube=unit_cube,
-        simplify=simplify,
-        num_target_faces=num_target_faces,
-        ratio_target_faces=ratio_target_faces,
+    path_to_file = watertight_mesh_path(
+        mesh_path, output_folder_path, single_mesh
     )
+    # With render_chunk_size, the mesh is streamed into batches on disk
+    # instead of being loaded and the renderer reads them back one at a time
+    with (
+        tempfile.TemporaryDirectory() if render_chunk_size is not None
+        else nullcontext()
+    ) as directory:
+        with METRICS.time("load"):
+            if directory is None:
+                raw_mesh = Mesh.from_file(mesh_path)
+            else:
+                raw_mesh = ChunkedMesh.from_file(
+                    mesh_path, directory, render_chunk_size, mode="r+"
+                )
+        mesh_to_watertight(
+            mesh=raw_mesh,
+            wat_transformer=wat_transformer,
+            path_to_file=path_to_file,
+            bbox=bbox,
+            unit_cube=unit_cube,
+            simplify=simplify,
+            num_target_faces=num_target_faces,
+            ratio_target_faces=ratio_target_faces,
+            resolutions=resolutions,
+        )
 
 
 def main(argv):
@@ -82,7 +150,7 @@ def main(argv):
     parser.add_argument(
         "--watertight_method",
         default="tsdf_fusion",
-        choices=["tsdf_fusion", "manifoldplus"]
+        choices=["tsdf_fusion", "visual_hull", "manifoldplus"]
     )
     parser.add_argument(
         "--unit_cube",
@@ -121,19 +189,40 @@ def main(argv):
     )
 
     add_tsdf_fusion_parameters(parser)
+    add_visual_hull_parameters(parser)
     add_manifoldplus_parameters(parser)
+    add_sharding_parameters(parser)
+    add_scheduling_parameters(parser)
+    add_metrics_parameters(parser)
+    add_supervision_parameters(parser)
     args = parser.parse_args(argv)
+    if args.resolutions is not None and \
+            args.watertight_method == "manifoldplus":
+        parser.error("--resolutions is not supported by manifoldplus")
     # Disable trimesh's logger
     logging.getLogger("trimesh").setLevel(logging.ERROR)
 
     if os.path.isdir(args.path_to_meshes):
         path_to_meshes = [
             os.path.join(args.path_to_meshes, mi)
-            for mi in os.listdir(args.path_to_meshes)
+            for mi in sorted(os.listdir(args.path_to_meshes))
             if mi.endswith(".obj") or mi.endswith(".off")
         ]
     else:
         path_to_meshes = [args.path_to_meshes]
+    single_mesh = len(path_to_meshes) == 1
+    if args.num_shards > 1:
+        # Balance the shards by the size of the mesh files
+        shards = assign_shards(
+            [os.path.basename(p) for p in path_to_meshes],
+            args.num_shards,
+            [os.path.getsize(p) for p in path_to_meshes]
+        )
+        path_to_meshes = [
+            p for p, s in zip(path_to_meshes, shards)
+            if s == args.shard_index
+        ]
+    started = time.time()
 
     # Check optimistically if the file already exists
     ensure_parent_directory_exists(args.path_to_output_directory)
@@ -150,22 +239,104 @@ def main(argv):
         truncation_factor=args.truncation_factor,
         n_views=args.n_views,
         depth_offset_factor=args.depth_offset_factor,
+        fusion_method=args.fusion_method,
+        n_bins=args.n_bins,
+        tvl1_lambda=args.tvl1_lambda,
+        tvl1_iterations=args.tvl1_iterations,
+        tvl1_tolerance=args.tvl1_tolerance,
+        hist_dtype=args.hist_dtype,
+        adaptive_grid=args.adaptive_grid,
+        cache_dir=args.cache_dir,
+        cache_size_gb=args.cache_size_gb,
+        render_chunk_size=args.render_chunk_size,
+        visual_hull_views=args.visual_hull_views,
+        visual_hull_image_scale=args.visual_hull_image_scale,
         manifoldplus_script=args.manifoldplus_script,
         depth=args.depth,
+        manifoldplus_timeout=args.manifoldplus_timeout,
     )
 
-    distribute_files(
-        mesh_paths=path_to_meshes,
-        output_folder_path=args.path_to_output_directory,
-        wat_transformer=wat_transformer,
-        bbox=args.bbox,
-        unit_cube=args.unit_cube,
-        simplify=args.simplify,
-        num_target_faces=args.num_target_faces,
-        ratio_target_faces=args.ratio_target_faces,
-        num_cpus=args.num_cpus,
+    cost_model = CostModel(
+        args.timing_history or os.path.join(
+            args.path_to_output_directory, "timing_history.json"
+        ),
+        method=args.watertight_method,
+        resolutions=args.resolutions or [args.resolution],
+        n_views=(
+            args.visual_hull_views
+            if args.watertight_method == "visual_hull" else args.n_views
+        ),
     )
+    quarantine = Quarantine(
+        args.quarantine or os.path.join(
+            args.path_to_output_directory, "quarantine.jsonl"
+        )
+    )
+    # The manifest still lists the quarantined meshes as missing
+    mesh_paths = [
+        p for p in path_to_meshes
+        if args.retry_quarantined or p not in quarantine
+    ]
+    # The metrics of the run are written periodically while converting
+    with MetricsExporter(
+        args.metrics_textfile, args.metrics_json, args.metrics_interval
+    ):
+        failed = distribute_files(
+            mesh_paths=mesh_paths,
+            output_folder_path=args.path_to_output_directory,
+            wat_transformer=wat_transformer,
+            bbox=args.bbox,
+            unit_cube=args.unit_cube,
+            simplify=args.simplify,
+            num_target_faces=args.num_target_faces,
+            ratio_target_faces=args.ratio_target_faces,
+            num_cpus=args.num_cpus,
+            resolutions=args.resolutions,
+            single_mesh=single_mesh,
+            cost_model=cost_model,
+            memory_budget=(
+                args.memory_budget_gb * 1024**3
+                if args.memory_budget_gb is not None else available_memory()
+            ),
+            timeout=args.mesh_timeout,
+            memory_limit=(
+                int(args.worker_memory_limit_gb * 1024**3)
+                if args.worker_memory_limit_gb is not None else None
+            ),
+            quarantine=quarantine,
+            # ManifoldPlus reads the whole mesh anyway
+            render_chunk_size=(
+                args.render_chunk_size
+                if args.watertight_method != "manifoldplus" else None
+            ),
+        )
+
+    if args.num_shards > 1 or args.manifest_dir is not None:
+        path = write_shard_manifest(
+            args.manifest_dir or args.path_to_output_directory,
+            args.shard_index,
+            args.num_shards,
+            [
+                manifest_entry(
+                    os.path.basename(p),
+                    output_paths(
+                        watertight_mesh_path(
+                            p, args.path_to_output_directory, single_mesh
+                        ),
+                        args.resolutions
+                    )
+                )
+                for p in path_to_meshes
+            ],
+            started
+        )
+        print(f"Stored the manifest of the shard in {path}")
+
+    if failed > 0:
+        print(f"Failed to convert {failed} meshes")
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,103 @@
+"""Completion manifests of the shards of a batch conversion."""
+
+import glob
+import json
+import os
+import time
+
+
+def manifest_path(manifest_dir, shard_index, num_shards):
+    return os.path.join(
+        manifest_dir,
+        f"manifest_shard_{shard_index:04d}_of_{num_shards:04d}.json"
+    )
+
+
+def write_shard_manifest(
+    manifest_dir, shard_index, num_shards, entries, started=None
+):
+    """Store the manifest of a shard.
+
+    Arguments:
+    ----------
+        manifest_dir: Directory to store the manifest in
+        shard_index: The index of the shard
+        num_shards: The total number of shards
+        entries: list of dictionaries with the tag of every model of the
+                 shard, the paths to its outputs and whether all of them
+                 exist
+        started: Optionally the time.time() when the shard started
+    """
+    os.makedirs(manifest_dir, exist_ok=True)
+    path = manifest_path(manifest_dir, shard_index, num_shards)
+    manifest = {
+        "shard_index": shard_index,
+        "num_shards": num_shards,
+        "started": started,
+        "finished": time.time(),
+        "n_models": len(entries),
+        "n_completed": sum(e["completed"] for e in entries),
+        "models": entries,
+    }
+    # Write to a temporary file first so that the merge never sees a
+    # partially written manifest
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def manifest_entry(tag, paths_to_files):
+    return {
+        "tag": tag,
+        "outputs": paths_to_files,
+        "completed": all(os.path.exists(p) for p in paths_to_files),
+    }
+
+
+def load_shard_manifests(manifest_dir):
+    manifests = []
+    for path in sorted(
+        glob.glob(os.path.join(manifest_dir, "manifest_shard_*_of_*.json"))
+    ):
+        with open(path, "r") as f:
+            manifests.append(json.load(f))
+    return manifests
+
+
+def merge_shard_manifests(manifests):
+    """Combine the manifests of all shards of a conversion into one.
+
+    Raises a ValueError if the manifests belong to runs with a different
+    number of shards or if a model appears in more than one shard.
+    """
+    if len(manifests) == 0:
+        raise ValueError("No shard manifests to merge")
+    num_shards = {m["num_shards"] for m in manifests}
+    if len(num_shards) != 1:
+        raise ValueError(
+            "The manifests were written with different numbers of shards "
+            f"{sorted(num_shards)}"
+        )
+    num_shards = num_shards.pop()
+
+    models = {}
+    for m in manifests:
+        for entry in m["models"]:
+            if entry["tag"] in models:
+                raise ValueError(
+                    f"{entry['tag']} appears in more than one shard"
+                )
+            models[entry["tag"]] = entry
+
+    found = sorted({m["shard_index"] for m in manifests})
+    return {
+        "num_shards": num_shards,
+        "missing_shards": sorted(set(range(num_shards)) - set(found)),
+        "n_models": len(models),
+        "n_completed": sum(e["completed"] for e in models.values()),
+        "incomplete": sorted(
+            t for t, e in models.items() if not e["completed"]
+        ),
+        "models": [models[t] for t in sorted(models)],
+    }
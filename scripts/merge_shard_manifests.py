@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Script for combining the completion manifests written by the shards of a
+batch conversion (see --num_shards) and reporting what is missing."""
+
+import argparse
+import json
+import os
+import sys
+
+from manifests import load_shard_manifests, merge_shard_manifests
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Merge the completion manifests of all shards"
+    )
+    parser.add_argument(
+        "manifest_dir",
+        help="Path to the directory containing the shard manifests"
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help=("Path to store the merged manifest, by default "
+              "manifest_merged.json in the manifest directory")
+    )
+    args = parser.parse_args(argv)
+
+    merged = merge_shard_manifests(load_shard_manifests(args.manifest_dir))
+    output = args.output or os.path.join(
+        args.manifest_dir, "manifest_merged.json"
+    )
+    with open(output, "w") as f:
+        json.dump(merged, f, indent=1)
+
+    print("Completed {}/{} models from {}/{} shards".format(
+        merged["n_completed"],
+        merged["n_models"],
+        merged["num_shards"] - len(merged["missing_shards"]),
+        merged["num_shards"],
+    ))
+    if merged["missing_shards"]:
+        print("Missing shards: {}".format(
+            ", ".join(map(str, merged["missing_shards"]))
+        ))
+    for tag in merged["incomplete"]:
+        print(f"Incomplete: {tag}")
+
+    # Signal to the caller whether the conversion is complete
+    return 0 if not merged["missing_shards"] and not merged["incomplete"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,359 @@
+"""Live metrics of long batch conversions.
+
+Every process records counters, gauges and latency histograms in its own
+METRICS registry. The worker processes return what they recorded during a
+call together with its result, see call_measured(), and the parent merges it
+into its registry. A MetricsExporter thread in the parent periodically
+rewrites a Prometheus textfile, e.g. for the textfile collector of the node
+exporter, and/or a JSON status file.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# The upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (
+    0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600
+)
+
+PREFIX = "watertight_"
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def _children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def process_tree_rss():
+    """The resident memory in bytes of this process and all its descendants,
+    e.g. the worker processes and the ManifoldPlus processes they started.
+    Only the current process is measured on systems without /proc."""
+    try:
+        parents = {}
+        rss = {}
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f"/proc/{pid}/stat", "r") as f:
+                    stat = f.read()
+                with open(f"/proc/{pid}/statm", "r") as f:
+                    statm = f.read()
+            except OSError:
+                # The process ended in the meantime
+                continue
+            # The command in parentheses may contain spaces
+            fields = stat[stat.rfind(")") + 2:].split()
+            parents[int(pid)] = int(fields[1])
+            rss[int(pid)] = int(statm.split()[1]) * page_size
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    tree = {os.getpid()}
+    grown = True
+    while grown:
+        children = {p for p, pp in parents.items() if pp in tree} - tree
+        tree |= children
+        grown = len(children) > 0
+    return sum(rss.get(p, 0) for p in tree)
+
+
+class Metrics:
+    """A thread-safe registry of counters, gauges and latency histograms,
+    identified by their name and labels."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = {
+                    "buckets": [0] * len(LATENCY_BUCKETS),
+                    "sum": 0.0,
+                    "count": 0
+                }
+            histogram = self.histograms[key]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def time(self, stage, count_subprocesses=False):
+        """Record the duration of the block in the stage_seconds histogram
+        and count it as a processed or a failed item of the stage.
+
+        With count_subprocesses, the CPU time of the child processes that
+        ended during the block, e.g. ManifoldPlus, is also counted.
+        """
+        start = time.perf_counter()
+        children = _children_cpu_seconds() if count_subprocesses else 0
+        try:
+            yield
+        except BaseException:
+            self.inc("stage_failures_total", stage=stage)
+            raise
+        else:
+            self.inc("stage_items_total", stage=stage)
+        finally:
+            self.observe(
+                "stage_seconds", time.perf_counter() - start, stage=stage
+            )
+            if count_subprocesses:
+                self.inc(
+                    "subprocess_cpu_seconds_total",
+                    _children_cpu_seconds() - children,
+                    stage=stage
+                )
+
+    def drain(self):
+        """Return the counters and the histograms recorded since the last
+        call and reset them, in a form that can be pickled and merged."""
+        with self._lock:
+            recorded = {
+                "counters": self.counters,
+                "histograms": self.histograms
+            }
+            self.counters = {}
+            self.histograms = {}
+        return recorded
+
+    def merge(self, recorded):
+        """Add the counters and the histograms returned by drain()."""
+        if recorded is None:
+            return
+        with self._lock:
+            for key, value in recorded["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in recorded["histograms"].items():
+                histogram = self.histograms.setdefault(key, {
+                    "buckets": [0] * len(LATENCY_BUCKETS),
+                    "sum": 0.0,
+                    "count": 0
+                })
+                for i, n in enumerate(other["buckets"]):
+                    histogram["buckets"][i] += n
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for kind, metrics in [
+                ("counter", self.counters), ("gauge", self.gauges)
+            ]:
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                    for (n, labels), value in sorted(metrics.items()):
+                        if n == name:
+                            lines.append(
+                                f"{PREFIX}{name}{_format_labels(labels)} "
+                                f"{float(value)}"
+                            )
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(LATENCY_BUCKETS, h["buckets"]):
+                        lines.append("{}{}_bucket{} {}".format(
+                            PREFIX, name,
+                            _format_labels(labels, [("le", f"{bound:g}")]),
+                            count
+                        ))
+                    lines.append("{}{}_bucket{} {}".format(
+                        PREFIX, name,
+                        _format_labels(labels, [("le", "+Inf")]),
+                        h["count"]
+                    ))
+                    lines.append(
+                        f"{PREFIX}{name}_sum{_format_labels(labels)} "
+                        f"{float(h['sum'])}"
+                    )
+                    lines.append(
+                        f"{PREFIX}{name}_count{_format_labels(labels)} "
+                        f"{h['count']}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """Return the metrics as a dictionary that can be stored as JSON."""
+        def entries(metrics, value=lambda v: v):
+            return [
+                {"name": name, "labels": dict(labels), "value": value(v)}
+                for (name, labels), v in sorted(metrics.items())
+            ]
+
+        def summary(h):
+            return {
+                "count": h["count"],
+                "sum": h["sum"],
+                "mean": h["sum"] / max(h["count"], 1),
+            }
+
+        with self._lock:
+            return {
+                "counters": entries(self.counters),
+                "gauges": entries(self.gauges),
+                "histograms": entries(self.histograms, summary),
+            }
+
+
+# The registry of this process
+METRICS = Metrics()
+
+
+def call_measured(fn, *args):
+    """Call fn in a worker process and return its result together with the
+    metrics recorded during the call, to be merged by the parent with
+    merge_measured(). If fn fails, the metrics are attached to the
+    exception."""
+    # Forked workers start with a copy of the metrics of the parent
+    METRICS.drain()
+    try:
+        result = fn(*args)
+    except Exception as e:
+        e.metrics = METRICS.drain()
+        raise
+    return result, METRICS.drain()
+
+
+def merge_measured(future):
+    """Merge the metrics of a finished call_measured() future into METRICS
+    and return its result, or raise its exception."""
+    METRICS.set("last_progress_timestamp_seconds", time.time())
+    try:
+        result, recorded = future.result()
+    except Exception as e:
+        METRICS.merge(getattr(e, "metrics", None))
+        raise
+    METRICS.merge(recorded)
+    return result
+
+
+def record_mesh(status):
+    """Count a mesh as converted, skipped or failed."""
+    METRICS.inc("meshes_total", status=status)
+    METRICS.set("last_progress_timestamp_seconds", time.time())
+
+
+class MetricsExporter:
+    """Periodically write the metrics of the run to a Prometheus textfile
+    and/or a JSON status file from a background thread.
+
+    Both files are written to a temporary file first and renamed, thus
+    readers never see a partial file. Every write also updates the resident
+    memory of the process tree and the uptime. Use it as a context manager,
+    the files are written once more when it exits.
+
+    Arguments:
+    ----------
+        prometheus_path: Path to the Prometheus textfile, it should end with
+                         .prom for the textfile collector
+        json_path: Path to the JSON status file
+        interval: Seconds between two writes
+        metrics: The Metrics to export, by default the METRICS of this
+                 process
+    """
+    def __init__(
+        self,
+        prometheus_path=None,
+        json_path=None,
+        interval=15,
+        metrics=None
+    ):
+        self.prometheus_path = prometheus_path
+        self.json_path = json_path
+        self.interval = interval
+        self.metrics = metrics or METRICS
+        self._started = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop(finished=exc[0] is None)
+
+    def start(self):
+        if self.prometheus_path is None and self.json_path is None:
+            return
+        self.metrics.set("start_timestamp_seconds", self._started)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, finished=True):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.write("finished" if finished else "failed")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                # Keep converting if e.g. the disk is full
+                print(f"Failed to write the metrics: {e}")
+
+    def write(self, state="running"):
+        now = time.time()
+        self.metrics.set("uptime_seconds", now - self._started)
+        self.metrics.set("resident_memory_bytes", process_tree_rss())
+        if self.prometheus_path is not None:
+            self._replace(self.prometheus_path, self.metrics.to_prometheus())
+        if self.json_path is not None:
+            status = {"state": state, "time": now}
+            status.update(self.metrics.to_dict())
+            # The throughput of every stage over the whole run
+            uptime = max(now - self._started, 1e-9)
+            status["throughput"] = {
+                c["labels"]["stage"]: c["value"] / uptime
+                for c in status["counters"]
+                if c["name"] == "stage_items_total"
+            }
+            self._replace(self.json_path, json.dumps(status, indent=1))
+
+    @staticmethod
+    def _replace(path, content):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
@@ -0,0 +1,247 @@
+"""A batch runner that overlaps loading, converting and writing meshes."""
+
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from tqdm import tqdm
+
+from metrics import METRICS, call_measured, merge_measured, record_mesh
+from scheduling import _timed_call
+from supervision import SupervisedPool
+
+# Marks the end of a queue
+_DONE = object()
+
+
+def _timed_convert(convert, payload):
+    with METRICS.time("convert", count_subprocesses=True):
+        return _timed_call(convert, payload)
+
+
+class PipelinedRunner:
+    """Run load -> convert -> write for many items with overlapping stages.
+
+    A pool of loader threads prefetches the items, which are usually bound by
+    the file system, into a bounded queue. The CPU-bound conversion runs in a
+    pool of worker processes, one item per process at a time, and its results
+    are put into a second bounded queue. That queue is drained by a pool of
+    writer threads that export the results. When a queue is full, the stage
+    feeding it blocks, thus at most
+    load_queue_depth + num_workers + write_queue_depth + num_writers
+    items are in memory at any time.
+
+    A failing item does not stop the others. The exception is returned in
+    place of its result. The worker processes are supervised, see
+    SupervisedPool, thus a conversion that crashes its process or exceeds
+    the timeout also only fails its own item.
+
+    With a memory budget, an item is only handed to a worker when its
+    estimated peak memory fits in the budget together with the items that
+    are being converted. The items are converted in the order they are
+    loaded, thus an item that does not fit waits for the running ones.
+
+    The seconds and the peak memory of every successful conversion are
+    measured in the worker and passed to on_converted, e.g. to record them
+    in a CostModel.
+
+    Arguments:
+    ----------
+        load: Function that takes an item and returns the input of convert,
+              or None to skip the item
+        convert: Picklable function that takes the output of load and
+                 returns the input of write, run in the worker processes
+        write: Function that takes the item and the output of convert
+        num_loaders: Number of loader threads
+        num_workers: Number of worker processes
+        num_writers: Number of writer threads
+        load_queue_depth: Maximum number of loaded items waiting for a worker
+        write_queue_depth: Maximum number of converted items waiting for a
+                           writer
+        estimate_memory: Function returning the estimated peak memory in
+                         bytes of converting an item
+        memory_budget: The memory in bytes that the items being converted
+                       may use, None for unbounded
+        timeout: The maximum seconds per conversion, None for unlimited
+        memory_limit: The maximum virtual memory in bytes of every worker
+                      process, None for unlimited
+        on_converted: Function called with the item, the seconds and the
+                      peak memory in bytes of every successful conversion
+    """
+    def __init__(
+        self,
+        load,
+        convert,
+        write,
+        num_loaders=4,
+        num_workers=1,
+        num_writers=2,
+        load_queue_depth=8,
+        write_queue_depth=8,
+        estimate_memory=None,
+        memory_budget=None,
+        timeout=None,
+        memory_limit=None,
+        on_converted=None,
+    ):
+        self.load = load
+        self.convert = convert
+        self.write = write
+        self.num_loaders = num_loaders
+        self.num_workers = num_workers
+        self.num_writers = num_writers
+        self.load_queue_depth = load_queue_depth
+        self.write_queue_depth = write_queue_depth
+        self.estimate_memory = estimate_memory
+        self.memory_budget = memory_budget
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.on_converted = on_converted
+
+    def run(self, items, progress=True):
+        """Process the items and return a list of (item, result) pairs in
+        completion order. The result is the return value of write, None for
+        skipped items or the exception raised while processing the item."""
+        try:
+            total = len(items)
+        except TypeError:
+            total = None
+        items = iter(items)
+        items_lock = threading.Lock()
+        loaded = queue.Queue(self.load_queue_depth)
+        converted = queue.Queue(self.write_queue_depth)
+
+        results = []
+        results_lock = threading.Lock()
+        pbar = tqdm(total=total, disable=not progress)
+
+        def record(item, result, status):
+            record_mesh(status)
+            with results_lock:
+                results.append((item, result))
+                pbar.update(1)
+
+        def loader():
+            while True:
+                with items_lock:
+                    item = next(items, _DONE)
+                if item is _DONE:
+                    return
+                try:
+                    with METRICS.time("load"):
+                        payload = self.load(item)
+                except Exception as e:
+                    record(item, e, "failed")
+                    continue
+                if payload is None:
+                    record(item, None, "skipped")
+                    continue
+                # Blocks while the workers are behind
+                loaded.put((item, payload))
+
+        def writer():
+            while True:
+                entry = converted.get()
+                if entry is _DONE:
+                    return
+                item, result = entry
+                if isinstance(result, Exception):
+                    record(item, result, "failed")
+                    continue
+                try:
+                    with METRICS.time("write"):
+                        written = self.write(item, result)
+                except Exception as e:
+                    record(item, e, "failed")
+                    continue
+                record(item, written, "converted")
+
+        loaders = [
+            threading.Thread(target=loader, daemon=True)
+            for _ in range(self.num_loaders)
+        ]
+        writers = [
+            threading.Thread(target=writer, daemon=True)
+            for _ in range(self.num_writers)
+        ]
+        for t in loaders + writers:
+            t.start()
+
+        def close_loaded():
+            for t in loaders:
+                t.join()
+            loaded.put(_DONE)
+        closer = threading.Thread(target=close_loaded, daemon=True)
+        closer.start()
+
+        memory_budget = self.memory_budget
+        if memory_budget is None:
+            memory_budget = float("inf")
+
+        with SupervisedPool(
+            self.num_workers, self.timeout, self.memory_limit
+        ) as pool:
+            in_flight = {}
+            held = None
+            exhausted = False
+            while not exhausted or len(in_flight) > 0 or held is not None:
+                # Keep every worker busy but leave the rest of the loaded
+                # items in the queue, so that the loaders feel the
+                # back-pressure
+                while len(in_flight) < self.num_workers:
+                    if held is None:
+                        if exhausted:
+                            break
+                        try:
+                            entry = loaded.get(block=len(in_flight) == 0)
+                        except queue.Empty:
+                            break
+                        if entry is _DONE:
+                            exhausted = True
+                            break
+                        item, payload = entry
+                        memory = (
+                            self.estimate_memory(item)
+                            if self.estimate_memory is not None else 0
+                        )
+                        held = (item, payload, memory)
+                    item, payload, memory = held
+                    used = sum(m for _, m in in_flight.values())
+                    # An item that does not fit waits for the running items,
+                    # unless nothing is running
+                    if used + memory > memory_budget and len(in_flight) > 0:
+                        break
+                    held = None
+                    future = pool.submit(
+                        call_measured, _timed_convert, self.convert, payload
+                    )
+                    in_flight[future] = (item, memory)
+
+                METRICS.set("queue_depth", loaded.qsize(), queue="load")
+                METRICS.set("queue_depth", converted.qsize(), queue="write")
+                METRICS.set("queue_depth", len(in_flight), queue="in_flight")
+                if len(in_flight) == 0:
+                    continue
+                # Wake up regularly to hand new items to idle workers
+                done, _ = wait(
+                    in_flight, timeout=0.1, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    item, _ = in_flight.pop(future)
+                    try:
+                        result, seconds, peak = merge_measured(future)
+                    except Exception as e:
+                        result = e
+                    else:
+                        if self.on_converted is not None:
+                            self.on_converted(item, seconds, peak)
+                    # Blocks while the writers are behind
+                    converted.put((item, result))
+                METRICS.set("queue_depth", len(in_flight), queue="in_flight")
+
+        for _ in writers:
+            converted.put(_DONE)
+        for t in writers:
+            t.join()
+        pbar.close()
+        return results
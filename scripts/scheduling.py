@@ -0,0 +1,437 @@
+"""Longest-first scheduling of the conversions based on a cost model."""
+
+import bisect
+import json
+import os
+import resource
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+from scipy.optimize import nnls
+from tqdm import tqdm
+from watertight_transformer.watertightness import read_off_counts
+
+from metrics import METRICS, call_measured, merge_measured, record_mesh
+from supervision import SupervisedPool
+
+# Rough number of bytes per face of an OBJ file, including its share of the
+# vertices, used when the face count is not known
+OBJ_BYTES_PER_FACE = 40
+
+
+def count_faces(path_to_mesh):
+    """Return the number of faces of a mesh file without loading it.
+
+    OFF files store the number of faces in their header. For other formats
+    the number of faces is estimated from the size of the file.
+    """
+    if path_to_mesh.endswith(".off"):
+        try:
+            with open(path_to_mesh, "r") as f:
+                return read_off_counts(f)[1]
+        except ValueError:
+            pass
+    return os.path.getsize(path_to_mesh) // OBJ_BYTES_PER_FACE
+
+
+class CostModel:
+    """Estimate how many seconds a conversion takes.
+
+    The cost is modeled as a linear function of the features
+    [1, F, F*V, R^3*V], where F is the number of faces of the input mesh, V
+    the number of views and R^3 the total number of voxels of all the
+    resolutions. The weights start from a rough prior and are refitted,
+    separately for every method, from the measured times stored in a history
+    file, thus the estimates improve with every run.
+
+    Arguments:
+    ----------
+        path_to_history: Optionally a JSON file to load the measured times
+                         from and to store them to
+        method: The watertight method, only the history of the same method
+                is used to fit the weights
+        resolutions: list of the resolutions of the conversion
+        n_views: The number of views of the conversion
+    """
+    prior_weights = np.array([1.0, 2e-6, 1e-8, 2e-9])
+
+    def __init__(
+        self,
+        path_to_history=None,
+        method="tsdf_fusion",
+        resolutions=(256,),
+        n_views=100,
+    ):
+        self.path_to_history = path_to_history
+        self.method = method
+        self.n_voxels = float(sum(r**3 for r in resolutions))
+        self.n_views = n_views
+
+        self.history = {"timings": [], "faces": {}}
+        if path_to_history is not None and os.path.exists(path_to_history):
+            with open(path_to_history, "r") as f:
+                self.history = json.load(f)
+        self.weights = self.fit()
+
+    def _features(self, n_faces, n_voxels, n_views):
+        return np.array([
+            1.0, n_faces, n_faces * n_views, n_voxels * n_views
+        ])
+
+    def fit(self):
+        timings = [
+            t for t in self.history["timings"] if t["method"] == self.method
+        ]
+        # Keep the prior until there are enough measurements
+        if len(timings) < 2 * len(self.prior_weights):
+            return self.prior_weights
+        A = np.stack([
+            self._features(t["faces"], t["voxels"], t["views"])
+            for t in timings
+        ])
+        b = np.array([t["seconds"] for t in timings])
+        # Scale the columns so that they are comparable
+        scale = np.maximum(np.abs(A).max(axis=0), 1e-12)
+        weights, _ = nnls(A / scale, b)
+        return weights / scale
+
+    def faces(self, path_to_mesh):
+        """The number of faces of the mesh, cached in the history."""
+        stat = os.stat(path_to_mesh)
+        entry = self.history["faces"].get(path_to_mesh)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        n_faces = count_faces(path_to_mesh)
+        self.history["faces"][path_to_mesh] = [
+            stat.st_size, stat.st_mtime_ns, n_faces
+        ]
+        return n_faces
+
+    def predict(self, path_to_mesh):
+        """The estimated seconds to convert the mesh."""
+        try:
+            n_faces = self.faces(path_to_mesh)
+        except OSError:
+            return 0.0
+        features = self._features(n_faces, self.n_voxels, self.n_views)
+        return float(features.dot(self.weights))
+
+    def record(
+        self,
+        path_to_mesh,
+        seconds,
+        estimated_memory=None,
+        measured_memory=None
+    ):
+        try:
+            n_faces = self.faces(path_to_mesh)
+        except OSError:
+            return
+        self.history["timings"].append({
+            "method": self.method,
+            "faces": n_faces,
+            "voxels": self.n_voxels,
+            "views": self.n_views,
+            "seconds": seconds,
+            "estimated_memory": estimated_memory,
+            "measured_memory": measured_memory,
+        })
+
+    def save(self):
+        if self.path_to_history is None:
+            return
+        tmp_path = self.path_to_history + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.history, f)
+        os.replace(tmp_path, self.path_to_history)
+
+
+def longest_first(items, costs):
+    """Sort the items by decreasing cost, keeping the order of equal costs."""
+    order = sorted(range(len(items)), key=lambda i: -costs[i])
+    return [items[i] for i in order]
+
+
+def available_memory():
+    """The memory in bytes that is available for new processes."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process, which is only
+    supported on Linux."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_memory():
+    """The peak resident memory in bytes of this process since the last
+    reset_peak_memory(), or since it started if resetting is unsupported."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # In kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _PendingItems:
+    """The items that are not started yet, in decreasing order of cost.
+
+    The items are removed by their position in that order. A segment tree
+    over their estimated memory finds the first item after a position that
+    fits in the memory left in O(log n), thus dispatching n items does not
+    rescan the pending ones every time.
+    """
+    def __init__(self, order, memory):
+        self.order = order
+        self.removed = [False] * len(order)
+        self.n_left = len(order)
+        self.head = 0
+        self.size = 1
+        while self.size < len(order):
+            self.size *= 2
+        self.tree = [float("inf")] * (2 * self.size)
+        for position, i in enumerate(order):
+            self.tree[self.size + position] = memory[i]
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = min(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def __len__(self):
+        return self.n_left
+
+    def first_fitting(self, start, limit):
+        """The first position from start on whose memory is at most limit,
+        None if there is none."""
+        def search(node, lo, hi):
+            if hi <= start or self.tree[node] > limit:
+                return None
+            if hi - lo == 1:
+                return lo
+            mid = (lo + hi) // 2
+            position = search(2 * node, lo, mid)
+            if position is None:
+                position = search(2 * node + 1, mid, hi)
+            return position
+        return search(1, 0, self.size)
+
+    def remove(self, position):
+        self.removed[position] = True
+        self.n_left -= 1
+        node = self.size + position
+        self.tree[node] = float("inf")
+        node //= 2
+        while node > 0:
+            self.tree[node] = min(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+        while self.head < len(self.order) and self.removed[self.head]:
+            self.head += 1
+
+
+def _timed_call(fn, item):
+    reset_peak_memory()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    start = time.perf_counter()
+    result = fn(item)
+    seconds = time.perf_counter() - start
+    peak = peak_memory()
+    # The peak of the child processes (e.g. ManifoldPlus) can only be
+    # measured when it exceeds the peak of all the previous ones
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if children_after > children:
+        peak += children_after * 1024
+    return result, seconds, peak
+
+
+def run_longest_first(
+    fn,
+    items,
+    cost_model,
+    path_of,
+    num_cpus=1,
+    estimate_memory=None,
+    memory_budget=None,
+    timeout=None,
+    memory_limit=None,
+    quarantine=None,
+):
+    """Call fn on every item in num_cpus processes, from the most to the
+    least expensive item according to the cost model.
+
+    The items are not split into fixed chunks. Every process takes the next
+    most expensive item as soon as it is idle, so the few most expensive
+    items start first instead of delaying the end of the run. The time and
+    the peak memory of every call are recorded in the cost model and the
+    history is saved.
+
+    With a memory budget, an item is only started when its estimated peak
+    memory fits in the budget together with the running items. When the most
+    expensive remaining item does not fit, cheaper items that are expected to
+    finish before any running item are started in the meantime, so that they
+    do not delay it.
+
+    The processes are supervised, see SupervisedPool. A call that takes
+    longer than the timeout or whose process crashes fails without affecting
+    the others.
+
+    An item can also be a sequence of meshes that fn converts as a whole,
+    when path_of returns the list of their paths. Its cost is the sum of the
+    costs of its meshes, its timeout is the timeout per mesh times their
+    number and its measured time is split among its meshes in proportion to
+    their predicted costs.
+
+    Arguments:
+    ----------
+        fn: Picklable function to call with every item
+        items: list of items
+        cost_model: A CostModel
+        path_of: Function returning the path to the input mesh of an item,
+                 or the list of paths of the meshes of a sequence
+        num_cpus: The number of processes
+        estimate_memory: Function returning the estimated peak memory in
+                         bytes of an item
+        memory_budget: The memory in bytes that the running items may use,
+                       None for unbounded
+        timeout: The maximum seconds per item, None for unlimited
+        memory_limit: The maximum virtual memory in bytes of every process,
+                      None for unlimited
+        quarantine: A Quarantine to add the paths of the failed items to,
+                    see Quarantine.accepts()
+
+    Returns:
+    --------
+        The results of fn in the order of items, the exception for the
+        failed items
+    """
+    paths = [path_of(item) for item in items]
+    paths = [p if isinstance(p, list) else [p] for p in paths]
+    mesh_costs = [[cost_model.predict(p) for p in ps] for ps in paths]
+    costs = [sum(c) for c in mesh_costs]
+    order = sorted(range(len(items)), key=lambda i: -costs[i])
+    # The negated costs in the order of the pending items, for bisect
+    sorted_costs = [-costs[i] for i in order]
+    memory = [
+        estimate_memory(item) if estimate_memory is not None else 0
+        for item in items
+    ]
+    pending = _PendingItems(order, memory)
+    if memory_budget is None:
+        memory_budget = float("inf")
+
+    results = [None] * len(items)
+    peaks = {}
+    pbar = tqdm(total=len(items))
+    with SupervisedPool(num_cpus, timeout, memory_limit) as pool:
+        in_flight = {}
+        while len(pending) > 0 or len(in_flight) > 0:
+            while len(pending) > 0 and len(in_flight) < num_cpus:
+                used = sum(memory[i] for i, _ in in_flight.values())
+                now = time.perf_counter()
+                # The time until the first running item is expected to end
+                shadow = min(
+                    (started + costs[i] - now
+                     for i, started in in_flight.values()),
+                    default=float("inf")
+                )
+                position = pending.head
+                if used + memory[order[position]] > memory_budget:
+                    # The items expected to finish before the first running
+                    # one are at the end of the order
+                    position = pending.first_fitting(
+                        bisect.bisect_left(sorted_costs, -shadow),
+                        memory_budget - used
+                    )
+                if position is None:
+                    if len(in_flight) > 0:
+                        break
+                    # It will never fit better than with nothing running
+                    position = pending.head
+                    i = order[position]
+                    print(
+                        f"{paths[i][0]} is estimated to need "
+                        f"{memory[i] / 1024**3:.2f} GB, more than the budget"
+                    )
+                pending.remove(position)
+                i = order[position]
+                future = pool.submit(
+                    call_measured,
+                    _timed_call,
+                    fn,
+                    items[i],
+                    call_timeout=timeout and timeout * len(paths[i])
+                )
+                in_flight[future] = (i, time.perf_counter())
+            METRICS.set("queue_depth", len(pending), queue="pending")
+            METRICS.set("queue_depth", len(in_flight), queue="in_flight")
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, _ = in_flight.pop(future)
+                pbar.update(1)
+                try:
+                    results[i], seconds, peaks[i] = merge_measured(future)
+                except Exception as e:
+                    print(f"Failed to convert {paths[i][0]}: {e}")
+                    results[i] = e
+                    for path in paths[i]:
+                        record_mesh("failed")
+                        if quarantine is not None and quarantine.accepts(e):
+                            quarantine.add(path, e)
+                    continue
+                total_cost = sum(mesh_costs[i])
+                for path, cost in zip(paths[i], mesh_costs[i]):
+                    record_mesh("converted")
+                    cost_model.record(
+                        path,
+                        (
+                            seconds * cost / total_cost if total_cost > 0
+                            else seconds / len(paths[i])
+                        ),
+                        memory[i] if estimate_memory is not None else None,
+                        peaks[i]
+                    )
+            METRICS.set("queue_depth", len(in_flight), queue="in_flight")
+    pbar.close()
+    cost_model.save()
+
+    if estimate_memory is not None and len(peaks) > 0:
+        report_memory(
+            [paths[i][0] for i in peaks],
+            [memory[i] for i in peaks],
+            list(peaks.values())
+        )
+
+    return results
+
+
+def report_memory(paths, estimated, measured):
+    """Print how the estimated peak memory compares to the measured one."""
+    ratios = np.array(measured, dtype=float) / np.maximum(estimated, 1)
+    worst = int(np.argmax(ratios))
+    print(
+        "Peak memory: measured/estimated median {:.2f}, max {:.2f} "
+        "({}, estimated {:.2f} GB, measured {:.2f} GB)".format(
+            np.median(ratios),
+            ratios[worst],
+            paths[worst],
+            estimated[worst] / 1024**3,
+            measured[worst] / 1024**3,
+        )
+    )
+    n_under = int((ratios > 1).sum())
+    if n_under > 0:
+        print(f"The peak memory of {n_under} meshes was underestimated")
@@ -0,0 +1,297 @@
+"""A process pool that survives crashing and hanging conversions."""
+
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import wait as wait_connections
+
+from metrics import METRICS
+
+
+class WorkerTimeout(Exception):
+    """The call did not finish in time and its worker was killed."""
+
+
+class WorkerCrashed(Exception):
+    """The worker died during the call, e.g. from a segmentation fault."""
+
+
+def _describe_exit(exitcode):
+    if exitcode is not None and exitcode < 0:
+        try:
+            return f"killed by {signal.Signals(-exitcode).name}"
+        except ValueError:
+            return f"killed by signal {-exitcode}"
+    return f"exited with code {exitcode}"
+
+
+def _descendants(pid):
+    """Return the pids of the processes started by pid, directly or not,
+    found in /proc, or an empty list without /proc."""
+    children = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # The command may contain spaces, the fields after it do not
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    descendants = []
+    stack = [pid]
+    while len(stack) > 0:
+        for child in children.get(stack.pop(), []):
+            descendants.append(child)
+            stack.append(child)
+    return descendants
+
+
+def _worker(conn, memory_limit):
+    # Start a new process group so that the processes started by a call,
+    # e.g. ManifoldPlus, are killed together with the worker
+    os.setsid()
+    if memory_limit is not None:
+        # Allocations beyond the limit fail instead of exhausting the
+        # memory of the machine, the limit is inherited by the subprocesses
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        fn, args, kwargs = task
+        try:
+            result = (True, fn(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # The result or the exception cannot be pickled
+            conn.send((False, RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+class SupervisedPool:
+    """Run calls in worker processes that are replaced when they die or hang.
+
+    Every worker runs one call at a time. A call that takes longer than the
+    timeout fails with WorkerTimeout and a call whose worker dies, e.g. from a
+    segmentation fault in the renderer or from exceeding the memory limit in
+    native code, fails with WorkerCrashed. In both cases the worker and the
+    processes it started are killed and a new worker takes the next call,
+    thus only the offending call fails and the queued calls are not lost.
+
+    It implements the submit() and shutdown() methods of the executors of
+    concurrent.futures and can be used in their place. The workers are
+    started with the forkserver method, thus, as with any multiprocessing
+    code, scripts using it need an `if __name__ == "__main__":` guard.
+
+    Arguments:
+    ----------
+        num_workers: The number of worker processes
+        timeout: The maximum seconds per call, None for unlimited
+        memory_limit: The maximum virtual memory in bytes of every worker,
+                      None for unlimited
+    """
+    def __init__(self, num_workers=1, timeout=None, memory_limit=None):
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._tasks = queue.Queue()
+        # The workers are started from the threads of the slots, while other
+        # threads may hold locks, e.g. the one of METRICS, that a forked
+        # worker would inherit locked forever
+        self._context = multiprocessing.get_context(
+            "forkserver"
+            if "forkserver" in multiprocessing.get_all_start_methods()
+            else "spawn"
+        )
+        self._slots = [
+            threading.Thread(target=self._supervise, daemon=True)
+            for _ in range(num_workers)
+        ]
+        for t in self._slots:
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, fn, *args, call_timeout=None, **kwargs):
+        """Schedule fn(*args, **kwargs) and return a Future. The call_timeout
+        overrides the timeout of the pool for this call."""
+        future = Future()
+        self._tasks.put(
+            (future, (fn, args, kwargs), call_timeout or self.timeout)
+        )
+        return future
+
+    def shutdown(self, wait=True):
+        for _ in self._slots:
+            self._tasks.put(None)
+        if wait:
+            for t in self._slots:
+                t.join()
+
+    def _start_worker(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker, args=(child_conn, self.memory_limit), daemon=True
+        )
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    @staticmethod
+    def _kill(process):
+        # The processes that left the group of the worker, e.g. ManifoldPlus
+        # in its own session, are only found while the worker is alive
+        descendants = _descendants(process.pid)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            process.kill()
+        for pid in descendants:
+            try:
+                os.killpg(os.getpgid(pid), signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                # It was in the group of the worker
+                pass
+        process.join()
+
+    def _supervise(self):
+        worker = None
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            future, call, timeout = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            if worker is None:
+                try:
+                    worker = self._start_worker()
+                except Exception as e:
+                    # E.g. the machine is out of memory or processes, fail
+                    # this call and try again with the next one
+                    future.set_exception(e)
+                    continue
+            process, conn = worker
+            try:
+                conn.send(call)
+            except Exception as e:
+                # The call cannot be pickled, the worker is still fine
+                future.set_exception(e)
+                continue
+
+            ready = wait_connections([conn, process.sentinel], timeout)
+            if conn in ready:
+                try:
+                    ok, result = conn.recv()
+                except EOFError:
+                    # It died while sending the result
+                    ready = [process.sentinel]
+                else:
+                    if ok:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(result)
+                    continue
+
+            if len(ready) == 0:
+                self._kill(process)
+                error = WorkerTimeout(
+                    f"The call did not finish within {timeout} seconds"
+                )
+                reason = "timeout"
+            else:
+                process.join()
+                error = WorkerCrashed(
+                    f"The worker {_describe_exit(process.exitcode)}"
+                )
+                reason = "crash"
+            conn.close()
+            worker = None
+            METRICS.inc("worker_restarts_total", reason=reason)
+            future.set_exception(error)
+
+        if worker is not None:
+            process, conn = worker
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join()
+
+
+class Quarantine:
+    """The inputs that failed to convert together with their errors.
+
+    The entries are appended to a JSON lines file as soon as they are added,
+    so that they survive the run, and the scripts skip the quarantined inputs
+    in later runs. Only the failures caused by the input itself, i.e. a
+    timeout, a crash or running out of memory, are quarantined, while other
+    errors, e.g. a wrong configuration, would fail every input again.
+
+    Arguments:
+    ----------
+        path: The path to the JSON lines file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["path"]] = entry
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def accepts(error):
+        """Return whether the error is quarantined."""
+        return isinstance(error, (
+            WorkerTimeout,
+            WorkerCrashed,
+            MemoryError,
+            subprocess.TimeoutExpired
+        ))
+
+    def add(self, path, error):
+        entry = {
+            "path": path,
+            "error": f"{type(error).__name__}: {error}",
+            "time": time.time(),
+        }
+        with self._lock:
+            self.entries[path] = entry
+            os.makedirs(
+                os.path.dirname(os.path.abspath(self.path)), exist_ok=True
+            )
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        METRICS.inc("quarantined_total")
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""Script for measuring the speed and the quality of TSDF fusion for
+different parameters on a sample of a dataset.
+
+Every configuration of n_views, image size, resolution, truncation_factor and
+depth_offset_factor, either from the full grid of the given values or sampled
+at random from it, converts every sampled mesh. For every configuration we
+report the time and the peak memory of rendering, fusion and marching cubes,
+the Chamfer distance and the volumetric IoU with the input mesh and the
+fraction of watertight outputs. The configurations that are not dominated by
+another one in all of these are marked as the Pareto front.
+"""
+import argparse
+import itertools
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+from simple_3dviz import Mesh
+from watertight_transformer.datasets import ModelCollectionBuilder
+from watertight_transformer.tsdf_fusion import TSDFFusion
+from watertight_transformer.watertightness import is_watertight
+
+from scheduling import peak_memory, reset_peak_memory
+from utils import chamfer_distance, normalize_mesh, volumetric_iou
+
+PARAMETERS = [
+    "n_views",
+    "image_size",
+    "resolution",
+    "truncation_factor",
+    "depth_offset_factor"
+]
+STAGES = ["render", "fusion", "marching_cubes"]
+
+
+def configurations(values, search="grid", n_trials=10, seed=0):
+    """Return the configurations to be evaluated as a list of dictionaries.
+
+    Arguments:
+    ----------
+        values: Dictionary with the list of values of every parameter
+        search: grid for every combination of the values, random for n_trials
+                distinct combinations drawn uniformly
+        n_trials: The number of random configurations
+        seed: The seed of the random search
+    """
+    grid = [
+        dict(zip(PARAMETERS, c))
+        for c in itertools.product(*[values[p] for p in PARAMETERS])
+    ]
+    if search == "random" and n_trials < len(grid):
+        rng = np.random.default_rng(seed)
+        grid = [grid[i] for i in rng.choice(len(grid), n_trials, False)]
+    # Configurations that render the same views are run one after the other,
+    # so that their depth maps are only rendered once
+    return sorted(grid, key=lambda c: (c["n_views"], c["image_size"]))
+
+
+def tsdf_fusion(config):
+    size = config["image_size"]
+    # Keep the field of view of the default 640x640 images
+    return TSDFFusion(
+        image_height=size,
+        image_width=size,
+        focal_length_x=size,
+        focal_length_y=size,
+        principal_point_x=size / 2,
+        principal_point_y=size / 2,
+        resolution=config["resolution"],
+        truncation_factor=config["truncation_factor"],
+        n_views=config["n_views"],
+        depth_offset_factor=config["depth_offset_factor"]
+    )
+
+
+def timed(fn, *args):
+    """Call fn and return its result, the seconds it took and the peak
+    resident memory in bytes during the call."""
+    reset_peak_memory()
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start, peak_memory()
+
+
+def convert_by_stage(tsdf, mesh, Rs, depthmaps):
+    """Fuse and extract the rendered depth maps of the mesh and return the
+    watertight mesh together with the time and the peak memory of both
+    stages."""
+    def fuse():
+        grid = tsdf.grid(mesh)
+        # Fused into a padded buffer, as in the conversion
+        return tsdf.fusion(
+            tsdf.offset_depthmaps(depthmaps), list(Rs), grid=grid, pad=1
+        )[0], grid[1]
+
+    (volume, origin), fusion_seconds, fusion_memory = timed(fuse)
+    wat_mesh, mc_seconds, mc_memory = timed(
+        lambda: tsdf.tsdf_to_mesh(volume, origin=origin, padded=True)
+    )
+    stages = {
+        "fusion": {"seconds": fusion_seconds, "memory": fusion_memory},
+        "marching_cubes": {"seconds": mc_seconds, "memory": mc_memory},
+    }
+    return wat_mesh, stages
+
+
+def evaluate(paths, configs, n_points, seed=0):
+    """Convert every mesh with every configuration and return the list of
+    measurements per configuration."""
+    rng = np.random.default_rng(seed)
+    results = [[] for _ in configs]
+    for path in paths:
+        mesh = normalize_mesh(Mesh.from_file(path), unit_cube=True)
+        points = rng.uniform(-0.55, 0.55, size=(n_points, 3))
+        render_key, render = None, None
+        for config, config_results in zip(configs, results):
+            tsdf = tsdf_fusion(config)
+            Rs = tsdf.get_views()
+            key = (config["n_views"], config["image_size"])
+            if key != render_key:
+                render_key = key
+                render = timed(tsdf.render_raw, mesh, Rs)
+            depthmaps, render_seconds, render_memory = render
+            wat_mesh, stages = convert_by_stage(tsdf, mesh, Rs, depthmaps)
+            stages["render"] = {
+                "seconds": render_seconds, "memory": render_memory
+            }
+            config_results.append({
+                "path": path,
+                "stages": stages,
+                "seconds": sum(s["seconds"] for s in stages.values()),
+                "memory": max(s["memory"] for s in stages.values()),
+                "chamfer": chamfer_distance(mesh, wat_mesh, n_points),
+                "iou": volumetric_iou(mesh, wat_mesh, points),
+                "watertight": is_watertight(wat_mesh.faces),
+            })
+    return results
+
+
+def summarize(results):
+    """Average the measurements of a configuration over the meshes."""
+    summary = {
+        k: float(np.mean([r[k] for r in results]))
+        for k in ["seconds", "chamfer", "iou", "watertight"]
+    }
+    summary["memory"] = float(max(r["memory"] for r in results))
+    for stage in STAGES:
+        summary[stage + "_seconds"] = float(
+            np.mean([r["stages"][stage]["seconds"] for r in results])
+        )
+    return summary
+
+
+def pareto_front(summaries):
+    """Return the indices of the summaries that are not dominated, i.e. no
+    other one is at least as fast, as lean, as close and as watertight and
+    strictly better in one of these."""
+    # Smaller is better for all the objectives
+    objectives = np.array([
+        [s["seconds"], s["memory"], s["chamfer"], -s["iou"], -s["watertight"]]
+        for s in summaries
+    ])
+    front = []
+    for i, o in enumerate(objectives):
+        dominated = np.any(
+            np.all(objectives <= o, axis=1) & np.any(objectives < o, axis=1)
+        )
+        if not dominated:
+            front.append(i)
+    return front
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Sweep the parameters of TSDF fusion on a dataset"
+    )
+    parser.add_argument(
+        "dataset_directory",
+        help="Path to the directory containing the dataset"
+    )
+    parser.add_argument(
+        "--dataset_type",
+        default="shapenet_v1",
+        choices=[
+            "shapenet_v1",
+            "dynamic_faust",
+            "freihand",
+            "3d_future",
+            "deforming_things_4d"
+        ],
+        help="The type of the dataset type to be used",
+    )
+    parser.add_argument(
+        "--model_tags",
+        type=lambda x: x.split(","),
+        default=[],
+        help="Tags to the models to be used",
+    )
+    parser.add_argument(
+        "--category_tags",
+        type=lambda x: x.split(","),
+        default=[],
+        help="Category tags to the models to be used",
+    )
+    parser.add_argument(
+        "--n_samples",
+        type=int,
+        default=20,
+        help="Number of meshes sampled from the dataset"
+    )
+    parser.add_argument(
+        "--search",
+        default="grid",
+        choices=["grid", "random"],
+        help="Evaluate every combination or n_trials random ones"
+    )
+    parser.add_argument(
+        "--n_trials",
+        type=int,
+        default=10,
+        help="Number of configurations evaluated by the random search"
+    )
+    parser.add_argument(
+        "--n_views",
+        type=lambda x: list(map(int, x.split(","))),
+        default="50,100",
+        help="Comma separated list of the numbers of views"
+    )
+    parser.add_argument(
+        "--image_sizes",
+        type=lambda x: list(map(int, x.split(","))),
+        default="320,640",
+        help=("Comma separated list of the sizes of the square depth images, "
+              "the focal length is scaled with the size")
+    )
+    parser.add_argument(
+        "--resolutions",
+        type=lambda x: list(map(int, x.split(","))),
+        default="128,256",
+        help="Comma separated list of the resolutions of the fusion"
+    )
+    parser.add_argument(
+        "--truncation_factors",
+        type=lambda x: list(map(int, x.split(","))),
+        default="5,15",
+        help="Comma separated list of truncation factors"
+    )
+    parser.add_argument(
+        "--depth_offset_factors",
+        type=lambda x: list(map(float, x.split(","))),
+        default="1.0,1.5",
+        help="Comma separated list of depth offset factors"
+    )
+    parser.add_argument(
+        "--n_points",
+        type=int,
+        default=100000,
+        help="Number of points used for the Chamfer distance and the IoU"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for sampling the meshes, the configurations and the points"
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Store the measurements and the Pareto front in this JSON file"
+    )
+    args = parser.parse_args(argv)
+    # Disable trimesh's logger
+    logging.getLogger("trimesh").setLevel(logging.ERROR)
+
+    dataset = (
+        ModelCollectionBuilder()
+        .with_dataset(args.dataset_type)
+        .filter_category_tags(args.category_tags)
+        .filter_tags(args.model_tags)
+        .build(args.dataset_directory)
+    )
+    paths = sorted(sample.path_to_mesh_file for sample in dataset)
+    rng = np.random.default_rng(args.seed)
+    if args.n_samples < len(paths):
+        paths = sorted(rng.choice(paths, args.n_samples, replace=False))
+
+    configs = configurations(
+        {
+            "n_views": args.n_views,
+            "image_size": args.image_sizes,
+            "resolution": args.resolutions,
+            "truncation_factor": args.truncation_factors,
+            "depth_offset_factor": args.depth_offset_factors,
+        },
+        args.search,
+        args.n_trials,
+        args.seed
+    )
+    print(f"Evaluating {len(configs)} configurations on {len(paths)} meshes")
+    results = evaluate(paths, configs, args.n_points, args.seed)
+    summaries = [summarize(r) for r in results]
+    front = pareto_front(summaries)
+
+    print(
+        "  {:>5} {:>5} {:>5} {:>5} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} "
+        "{:>9} {:>6} {:>10}".format(
+            "views", "image", "res", "trunc", "offset", "render", "fusion",
+            "mc", "time (s)", "mem (MB)", "chamfer", "iou", "watertight"
+        )
+    )
+    for i, (config, s) in enumerate(zip(configs, summaries)):
+        print(
+            "{} {:5d} {:5d} {:5d} {:5d} {:6.2f} {:8.2f} {:8.2f} {:8.2f} "
+            "{:8.2f} {:8.0f} {:9.5f} {:6.3f} {:9.0f}%".format(
+                "*" if i in front else " ",
+                config["n_views"],
+                config["image_size"],
+                config["resolution"],
+                config["truncation_factor"],
+                config["depth_offset_factor"],
+                s["render_seconds"],
+                s["fusion_seconds"],
+                s["marching_cubes_seconds"],
+                s["seconds"],
+                s["memory"] / 1024**2,
+                s["chamfer"],
+                s["iou"],
+                100 * s["watertight"]
+            )
+        )
+    print("* marks the configurations on the Pareto front")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "configurations": [
+                        {"parameters": c, "summary": s, "meshes": r}
+                        for c, s, r in zip(configs, summaries, results)
+                    ],
+                    "pareto_front": front,
+                },
+                f,
+                indent=1,
+                default=float
+            )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,14 +3,147 @@ import os
 import numpy as np
 import pymeshlab
 import trimesh
+from simple_3dviz import Mesh
 from watertight_transformer.base import WatertightTransformerFactory
-from watertight_transformer.datasets.model_collections import Mesh
+from watertight_transformer.chunked_mesh import ChunkedMesh
+from watertight_transformer.watertightness import check_watertightness
+
+from metrics import METRICS
 
 
 def ensure_parent_directory_exists(filepath):
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
 
+def simplify_mesh(ms: pymeshlab.MeshSet, num_faces: int):
+    # Simplify the current mesh of the MeshSet in place
+    ms.meshing_decimation_quadric_edge_collapse(
+        targetfacenum=num_faces,
+        qualitythr=0.5,
+        preservenormal=True,
+        planarquadric=True,
+        preservetopology=True,
+        autoclean=False,  # very important for watertightness preservation
+    )
+
+
+def multires_path(path_to_file, resolution):
+    # e.g. model_watertight.obj -> model_watertight_128.obj
+    stem, ext = os.path.splitext(path_to_file)
+    return f"{stem}_{resolution}{ext}"
+
+
+def save_simplified_mesh(wat_mesh, path_to_file, num_faces):
+    # Hand the watertight mesh to pymeshlab directly from memory
+    ms = pymeshlab.MeshSet()
+    ms.add_mesh(pymeshlab.Mesh(
+        vertex_matrix=np.asarray(wat_mesh.vertices, dtype=np.float64),
+        face_matrix=np.asarray(wat_mesh.faces, dtype=np.int32)
+    ))
+    simplify_mesh(ms, num_faces)
+    ms.save_current_mesh(path_to_file)
+
+
+def output_paths(path_to_file, resolutions=None):
+    # One output file per resolution, see multires_path()
+    if resolutions is None:
+        return [path_to_file]
+    return [multires_path(path_to_file, r) for r in resolutions]
+
+
+def normalize_mesh(mesh: Mesh, bbox: list = None, unit_cube: bool = False):
+    """Rescale the mesh and return it as a trimesh.Trimesh object. A
+    ChunkedMesh is rescaled in place and returned as is."""
+    if isinstance(mesh, ChunkedMesh):
+        if bbox is not None:
+            mesh.fit_to_bbox(bbox[:3], bbox[3:])
+        elif unit_cube:
+            mesh.to_unit_cube()
+        return mesh
+    if bbox is not None:
+        # Scale the mesh to range specified from the input bounding box
+        bbox_min = np.array(bbox[:3])
+        bbox_max = np.array(bbox[3:])
+        dims = bbox_max - bbox_min
+        mesh._vertices -= dims / 2 + bbox_min
+        mesh._vertices /= dims.max()
+    else:
+        if unit_cube:
+            # Scale the mesh to range [-0.5,0.5]^3
+            # This is needed for TSDF Fusion!
+            mesh.to_unit_cube()
+    # Extract the points and the faces from the mesh
+    points, faces = mesh.to_points_and_faces()
+
+    return trimesh.Trimesh(vertices=points, faces=faces)
+
+
+def chamfer_distance(mesh, other, n_points):
+    """The symmetric Chamfer-L1 distance of points sampled on both meshes."""
+    from scipy.spatial import cKDTree
+
+    points, _ = trimesh.sample.sample_surface(mesh, n_points)
+    other_points, _ = trimesh.sample.sample_surface(other, n_points)
+    d1, _ = cKDTree(other_points).query(points)
+    d2, _ = cKDTree(points).query(other_points)
+    return 0.5 * (d1.mean() + d2.mean())
+
+
+def volumetric_iou(mesh, other, points):
+    """The volumetric IoU of two meshes, estimated from the points."""
+    from watertight_transformer.external.libmesh import MeshIntersector
+
+    inside = MeshIntersector(mesh).query(points)
+    other_inside = MeshIntersector(other).query(points)
+    union = (inside | other_inside).sum()
+    return (inside & other_inside).sum() / max(union, 1)
+
+
+def target_num_faces(
+    n_faces: int,
+    num_target_faces: int = None,
+    ratio_target_faces: float = None
+):
+    if num_target_faces:
+        return num_target_faces
+    return int(ratio_target_faces * n_faces)
+
+
+def convert_mesh(
+    tr_mesh: trimesh.Trimesh,
+    wat_transformer: WatertightTransformerFactory,
+    file_type: str = "off",
+    resolutions: list = None,
+):
+    """Return the list of watertight meshes, one per resolution, in memory.
+    """
+    if resolutions is None:
+        return [wat_transformer.to_watertight(tr_mesh, file_type=file_type)]
+    return wat_transformer.to_watertight_multires(
+        tr_mesh, resolutions, file_type=file_type
+    )
+
+
+def export_watertight(
+    wat_meshes: list,
+    paths_to_files: list,
+    num_faces: int = None,
+    check_watertight: bool = False,
+):
+    """Export the watertight meshes, simplified to num_faces faces if it is
+    provided, and optionally return their watertightness verdicts."""
+    for wat_mesh, path_to_file in zip(wat_meshes, paths_to_files):
+        ensure_parent_directory_exists(path_to_file)
+        if num_faces is None:
+            wat_mesh.export(path_to_file, path_to_file.split(".")[-1])
+        else:
+            save_simplified_mesh(wat_mesh, path_to_file, num_faces)
+
+    # Check the exported meshes while they are still hot in the page cache
+    if check_watertight:
+        return [check_watertightness(p) for p in paths_to_files]
+
+
 def mesh_to_watertight(
     mesh: Mesh,
     wat_transformer: WatertightTransformerFactory,
@@ -20,9 +153,12 @@ def mesh_to_watertight(
     simplify: bool = False,
     num_target_faces: int = None,
     ratio_target_faces: float = None,
+    check_watertight: bool = False,
+    resolutions: list = None,
 ):
+    paths_to_files = output_paths(path_to_file, resolutions)
     # Check optimistically if the file already exists
-    if os.path.exists(path_to_file):
+    if all(os.path.exists(p) for p in paths_to_files):
         return
     ensure_parent_directory_exists(path_to_file)
     # Extract the file type from the output file
@@ -30,22 +166,7 @@ def mesh_to_watertight(
     if file_type not in ["off", "obj"]:
         raise Exception(f"The {file_type} is not a valid mesh extension")
 
-    if bbox is not None:
-        # Scale the mesh to range specified from the input bounding box
-        bbox_min = np.array(bbox[:3])
-        bbox_max = np.array(bbox[3:])
-        dims = bbox_max - bbox_min
-        mesh._vertices -= dims / 2 + bbox_min
-        mesh._vertices /= dims.max()
-    else:
-        if unit_cube:
-            # Scale the mesh to range [-0.5,0.5]^3
-            # This is needed for TSDF Fusion!
-            mesh.to_unit_cube()
-    # Extract the points and the faces from the mesh
-    points, faces = mesh.to_points_and_faces()
-
-    tr_mesh = trimesh.Trimesh(vertices=points, faces=faces)
+    tr_mesh = normalize_mesh(mesh, bbox, unit_cube)
     # Check if the mesh is indeed non-watertight before making the
     # conversion
     #if tr_mesh.is_watertight:
@@ -53,24 +174,31 @@ def mesh_to_watertight(
     #    # tr_mesh.export(path_to_file, file_type=file_type)
     #else:
     # Make the mesh watertight with TSDF Fusion or ManifoldPlus
-    wat_transformer.to_watertight(
-        tr_mesh, path_to_file, file_type=file_type
-    )
-
-    if simplify:
-        if num_target_faces:
-            num_faces = num_target_faces
+    with METRICS.time("convert", count_subprocesses=True):
+        if not simplify:
+            if resolutions is None:
+                wat_transformer.to_watertight(
+                    tr_mesh, path_to_file, file_type=file_type
+                )
+            else:
+                # Render once and fuse at every resolution
+                wat_transformer.to_watertight_multires(
+                    tr_mesh, resolutions, paths_to_files, file_type=file_type
+                )
         else:
-            num_faces = int(ratio_target_faces * len(faces))
-        # Call the meshlabserver to simplify the mesh
-        ms = pymeshlab.MeshSet()
-        ms.load_new_mesh(path_to_file)
-        ms.meshing_decimation_quadric_edge_collapse(
-            targetfacenum=num_faces,
-            qualitythr=0.5,
-            preservenormal=True,
-            planarquadric=True,
-            preservetopology=True,
-            autoclean=False,  # very important for watertightness preservation
-        )
-        ms.save_current_mesh(path_to_file)
+            num_faces = target_num_faces(
+                len(tr_mesh.faces), num_target_faces, ratio_target_faces
+            )
+            export_watertight(
+                convert_mesh(
+                    tr_mesh, wat_transformer, file_type, resolutions
+                ),
+                paths_to_files,
+                num_faces
+            )
+
+    # Check the exported meshes while they are still hot in the page cache
+    if check_watertight:
+        with METRICS.time("check"):
+            verdicts = [check_watertightness(p) for p in paths_to_files]
+        return verdicts[0] if resolutions is None else verdicts
@@ -59,7 +59,9 @@ def get_extensions():
             "watertight_transformer.external.libmesh.triangle_hash",
             sources=["watertight_transformer/external/libmesh/triangle_hash.pyx"],
             include_dirs=[np.get_include()],
-            libraries=["m"]  # Unix-like specific
+            libraries=["m"],  # Unix-like specific
+            extra_compile_args=["-fopenmp"],
+            extra_link_args=["-fopenmp"]
         ),
         Extension(
             "watertight_transformer.external.librender.pyrender",
@@ -89,7 +91,8 @@ def get_extensions():
             "watertight_transformer.external.libfusioncpu.cyfusion",
             sources=[
                 "watertight_transformer/external/libfusioncpu/cyfusion.pyx",
-                "watertight_transformer/external/libfusioncpu/fusion.cpp"
+                "watertight_transformer/external/libfusioncpu/fusion.cpp",
+                "watertight_transformer/external/libfusioncpu/fusion_zach_tvl1.cpp"
             ],
             language="c++",
             libraries=["m"],
@@ -7,4 +7,6 @@ __email__ = "paschald@stanford.edu"
 __url__ = "https://paschalidoud.github.io/"
 __version__ = "0.1"
 
-from .base import WatertightTransformerFactory
+from .base import ConversionResult, WatertightTransformerFactory
+from .chunked_mesh import ChunkedMesh
+from .sdf_query import SDFVolume
@@ -1,13 +1,63 @@
-from tempfile import NamedTemporaryFile
+import os
 
-from .manifoldplus import ManifoldPlus
-from .tsdf_fusion import TSDFFusion
+# The backends are imported when the factory creates them, so that importing
+# the package stays cheap, e.g. for the worker processes
+
+
+class ConversionResult:
+    """The outcome of converting one mesh with to_watertight_many().
+
+    Arguments:
+    ----------
+        index: The position of the mesh in the input
+        mesh: The watertight trimesh.Trimesh, or the list of meshes for
+              several resolutions, None if the conversion failed
+        error: The exception raised by the conversion, None on success
+    """
+    def __init__(self, index, mesh=None, error=None):
+        self.index = index
+        self.mesh = mesh
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = "ok" if self.ok else repr(self.error)
+        return f"ConversionResult(index={self.index}, {status})"
+
+
+# The transformer of a worker process of to_watertight_many(), sent once
+# when the process starts instead of with every mesh
+_worker_transformer = None
+
+
+def _init_worker(wat_transformer):
+    global _worker_transformer
+    _worker_transformer = wat_transformer
+
+
+def _convert(wat_transformer, mesh, file_type, resolutions):
+    if resolutions is not None:
+        return wat_transformer.to_watertight_multires(
+            mesh, resolutions, file_type=file_type
+        )
+    return wat_transformer.to_watertight(mesh, file_type=file_type)
+
+
+def _convert_in_worker(mesh, file_type, resolutions):
+    return _convert(_worker_transformer, mesh, file_type, resolutions)
 
 
 class WatertightTransformerFactory:
     """
     Arguments:
     ----------
+        name: The watertight method, tsdf_fusion, manifoldplus or
+              visual_hull. visual_hull is a fast approximate TSDFFusion
+              that carves the voxels seen as free by fewer, smaller depth
+              maps, see visual_hull_views and visual_hull_image_scale
         image_height: Image height of depth map generated during TSDFFusion
         image_width: Image width of depth map generated during TSDFFusion
         focal_length_x: The focal length along the x-axis for TSDFFusion
@@ -20,9 +70,32 @@ class WatertightTransformerFactory:
         depth_offset_factor: The depth maps are offsetted using 
                              depth_offset_factor*voxel_size in TSDFFusion
         n_views: The number of views used in TSDFFusion
+        fusion_method: tsdf or zach_tvl1, the fusion used in TSDFFusion.
+                       It is ignored by visual_hull, which always uses the
+                       visual_hull fusion of TSDFFusion
+        n_bins: The number of histogram bins for the zach_tvl1 fusion
+        tvl1_lambda: The weight of the data term for the zach_tvl1 fusion
+        tvl1_iterations: The maximum number of iterations for the zach_tvl1
+                         fusion
+        tvl1_tolerance: The convergence tolerance for the zach_tvl1 fusion
+        hist_dtype: float32, uint16, uint8 or sparse, the type of the
+                    histogram of the zach_tvl1 fusion
+        adaptive_grid: Only fuse the bounding box of the mesh in TSDFFusion
+        cache_dir: Optionally a directory to cache the intermediate results
+                   of TSDFFusion in, see StageCache
+        cache_size_gb: The maximum size of the cache in GB
+        render_chunk_size: Render the meshes in batches of this many faces
+                           in TSDFFusion, see ChunkedMesh
+        visual_hull_views: The number of views used by visual_hull instead
+                           of n_views
+        visual_hull_image_scale: The depth maps of visual_hull are rendered
+                                 with the image size, the focal length and the
+                                 principal point scaled by this factor
         manifold_plus_script: Path to the binary file to be used to perform the
                               Manifold algorithm
         depth: Number of depth values used in the Manifold algorithm 
+        manifoldplus_timeout: Seconds after which a ManifoldPlus call is
+                              killed
     """
     def __init__(
         self,
@@ -37,8 +110,21 @@ class WatertightTransformerFactory:
         truncation_factor=15,
         n_views=100,
         depth_offset_factor=1.5,
+        fusion_method="tsdf",
+        n_bins=10,
+        tvl1_lambda=1.0,
+        tvl1_iterations=500,
+        tvl1_tolerance=1e-4,
+        hist_dtype="float32",
+        adaptive_grid=False,
+        cache_dir=None,
+        cache_size_gb=None,
+        render_chunk_size=None,
+        visual_hull_views=20,
+        visual_hull_image_scale=0.5,
         manifoldplus_script=None,
         depth=10,
+        manifoldplus_timeout=None,
     ):
         self.name = name
         if self.name == "manifoldplus":
@@ -47,11 +133,26 @@ class WatertightTransformerFactory:
                 raise Exception(
                     "Cannot run ManifoldPlus without specifying a script"
                 )
+            from .manifoldplus import ManifoldPlus
             self.wat_transformer = ManifoldPlus(
                 manifoldplus_script=manifoldplus_script,
-                depth=depth
+                depth=depth,
+                timeout=manifoldplus_timeout
             )
-        elif self.name == "tsdf_fusion":
+        elif self.name in ["tsdf_fusion", "visual_hull"]:
+            from .stage_cache import StageCache
+            from .tsdf_fusion import TSDFFusion
+            if self.name == "visual_hull":
+                # Fewer and smaller depth maps suffice to carve a coarse shell
+                s = visual_hull_image_scale
+                image_height = int(round(image_height * s))
+                image_width = int(round(image_width * s))
+                focal_length_x, focal_length_y = \
+                    focal_length_x * s, focal_length_y * s
+                principal_point_x, principal_point_y = \
+                    principal_point_x * s, principal_point_y * s
+                n_views = visual_hull_views
+                fusion_method = "visual_hull"
             self.wat_transformer = TSDFFusion(
                 image_height=image_height,
                 image_width=image_width,
@@ -62,23 +163,272 @@ class WatertightTransformerFactory:
                 resolution=resolution,
                 truncation_factor=truncation_factor,
                 n_views=n_views,
-                depth_offset_factor=depth_offset_factor
+                depth_offset_factor=depth_offset_factor,
+                fusion_method=fusion_method,
+                n_bins=n_bins,
+                tvl1_lambda=tvl1_lambda,
+                tvl1_iterations=tvl1_iterations,
+                tvl1_tolerance=tvl1_tolerance,
+                hist_dtype=hist_dtype,
+                adaptive_grid=adaptive_grid,
+                cache=(
+                    StageCache(cache_dir, cache_size_gb)
+                    if cache_dir is not None else None
+                ),
+                render_chunk_size=render_chunk_size
             )
         else:
             raise NotImplementedError()
 
-    
-    def to_watertight(self, mesh, path_to_watertight, file_type="off"):
+
+    def to_watertight(self, mesh, path_to_watertight=None, file_type="off"):
+        """Convert the mesh to a watertight mesh.
+
+        The watertight mesh is stored in path_to_watertight, if provided, and
+        it is also returned as a trimesh.Trimesh object so that it can be
+        further processed without reloading it.
+        """
         if self.name == "manifoldplus":
-            # Create a temporary file and store the mesh
-            path_to_mesh = NamedTemporaryFile().name + file_type
-            mesh.export(path_to_mesh, file_type=file_type)
-            self.wat_transformer.to_watertight(
-                path_to_mesh, path_to_watertight, file_type
+            return self.wat_transformer.mesh_to_watertight(
+                mesh, path_to_watertight, file_type
             )
-        elif self.name == "tsdf_fusion":
-            self.wat_transformer.to_watertight(
+        elif self.name in ["tsdf_fusion", "visual_hull"]:
+            return self.wat_transformer.to_watertight(
                 mesh, path_to_watertight, file_type
             )
         else:
             raise NotImplementedError()
+
+    def to_sdf_volume(self, mesh, resolution=None):
+        """Fuse the mesh and return an SDFVolume to query the signed distances
+        at arbitrary points. Only supported by TSDF fusion and the visual
+        hull.
+        """
+        if self.name not in ["tsdf_fusion", "visual_hull"]:
+            raise NotImplementedError(
+                "Signed distance queries are only supported by tsdf_fusion "
+                "and visual_hull"
+            )
+        return self.wat_transformer.to_sdf_volume(mesh, resolution)
+
+    def estimate_peak_memory(self, n_faces, resolutions=None):
+        """Estimate the peak memory in bytes of converting a mesh with
+        n_faces faces, optionally at several resolutions."""
+        return self.wat_transformer.estimate_peak_memory(n_faces, resolutions)
+
+    def to_watertight_multires(
+        self,
+        mesh,
+        resolutions,
+        paths_to_watertight=None,
+        file_type="off"
+    ):
+        """Convert the mesh to a watertight mesh at several resolutions,
+        rendering it only once. Only supported by TSDF fusion and the visual
+        hull.
+        """
+        if self.name not in ["tsdf_fusion", "visual_hull"]:
+            raise NotImplementedError(
+                "Multiple resolutions are only supported by tsdf_fusion and "
+                "visual_hull"
+            )
+        return self.wat_transformer.to_watertight_multires(
+            mesh, resolutions, paths_to_watertight, file_type
+        )
+
+    def to_watertight_sequence(
+        self,
+        meshes,
+        output_paths=None,
+        file_type="off",
+        incremental=False,
+        keyframe_interval=10,
+        tolerance_factor=0,
+    ):
+        """Convert the frames of a sequence, which share their faces, and
+        yield the watertight meshes in the same order. TSDF fusion and the
+        visual hull keep the renderer and the views across the frames, see
+        TSDFFusion.to_watertight_sequence(), ManifoldPlus converts every frame
+        independently.
+        """
+        if self.name in ["tsdf_fusion", "visual_hull"]:
+            yield from self.wat_transformer.to_watertight_sequence(
+                meshes,
+                output_paths,
+                file_type,
+                incremental=incremental,
+                keyframe_interval=keyframe_interval,
+                tolerance_factor=tolerance_factor
+            )
+            return
+        for i, mesh in enumerate(meshes):
+            yield self.to_watertight(
+                mesh,
+                None if output_paths is None else output_paths[i],
+                file_type
+            )
+
+    def to_watertight_many(
+        self,
+        meshes,
+        ordered=True,
+        num_workers=None,
+        max_in_flight=None,
+        resolutions=None,
+        file_type="off",
+        mp_context=None,
+    ):
+        """Convert many meshes in parallel and yield a ConversionResult for
+        every mesh as soon as it is available.
+
+        The meshes are taken lazily from the iterable, thus it can be a
+        generator, e.g. a data loader. The watertight meshes are only kept in
+        memory. A mesh that fails to convert, or whose worker process dies,
+        yields a result with the error instead of stopping the rest. The
+        other meshes in flight when a worker dies are converted again one at
+        a time, thus only the meshes that crash on their own yield an error.
+
+        Arguments:
+        ----------
+            meshes: An iterable of trimesh.Trimesh objects
+            ordered: If True, the results are yielded in the order of the
+                     meshes, otherwise in the order they finish
+            num_workers: The number of worker processes, by default the
+                         number of CPUs. With 0 the meshes are converted in
+                         the calling process
+            max_in_flight: The maximum number of meshes that are taken from
+                           the iterable but not yielded yet, by default
+                           2*num_workers
+            resolutions: Optionally a list of resolutions to convert every
+                         mesh at, see to_watertight_multires()
+            file_type: The file type used to stage the meshes
+            mp_context: The multiprocessing context of the workers, by default
+                        forkserver. Forking the calling process directly can
+                        deadlock the OpenMP fusion in the workers, if the
+                        calling process has already used OpenMP
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        if num_workers == 0:
+            for i, mesh in enumerate(meshes):
+                try:
+                    result = ConversionResult(
+                        i, _convert(self, mesh, file_type, resolutions)
+                    )
+                except Exception as e:
+                    result = ConversionResult(i, error=e)
+                yield result
+            return
+
+        import multiprocessing
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, \
+            wait
+        from concurrent.futures.process import BrokenProcessPool
+
+        max_in_flight = max(max_in_flight or 2 * num_workers, 1)
+        if mp_context is None:
+            mp_context = multiprocessing.get_context(
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            )
+        meshes = enumerate(meshes)
+        new_pool = lambda: ProcessPoolExecutor(
+            num_workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(self,)
+        )
+        pool = new_pool()
+        in_flight = {}
+        # The finished results waiting for an earlier one in ordered mode
+        finished = {}
+        next_index = 0
+        exhausted = False
+        # Set when every mesh was yielded, otherwise the consumer stopped
+        # early and the running conversions are not waited for
+        completed = False
+
+        def recover(pool):
+            # A worker died, e.g. it ran out of memory, and took every
+            # conversion in flight down with it. Rerun them one at a time in
+            # a fresh pool, so that only the meshes that crash on their own
+            # yield an error
+            wait(in_flight)
+            suspects = []
+            for future, (i, mesh) in list(in_flight.items()):
+                if isinstance(future.exception(), BrokenProcessPool):
+                    suspects.append((i, mesh, future.exception()))
+                    del in_flight[future]
+            pool.shutdown(wait=False)
+            pool = new_pool()
+            if len(suspects) == 1:
+                i, _, error = suspects[0]
+                finished[i] = ConversionResult(i, error=error)
+                return pool
+            for i, mesh, _ in suspects:
+                future = pool.submit(
+                    _convert_in_worker, mesh, file_type, resolutions
+                )
+                try:
+                    finished[i] = ConversionResult(i, future.result())
+                except BrokenProcessPool as e:
+                    finished[i] = ConversionResult(i, error=e)
+                    pool.shutdown(wait=False)
+                    pool = new_pool()
+                except Exception as e:
+                    finished[i] = ConversionResult(i, error=e)
+            return pool
+
+        try:
+            while True:
+                # Completed results that are not yielded yet also count
+                while not exhausted and \
+                        len(in_flight) + len(finished) < max_in_flight:
+                    entry = next(meshes, None)
+                    if entry is None:
+                        exhausted = True
+                        break
+                    i, mesh = entry
+                    try:
+                        future = pool.submit(
+                            _convert_in_worker, mesh, file_type, resolutions
+                        )
+                    except BrokenProcessPool:
+                        pool = recover(pool)
+                        future = pool.submit(
+                            _convert_in_worker, mesh, file_type, resolutions
+                        )
+                    in_flight[future] = (i, mesh)
+
+                if len(in_flight) == 0 and len(finished) == 0:
+                    completed = True
+                    return
+
+                if len(in_flight) > 0:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    if any(
+                        isinstance(future.exception(), BrokenProcessPool)
+                        for future in done
+                    ):
+                        pool = recover(pool)
+                    for future in done & in_flight.keys():
+                        i, _ = in_flight.pop(future)
+                        try:
+                            finished[i] = ConversionResult(i, future.result())
+                        except Exception as e:
+                            finished[i] = ConversionResult(i, error=e)
+
+                if ordered:
+                    while next_index in finished:
+                        yield finished.pop(next_index)
+                        next_index += 1
+                else:
+                    for i in list(finished):
+                        yield finished.pop(i)
+        finally:
+            # Executor.shutdown() only accepts cancel_futures from Python 3.9
+            for future in in_flight:
+                future.cancel()
+            pool.shutdown(wait=completed)
+
@@ -0,0 +1,239 @@
+import os
+
+import numpy as np
+
+VERTICES_FILE = "vertices.bin"
+FACES_FILE = "faces.bin"
+CHUNKS_FILE = "chunks.npy"
+
+# The number of vertices that are rescaled at once or lines that are parsed
+# at once
+BLOCK_SIZE = 1 << 20
+
+
+def _parse_block(vertex_lines, face_lists, vertex_file, face_file):
+    if len(vertex_lines) > 0:
+        np.array(
+            [l.split()[:3] for l in vertex_lines], dtype=np.float32
+        ).tofile(vertex_file)
+    if len(face_lists) > 0:
+        np.array(face_lists, dtype=np.uint32).tofile(face_file)
+
+
+def _map(path, dtype):
+    # Files without rows cannot be memory-mapped
+    if os.path.getsize(path) == 0:
+        return np.zeros((0, 3), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r").reshape(-1, 3)
+
+
+def _triangulate(indices):
+    # Split the polygons into a fan of triangles
+    return [
+        (indices[0], indices[k], indices[k + 1])
+        for k in range(1, len(indices) - 1)
+    ]
+
+
+def _stream_obj(f, vertex_file, face_file):
+    n_vertices = 0
+    vertex_lines, face_lists = [], []
+    for line in f:
+        if line.startswith("v "):
+            vertex_lines.append(line[2:])
+            n_vertices += 1
+        elif line.startswith("f "):
+            indices = []
+            for token in line.split()[1:]:
+                i = int(token.split("/")[0])
+                # The negative indices are relative to the last vertex
+                indices.append(i - 1 if i > 0 else n_vertices + i)
+            face_lists.extend(_triangulate(indices))
+        else:
+            continue
+        if len(vertex_lines) + len(face_lists) >= BLOCK_SIZE:
+            _parse_block(vertex_lines, face_lists, vertex_file, face_file)
+            vertex_lines, face_lists = [], []
+    _parse_block(vertex_lines, face_lists, vertex_file, face_file)
+
+
+def _stream_off(f, vertex_file, face_file):
+    def lines():
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                yield line
+
+    lines = lines()
+    header = next(lines)
+    if not header.startswith("OFF"):
+        raise ValueError(f"Expected an OFF header, got {header[:20]}")
+    counts = header[3:].split() or next(lines).split()
+    n_vertices, n_faces = int(counts[0]), int(counts[1])
+
+    vertex_lines = []
+    for _ in range(n_vertices):
+        vertex_lines.append(next(lines))
+        if len(vertex_lines) >= BLOCK_SIZE:
+            _parse_block(vertex_lines, [], vertex_file, face_file)
+            vertex_lines = []
+    _parse_block(vertex_lines, [], vertex_file, face_file)
+
+    face_lists = []
+    for _ in range(n_faces):
+        values = next(lines).split()
+        face_lists.extend(
+            _triangulate([int(v) for v in values[1:1 + int(values[0])]])
+        )
+        if len(face_lists) >= BLOCK_SIZE:
+            _parse_block([], face_lists, vertex_file, face_file)
+            face_lists = []
+    _parse_block([], face_lists, vertex_file, face_file)
+
+
+class ChunkedMesh:
+    """A triangle mesh that is stored on disk in batches of a bounded number
+    of faces and memory-mapped, thus it is never loaded in memory at once.
+
+    Every batch stores the vertices that its faces use, so that it can be
+    rendered on its own, see TSDFFusion.render_raw(), and the vertices that
+    are shared by several batches are stored once per batch. The .vertices and
+    the .faces of all the batches together are still a valid mesh, which can
+    be passed wherever TSDFFusion expects a mesh.
+
+    Arguments:
+    ----------
+        directory: The directory written by from_arrays() or from_file()
+        mode: "r" to map the mesh read-only or "r+" to rescale it in place
+    """
+    def __init__(self, directory, mode="r"):
+        self.directory = directory
+        self.mode = mode
+        # The offsets of the vertices and the faces of every batch
+        self.offsets = np.load(os.path.join(directory, CHUNKS_FILE))
+        n_vertices, n_faces = self.offsets[-1]
+        self.vertices = np.memmap(
+            os.path.join(directory, VERTICES_FILE),
+            dtype=np.float32,
+            mode=mode,
+            shape=(n_vertices, 3)
+        )
+        self.faces = np.memmap(
+            os.path.join(directory, FACES_FILE),
+            dtype=np.uint32,
+            mode="r",
+            shape=(n_faces, 3)
+        )
+
+    @property
+    def n_chunks(self):
+        return len(self.offsets) - 1
+
+    def chunk(self, i):
+        """Return the vertices and the faces of the i-th batch, the faces
+        index the returned vertices."""
+        (v_start, f_start), (v_end, f_end) = self.offsets[i:i + 2]
+        return (
+            self.vertices[v_start:v_end],
+            self.faces[f_start:f_end] - np.uint32(v_start)
+        )
+
+    def chunks(self, reverse=False):
+        """Iterate over the batches, optionally in reverse order."""
+        order = range(self.n_chunks)
+        for i in (reversed(order) if reverse else order):
+            yield self.chunk(i)
+
+    @property
+    def bbox(self):
+        bbox_min = np.full(3, np.inf)
+        bbox_max = np.full(3, -np.inf)
+        for start in range(0, len(self.vertices), BLOCK_SIZE):
+            block = self.vertices[start:start + BLOCK_SIZE]
+            bbox_min = np.minimum(bbox_min, block.min(axis=0))
+            bbox_max = np.maximum(bbox_max, block.max(axis=0))
+        return bbox_min, bbox_max
+
+    def fit_to_bbox(self, bbox_min, bbox_max):
+        """Rescale the vertices in place, such that the box from bbox_min to
+        bbox_max is mapped to the 0 centered unit cube."""
+        if self.mode == "r":
+            raise ValueError("The mesh is mapped read-only")
+        bbox_min = np.asarray(bbox_min, dtype=np.float64)
+        dims = np.asarray(bbox_max, dtype=np.float64) - bbox_min
+        for start in range(0, len(self.vertices), BLOCK_SIZE):
+            block = self.vertices[start:start + BLOCK_SIZE]
+            block[...] = (block - (dims / 2 + bbox_min)) / dims.max()
+        self.vertices.flush()
+
+    def to_unit_cube(self):
+        """Rescale the mesh in place to fit the 0 centered unit cube."""
+        self.fit_to_bbox(*self.bbox)
+
+    @classmethod
+    def from_arrays(
+        cls, vertices, faces, directory, chunk_size=1000000, mode="r"
+    ):
+        """Split the mesh into batches of chunk_size faces, store them in the
+        directory and return them memory-mapped.
+
+        Arguments:
+        ----------
+            vertices: np.array of shape (N, 3), e.g. an np.memmap
+            faces: np.array of shape (M, 3) with 0-based vertex indices
+            directory: The directory to store the mesh in
+            chunk_size: The maximum number of faces of every batch
+            mode: The mode of the returned mesh, see ChunkedMesh
+        """
+        os.makedirs(directory, exist_ok=True)
+        offsets = [(0, 0)]
+        with open(os.path.join(directory, VERTICES_FILE), "wb") as fv, \
+                open(os.path.join(directory, FACES_FILE), "wb") as ff:
+            for start in range(0, len(faces), chunk_size):
+                chunk = np.asarray(faces[start:start + chunk_size])
+                used, local = np.unique(chunk.ravel(), return_inverse=True)
+                v_offset = offsets[-1][0]
+                np.asarray(vertices[used], dtype=np.float32).tofile(fv)
+                (local.reshape(-1, 3) + v_offset).astype(np.uint32).tofile(ff)
+                offsets.append((v_offset + len(used), start + len(chunk)))
+        if offsets[-1][0] >= 2**32:
+            raise ValueError("The mesh has too many vertices")
+        # The offsets are written last, thus they mark a complete mesh
+        np.save(
+            os.path.join(directory, CHUNKS_FILE),
+            np.array(offsets, dtype=np.int64)
+        )
+        return cls(directory, mode)
+
+    @classmethod
+    def from_file(cls, path, directory, chunk_size=1000000, mode="r"):
+        """Stream an .obj or an .off file into batches of chunk_size faces,
+        see from_arrays(). The polygons are split into triangles and only
+        the positions of the vertices are kept.
+        """
+        os.makedirs(directory, exist_ok=True)
+        raw_vertices_path = os.path.join(directory, "raw_vertices.bin")
+        raw_faces_path = os.path.join(directory, "raw_faces.bin")
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in [".obj", ".off"]:
+            raise ValueError(f"Cannot stream {ext} files")
+        try:
+            with open(path, "r") as f, \
+                    open(raw_vertices_path, "wb") as fv, \
+                    open(raw_faces_path, "wb") as ff:
+                if ext == ".obj":
+                    _stream_obj(f, fv, ff)
+                else:
+                    _stream_off(f, fv, ff)
+            mesh = cls.from_arrays(
+                _map(raw_vertices_path, np.float32),
+                _map(raw_faces_path, np.uint32),
+                directory,
+                chunk_size,
+                mode
+            )
+        finally:
+            for p in [raw_vertices_path, raw_faces_path]:
+                if os.path.exists(p):
+                    os.remove(p)
+        return mesh
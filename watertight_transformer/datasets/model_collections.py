@@ -1,3 +1,5 @@
+import hashlib
+import heapq
 import numpy as np
 try:
     from functools import lru_cache
@@ -5,9 +7,6 @@ except ImportError:
     from backports.functools_lru_cache import lru_cache
 from collections import OrderedDict
 import os
-from PIL import Image
-
-from simple_3dviz import Mesh
 
 
 class BaseModel(object):
@@ -43,6 +42,7 @@ class BaseModel(object):
     @property
     def groundtruth_mesh(self):
         if self._gt_mesh is None:
+            from simple_3dviz import Mesh
             self._gt_mesh = Mesh.from_file(self.path_to_mesh_file)
         return self._gt_mesh
 
@@ -63,6 +63,7 @@ class BaseModel(object):
         return self._image_paths
 
     def get_image(self, idx):
+        from PIL import Image
         return np.array(Image.open(self.image_paths[idx]).convert("RGB"))
 
 
@@ -104,12 +105,93 @@ class TagSubset(ModelSubset):
 
 
 class RandomSubset(ModelSubset):
-    def __init__(self, collection, percentage):
+    def __init__(self, collection, percentage, seed=None):
         N = len(collection)
-        subset = np.random.choice(N, int(N*percentage)).tolist()
+        # Fix the seed to select the same subset in several processes
+        rng = np.random.RandomState(seed)
+        subset = sorted(
+            rng.choice(N, int(N*percentage), replace=False).tolist()
+        )
         super(RandomSubset, self).__init__(collection, subset)
 
 
+def stable_hash(tag):
+    """A hash of the tag that is the same across processes and machines,
+    unlike hash()."""
+    return int(hashlib.md5(tag.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def assign_shards(tags, num_shards, costs=None):
+    """Assign every tag to one of num_shards shards.
+
+    Without costs a tag is assigned based on its stable hash. Otherwise the
+    tags are assigned greedily from the most to the least expensive one,
+    to the shard with the smallest total cost so far, which balances the
+    total cost of the shards. Ties are broken with the stable hash, thus every
+    process computes the same assignment for the same tags and costs.
+
+    Arguments:
+    ----------
+        tags: list of unique strings
+        num_shards: The number of shards
+        costs: Optionally a list with the estimated cost of every tag
+
+    Returns:
+    --------
+        A list with the shard index of every tag
+    """
+    hashes = [stable_hash(t) for t in tags]
+    if costs is None:
+        return [h % num_shards for h in hashes]
+
+    order = sorted(range(len(tags)), key=lambda i: (-costs[i], hashes[i]))
+    loads = [(0, s) for s in range(num_shards)]
+    shards = [0] * len(tags)
+    for i in order:
+        load, s = heapq.heappop(loads)
+        shards[i] = s
+        heapq.heappush(loads, (load + costs[i], s))
+    return shards
+
+
+def mesh_file_cost(model):
+    """Estimate the cost of converting a model by the size of its mesh file.
+    """
+    try:
+        return os.path.getsize(model.path_to_mesh_file)
+    except OSError:
+        return 0
+
+
+class ShardSubset(ModelSubset):
+    """Keep the models of a collection assigned to the shard shard_index out
+    of num_shards, see assign_shards(). If cost is provided, it is called
+    with every model to estimate its cost and balance the shards. If group is
+    provided, it is called with every model and the models with the same
+    result, e.g. the frames of a sequence, are assigned to the same shard
+    together with their total cost.
+    """
+    def __init__(
+        self, collection, shard_index, num_shards, cost=None, group=None
+    ):
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(
+                f"Invalid shard {shard_index} for {num_shards} shards"
+            )
+        models = list(collection)
+        keys = [m.tag if group is None else group(m) for m in models]
+        groups = sorted(set(keys))
+        costs = None
+        if cost is not None:
+            totals = dict.fromkeys(groups, 0)
+            for k, m in zip(keys, models):
+                totals[k] += cost(m)
+            costs = [totals[k] for k in groups]
+        shards = dict(zip(groups, assign_shards(groups, num_shards, costs)))
+        subset = [i for i, k in enumerate(keys) if shards[k] == shard_index]
+        super(ShardSubset, self).__init__(collection, subset)
+
+
 class CategorySubset(ModelSubset):
     def __init__(self, collection, category_tags):
         category_tags = set(category_tags)
@@ -158,7 +240,7 @@ class DynamicFaust(ModelCollection):
         # "discard" the neutral pose that is used for calibration purposes.
         self._tags = sorted([
             "{}:{}".format(d, l[:-4]) for d in self._paths
-            for l in sorted(os.listdir(os.path.join(self._base_dir, d, mesh_folder)))[20:]
+            for l in sorted(os.listdir(os.path.join(self._base_dir, d, "mesh_seq")))[20:]
             if l.endswith(".obj")
         ])
 
@@ -404,6 +486,11 @@ class ModelCollectionBuilder(object):
         self._tags = []
         self._category_tags = []
         self._percentage = 1.0
+        self._seed = None
+        self._shard_index = 0
+        self._num_shards = 1
+        self._shard_cost = None
+        self._shard_group = None
 
     def with_dataset(self, dataset_type):
         self._dataset_class = model_factory(dataset_type)
@@ -429,8 +516,22 @@ class ModelCollectionBuilder(object):
         self._category_tags = tags
         return self
 
-    def random_subset(self, percentage):
+    def random_subset(self, percentage, seed=None):
         self._percentage = percentage
+        self._seed = seed
+        return self
+
+    def shard(
+        self, shard_index, num_shards, cost=mesh_file_cost, group=None
+    ):
+        """Keep only the models of one shard, see ShardSubset. By default the
+        shards are balanced by the size of the mesh files, pass cost=None to
+        assign the models only by the hash of their tags. Pass group to keep
+        the models of a group, e.g. of a sequence, in the same shard."""
+        self._shard_index = shard_index
+        self._num_shards = num_shards
+        self._shard_cost = cost
+        self._shard_group = group
         return self
 
     def build(self, base_dir):
@@ -450,6 +551,18 @@ class ModelCollectionBuilder(object):
                 len(dataset), prev_len)
             )
         if self._percentage < 1.0:
-            dataset = RandomSubset(dataset, self._percentage)
+            dataset = RandomSubset(dataset, self._percentage, self._seed)
+        if self._num_shards > 1:
+            prev_len = len(dataset)
+            dataset = ShardSubset(
+                dataset,
+                self._shard_index,
+                self._num_shards,
+                self._shard_cost,
+                self._shard_group
+            )
+            print("Keep {}/{} for shard {}/{}".format(
+                len(dataset), prev_len, self._shard_index, self._num_shards)
+            )
 
         return dataset
@@ -32,11 +32,27 @@ cdef extern from "fusion.h":
     float* data_;
 
 
-  void fusion_projectionmask_cpu(const Views& views, float vx_size, bool unknown_is_free, int n_threads, Volume& vol);
-  void fusion_occupancy_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
-  void fusion_tsdfmask_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
-  void fusion_tsdf_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
-  void fusion_tsdf_hist_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, bool unobserved_is_occupied, int n_threads, Volume& vol);
+  void fusion_projectionmask_cpu(const Views& views, float vx_size, const float* origin, bool unknown_is_free, int n_threads, Volume& vol);
+  void fusion_occupancy_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
+  void fusion_tsdfmask_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
+  void fusion_tsdf_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol, int pad);
+  void fusion_tsdf_hist_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, bool unobserved_is_occupied, int n_threads, Volume& vol);
+
+  void fusion_tsdf_hist_uniform_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, float* counts);
+  void fusion_tsdf_hist_uniform_u16_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, unsigned short* counts);
+  void fusion_tsdf_hist_uniform_u8_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, unsigned char* counts);
+  void fusion_signed_edt_cpu(const float* occupancy, int depth, int height, int width, float vx_size, float truncation, int n_threads, float* sdf);
+  void fusion_trilinear_cpu(const float* vol, int depth, int height, int width, const double* points, long n_points, const float* origin, float vx_size, bool padded, float pad_value, int n_threads, float* values, float* gradients);
+
+  int fusion_hist_zach_tvl1_cpu(const Volume& hist, float truncation, float lambda_param, int iterations, float tolerance, int n_threads, Volume& vol);
+  int fusion_hist_u16_zach_tvl1_cpu(const unsigned short* hist, int n_bins, float truncation, float lambda_param, int iterations, float tolerance, int n_threads, Volume& vol);
+  int fusion_hist_u8_zach_tvl1_cpu(const unsigned char* hist, int n_bins, float truncation, float lambda_param, int iterations, float tolerance, int n_threads, Volume& vol);
+  int fusion_sparse_hist_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const float* values, long n_indices, int n_bins, float truncation, float lambda_param, int iterations, float tolerance, int n_threads, Volume& vol);
+  int fusion_sparse_hist_u16_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const unsigned short* values, long n_indices, int n_bins, float truncation, float lambda_param, int iterations, float tolerance, int n_threads, Volume& vol);
+  int fusion_sparse_hist_u8_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const unsigned char* values, long n_indices, int n_bins, float truncation, float lambda_param, int iterations, float tolerance, int n_threads, Volume& vol);
+
+  int FUSION_MAX_BINS
+  int fusion_zach_tvl1_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, float lambda_param, int iterations, float tolerance, int n_threads, Volume& vol);
 
 cdef class PyViews:
   cdef Views views
@@ -88,38 +104,257 @@ cdef class PyVolume:
     self.vol.width_ = data.shape[3]
 
 
-def projmask_cpu(PyViews views, int depth, int height, int width, float vx_size, bool unknown_is_free, int n_threads=8):
+def _origin_xyz(origin):
+  # origin is given per array axis (depth, height, width), the fusion expects
+  # it in world coordinates (x, y, z), i.e. reversed
+  if origin is None:
+    origin = (-0.5, -0.5, -0.5)
+  origin = np.asarray(origin, dtype=np.float32)
+  if origin.shape != (3,):
+    raise Exception('origin has to contain 3 values')
+  return np.ascontiguousarray(origin[::-1])
+
+
+def projmask_cpu(PyViews views, int depth, int height, int width, float vx_size, bool unknown_is_free, origin=None, int n_threads=8):
+  cdef float[::1] origin_view = _origin_xyz(origin)
   vol = np.empty((1, depth, height, width), dtype=np.float32)
   cdef float[:,:,:,::1] vol_view = vol
   cdef PyVolume py_vol = PyVolume(vol_view)
-  fusion_projectionmask_cpu(views.views, vx_size, unknown_is_free, n_threads, py_vol.vol)
+  fusion_projectionmask_cpu(views.views, vx_size, &(origin_view[0]), unknown_is_free, n_threads, py_vol.vol)
   return vol
 
-def occupancy_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, int n_threads=8):
+def occupancy_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, origin=None, int n_threads=8):
+  cdef float[::1] origin_view = _origin_xyz(origin)
   vol = np.empty((1, depth, height, width), dtype=np.float32)
   cdef float[:,:,:,::1] vol_view = vol
   cdef PyVolume py_vol = PyVolume(vol_view)
-  fusion_occupancy_cpu(views.views, vx_size, truncation, unknown_is_free, n_threads, py_vol.vol)
+  fusion_occupancy_cpu(views.views, vx_size, &(origin_view[0]), truncation, unknown_is_free, n_threads, py_vol.vol)
   return vol
 
-def tsdfmask_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, int n_threads=8):
+def signed_edt_cpu(occupancy, float vx_size, float truncation, int n_threads=8):
+  """Truncated signed distance of the voxels of a depth x height x width
+  occupancy volume, e.g. of occupancy_cpu, to its boundary, positive
+  outside."""
+  occupancy = np.ascontiguousarray(occupancy, dtype=np.float32)
+  if occupancy.ndim != 3:
+    raise Exception('occupancy has to be depth x height x width')
+  cdef float[:,:,::1] occupancy_view = occupancy
+  sdf = np.empty(occupancy.shape, dtype=np.float32)
+  cdef float[:,:,::1] sdf_view = sdf
+  fusion_signed_edt_cpu(&(occupancy_view[0,0,0]), occupancy.shape[0], occupancy.shape[1], occupancy.shape[2], vx_size, truncation, n_threads, &(sdf_view[0,0,0]))
+  return sdf
+
+def trilinear_cpu(vol, points, float vx_size, origin=None, bool padded=True, float pad_value=0, bool gradient=False, int n_threads=8):
+  """Trilinear interpolation of the depth x height x width volume at the Nx3
+  points, see fusion_trilinear_cpu for the conventions. Returns the values
+  and, with gradient, the Nx3 gradients."""
+  vol = np.ascontiguousarray(vol, dtype=np.float32)
+  if vol.ndim != 3:
+    raise Exception('vol has to be depth x height x width')
+  points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+  if origin is None:
+    origin = (-0.5, -0.5, -0.5)
+  cdef float[::1] origin_view = np.ascontiguousarray(origin, dtype=np.float32)
+  if origin_view.shape[0] != 3:
+    raise Exception('origin has to contain 3 values')
+  cdef float[:,:,::1] vol_view = vol
+  cdef double[:,::1] points_view = points
+  values = np.empty(len(points), dtype=np.float32)
+  cdef float[::1] values_view = values
+  cdef float[:,::1] gradients_view
+  cdef float* gradients_ptr = NULL
+  if gradient:
+    gradients = np.empty((len(points), 3), dtype=np.float32)
+    gradients_view = gradients
+    if len(points) > 0:
+      gradients_ptr = &(gradients_view[0,0])
+  if len(points) > 0:
+    fusion_trilinear_cpu(&(vol_view[0,0,0]), vol.shape[0], vol.shape[1], vol.shape[2], &(points_view[0,0]), len(points), &(origin_view[0]), vx_size, padded, pad_value, n_threads, &(values_view[0]), gradients_ptr)
+  if gradient:
+    return values, gradients
+  return values
+
+def tsdfmask_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, origin=None, int n_threads=8):
+  cdef float[::1] origin_view = _origin_xyz(origin)
   vol = np.empty((1, depth, height, width), dtype=np.float32)
   cdef float[:,:,:,::1] vol_view = vol
   cdef PyVolume py_vol = PyVolume(vol_view)
-  fusion_tsdfmask_cpu(views.views, vx_size, truncation, unknown_is_free, n_threads, py_vol.vol)
+  fusion_tsdfmask_cpu(views.views, vx_size, &(origin_view[0]), truncation, unknown_is_free, n_threads, py_vol.vol)
   return vol
 
-def tsdf_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, int n_threads=8):
-  vol = np.empty((1, depth, height, width), dtype=np.float32)
+def tsdf_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, origin=None, int pad=0, float pad_value=0, int n_threads=8):
+  """With pad, the fused volume is the interior of the returned volume,
+  which has pad voxels of pad_value more on every side, thus it is padded
+  without a padded copy."""
+  if pad < 0:
+    raise Exception('pad has to be non-negative')
+  cdef float[::1] origin_view = _origin_xyz(origin)
+  vol = np.empty((1, depth + 2 * pad, height + 2 * pad, width + 2 * pad), dtype=np.float32)
+  if pad > 0:
+    vol[:, :pad] = pad_value
+    vol[:, -pad:] = pad_value
+    vol[:, :, :pad] = pad_value
+    vol[:, :, -pad:] = pad_value
+    vol[:, :, :, :pad] = pad_value
+    vol[:, :, :, -pad:] = pad_value
   cdef float[:,:,:,::1] vol_view = vol
   cdef PyVolume py_vol = PyVolume(vol_view)
-  fusion_tsdf_cpu(views.views, vx_size, truncation, unknown_is_free, n_threads, py_vol.vol)
+  fusion_tsdf_cpu(views.views, vx_size, &(origin_view[0]), truncation, unknown_is_free, n_threads, py_vol.vol, pad)
   return vol
 
-def tsdf_hist_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, float[::1] bins, bool unobserved_is_occupied=True, int n_threads=8):
+def tsdf_hist_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, float[::1] bins, bool unobserved_is_occupied=True, origin=None, int n_threads=8):
+  cdef float[::1] origin_view = _origin_xyz(origin)
   cdef int n_bins = bins.shape[0]
   vol = np.empty((n_bins, depth, height, width), dtype=np.float32)
   cdef float[:,:,:,::1] vol_view = vol
   cdef PyVolume py_vol = PyVolume(vol_view)
-  fusion_tsdf_hist_cpu(views.views, vx_size, truncation, unknown_is_free, &(bins[0]), n_bins, unobserved_is_occupied, n_threads, py_vol.vol)
-  return vol
\ No newline at end of file
+  fusion_tsdf_hist_cpu(views.views, vx_size, &(origin_view[0]), truncation, unknown_is_free, &(bins[0]), n_bins, unobserved_is_occupied, n_threads, py_vol.vol)
+  return vol
+
+
+
+def _tsdf_hist_uniform_slab(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, int n_bins, dtype, bool unobserved_is_occupied, int d_begin, int d_end, origin, int n_threads):
+  cdef float[::1] origin_view = _origin_xyz(origin)
+  if n_bins < 2 or n_bins > FUSION_MAX_BINS:
+    raise Exception('n_bins has to be in [2, %d]' % FUSION_MAX_BINS)
+  dtype = np.dtype(dtype)
+  counts = np.empty((n_bins, d_end - d_begin, height, width), dtype=dtype)
+  cdef float[:,:,:,::1] f32_view
+  cdef unsigned short[:,:,:,::1] u16_view
+  cdef unsigned char[:,:,:,::1] u8_view
+  if dtype == np.float32:
+    f32_view = counts
+    fusion_tsdf_hist_uniform_cpu(views.views, vx_size, &(origin_view[0]), truncation, unknown_is_free, -truncation, truncation, n_bins, unobserved_is_occupied, depth, height, width, d_begin, d_end, n_threads, &(f32_view[0,0,0,0]))
+  elif dtype == np.uint16:
+    u16_view = counts
+    fusion_tsdf_hist_uniform_u16_cpu(views.views, vx_size, &(origin_view[0]), truncation, unknown_is_free, -truncation, truncation, n_bins, unobserved_is_occupied, depth, height, width, d_begin, d_end, n_threads, &(u16_view[0,0,0,0]))
+  elif dtype == np.uint8:
+    u8_view = counts
+    fusion_tsdf_hist_uniform_u8_cpu(views.views, vx_size, &(origin_view[0]), truncation, unknown_is_free, -truncation, truncation, n_bins, unobserved_is_occupied, depth, height, width, d_begin, d_end, n_threads, &(u8_view[0,0,0,0]))
+  else:
+    raise Exception('dtype has to be float32, uint16 or uint8')
+  return counts
+
+def tsdf_hist_uniform_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, int n_bins, dtype=np.float32, bool unobserved_is_occupied=True, origin=None, int n_threads=8):
+  """Histogram fusion with n_bins bins uniformly spaced in [-truncation,
+  truncation]. The normalized histograms are stored as float32 in [0, 1], or
+  quantized to uint16 in [0, 65535] or to uint8 in [0, 255], which trades
+  precision for 2x or 4x less memory."""
+  return _tsdf_hist_uniform_slab(views, depth, height, width, vx_size, truncation, unknown_is_free, n_bins, dtype, unobserved_is_occupied, 0, depth, origin, n_threads)
+
+def tsdf_hist_sparse_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, int n_bins, dtype=np.uint8, bool unobserved_is_occupied=True, int slab_depth=16, origin=None, int n_threads=8):
+  """Sparse version of tsdf_hist_uniform_cpu.
+
+  Most voxels are either free space or unobserved and their histograms have
+  all their mass in a single bin. Only the histograms of the remaining voxels
+  are kept, thus the volume is fused in slabs of slab_depth slices to bound
+  the memory. Returns the bin of every voxel with the largest count as a
+  (depth, height, width) uint8 array, the flat indices of the voxels that
+  do not have all their mass in a single bin and their (n, n_bins)
+  histograms. Use sparse_hist_to_dense() to recover the dense histogram.
+  """
+  modes = np.empty((depth, height, width), dtype=np.uint8)
+  indices = []
+  values = []
+  cdef int d_begin, d_end
+  for d_begin in range(0, depth, slab_depth):
+    d_end = min(depth, d_begin + slab_depth)
+    counts = _tsdf_hist_uniform_slab(views, depth, height, width, vx_size, truncation, unknown_is_free, n_bins, dtype, unobserved_is_occupied, d_begin, d_end, origin, n_threads)
+    counts = counts.reshape(n_bins, -1)
+    modes[d_begin:d_end] = counts.argmax(axis=0).reshape(d_end - d_begin, height, width)
+    mixed = np.flatnonzero((counts > 0).sum(axis=0) != 1)
+    indices.append(mixed + d_begin * height * width)
+    values.append(counts[:, mixed].T)
+  return modes, np.concatenate(indices).astype(np.int64), np.ascontiguousarray(np.concatenate(values))
+
+def sparse_hist_to_dense(modes, indices, values):
+  """Reconstruct the dense (n_bins, depth, height, width) histogram from the
+  output of tsdf_hist_sparse_cpu."""
+  n_bins = values.shape[1]
+  if values.dtype == np.float32:
+    max_count = 1
+  else:
+    max_count = np.iinfo(values.dtype).max
+  hist = np.zeros((n_bins,) + modes.shape, dtype=values.dtype)
+  hist_flat = hist.reshape(n_bins, -1)
+  hist_flat[modes.ravel(), np.arange(modes.size)] = max_count
+  hist_flat[:, indices] = values.T
+  return hist
+
+def zach_tvl1_hist_cpu(np.ndarray hist, float truncation, float lambda_param, int iterations, float tolerance=0, init=None, int n_threads=8):
+  """TV-L1 refinement of a histogram with uniformly spaced bins, stored as
+  float32 or as the quantized uint16 or uint8 output of
+  tsdf_hist_uniform_cpu."""
+  vol = np.zeros((1, hist.shape[1], hist.shape[2], hist.shape[3]), dtype=np.float32)
+  if init is not None:
+    vol[...] = init.reshape(vol.shape)
+  cdef float[:,:,:,::1] vol_view = vol
+  cdef PyVolume py_vol = PyVolume(vol_view)
+  cdef PyVolume py_hist
+  cdef unsigned short[:,:,:,::1] u16_view
+  cdef unsigned char[:,:,:,::1] u8_view
+  cdef int n_bins = hist.shape[0]
+  if hist.dtype == np.float32:
+    py_hist = PyVolume(hist)
+    fusion_hist_zach_tvl1_cpu(py_hist.vol, truncation, lambda_param, iterations, tolerance, n_threads, py_vol.vol)
+  elif hist.dtype == np.uint16:
+    u16_view = hist
+    fusion_hist_u16_zach_tvl1_cpu(&(u16_view[0,0,0,0]), n_bins, truncation, lambda_param, iterations, tolerance, n_threads, py_vol.vol)
+  elif hist.dtype == np.uint8:
+    u8_view = hist
+    fusion_hist_u8_zach_tvl1_cpu(&(u8_view[0,0,0,0]), n_bins, truncation, lambda_param, iterations, tolerance, n_threads, py_vol.vol)
+  else:
+    raise Exception('hist has to be float32, uint16 or uint8')
+  return vol
+
+def zach_tvl1_sparse_hist_cpu(modes, indices, values, float truncation, float lambda_param, int iterations, float tolerance=0, init=None, int n_threads=8):
+  """TV-L1 refinement of the sparse histogram of tsdf_hist_sparse_cpu, which
+  is read in place instead of being made dense. The result is the same as
+  that of zach_tvl1_hist_cpu on sparse_hist_to_dense(modes, indices,
+  values)."""
+  cdef unsigned char[:,:,::1] modes_view = np.ascontiguousarray(modes, dtype=np.uint8)
+  cdef long long[::1] indices_view = np.ascontiguousarray(indices, dtype=np.int64)
+  values = np.ascontiguousarray(values)
+  cdef int n_bins = values.shape[1]
+  cdef long n_indices = values.shape[0]
+  if indices_view.shape[0] != n_indices:
+    raise Exception('indices and values differ in length')
+  vol = np.zeros((1,) + tuple(modes.shape), dtype=np.float32)
+  if init is not None:
+    vol[...] = init.reshape(vol.shape)
+  cdef float[:,:,:,::1] vol_view = vol
+  cdef PyVolume py_vol = PyVolume(vol_view)
+  # Keeps the pointers valid for empty arrays
+  cdef long long dummy_index = 0
+  cdef const long long* indices_ptr = &dummy_index
+  if n_indices > 0:
+    indices_ptr = &(indices_view[0])
+  cdef float[:,::1] f32_view
+  cdef unsigned short[:,::1] u16_view
+  cdef unsigned char[:,::1] u8_view
+  cdef float f32_dummy = 0
+  cdef unsigned short u16_dummy = 0
+  cdef unsigned char u8_dummy = 0
+  if values.dtype == np.float32:
+    f32_view = values
+    fusion_sparse_hist_zach_tvl1_cpu(&(modes_view[0,0,0]), indices_ptr, &(f32_view[0,0]) if n_indices > 0 else &f32_dummy, n_indices, n_bins, truncation, lambda_param, iterations, tolerance, n_threads, py_vol.vol)
+  elif values.dtype == np.uint16:
+    u16_view = values
+    fusion_sparse_hist_u16_zach_tvl1_cpu(&(modes_view[0,0,0]), indices_ptr, &(u16_view[0,0]) if n_indices > 0 else &u16_dummy, n_indices, n_bins, truncation, lambda_param, iterations, tolerance, n_threads, py_vol.vol)
+  elif values.dtype == np.uint8:
+    u8_view = values
+    fusion_sparse_hist_u8_zach_tvl1_cpu(&(modes_view[0,0,0]), indices_ptr, &(u8_view[0,0]) if n_indices > 0 else &u8_dummy, n_indices, n_bins, truncation, lambda_param, iterations, tolerance, n_threads, py_vol.vol)
+  else:
+    raise Exception('values have to be float32, uint16 or uint8')
+  return vol
+
+def zach_tvl1_cpu(PyViews views, int depth, int height, int width, float vx_size, float truncation, bool unknown_is_free, float[::1] bins, float lambda_param, int iterations, float tolerance=0, init=None, origin=None, int n_threads=8):
+  cdef float[::1] origin_view = _origin_xyz(origin)
+  cdef int n_bins = bins.shape[0]
+  vol = np.zeros((1, depth, height, width), dtype=np.float32)
+  if init is not None:
+    vol[...] = init.reshape(vol.shape)
+  cdef float[:,:,:,::1] vol_view = vol
+  cdef PyVolume py_vol = PyVolume(vol_view)
+  fusion_zach_tvl1_cpu(views.views, vx_size, &(origin_view[0]), truncation, unknown_is_free, &(bins[0]), n_bins, lambda_param, iterations, tolerance, n_threads, py_vol.vol)
+  return vol
@@ -9,8 +9,13 @@
 
 
 template <typename FusionFunctorT>
-void fusion_cpu(const Views& views, const FusionFunctorT functor, float vx_size, int n_threads, Volume& vol) {
-  int vx_res3 = vol.depth_ * vol.height_ * vol.width_;
+void fusion_cpu(const Views& views, const FusionFunctorT functor, float vx_size, const float* origin, int n_threads, Volume& vol, int pad = 0) {
+  // With pad, only the interior of vol without pad voxels on every side is
+  // fused and origin is the corner of the interior
+  int depth = vol.depth_ - 2 * pad;
+  int height = vol.height_ - 2 * pad;
+  int width = vol.width_ - 2 * pad;
+  int vx_res3 = depth * height * width;
 
 #if defined(_OPENMP)
   omp_set_num_threads(n_threads);
@@ -18,9 +23,12 @@ void fusion_cpu(const Views& views, const FusionFunctorT functor, float vx_size,
   #pragma omp parallel for
   for(int idx = 0; idx < vx_res3; ++idx) {
     int d,h,w;
-    fusion_idx2dhw(idx, vol.width_,vol.height_, d,h,w);
+    fusion_idx2dhw(idx, width,height, d,h,w);
     float x,y,z;
-    fusion_dhw2xyz(d,h,w, vx_size, x,y,z);
+    fusion_dhw2xyz(d,h,w, vx_size, origin, x,y,z);
+    d += pad;
+    h += pad;
+    w += pad;
 
     functor.before_sample(&vol, d,h,w);
     bool run = true;
@@ -44,27 +52,283 @@ void fusion_cpu(const Views& views, const FusionFunctorT functor, float vx_size,
   }
 }
 
-void fusion_projectionmask_cpu(const Views& views, float vx_size, bool unknown_is_free, int n_threads, Volume& vol) {
+void fusion_projectionmask_cpu(const Views& views, float vx_size, const float* origin, bool unknown_is_free, int n_threads, Volume& vol) {
   ProjectionMaskFusionFunctor functor(unknown_is_free);
-  fusion_cpu(views, functor, vx_size, n_threads, vol);
+  fusion_cpu(views, functor, vx_size, origin, n_threads, vol);
 }
 
-void fusion_occupancy_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol) {
+void fusion_occupancy_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol) {
   OccupancyFusionFunctor functor(truncation, unknown_is_free);
-  fusion_cpu(views, functor, vx_size, n_threads, vol);
+  fusion_cpu(views, functor, vx_size, origin, n_threads, vol);
 }
 
-void fusion_tsdfmask_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol) {
+void fusion_tsdfmask_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol) {
   TsdfMaskFusionFunctor functor(truncation, unknown_is_free);
-  fusion_cpu(views, functor, vx_size, n_threads, vol);
+  fusion_cpu(views, functor, vx_size, origin, n_threads, vol);
 }
 
-void fusion_tsdf_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol) {
+void fusion_tsdf_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol, int pad) {
   TsdfFusionFunctor functor(truncation, unknown_is_free);
-  fusion_cpu(views, functor, vx_size, n_threads, vol);
+  fusion_cpu(views, functor, vx_size, origin, n_threads, vol, pad);
 }
 
-void fusion_tsdf_hist_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, bool unobserved_is_occupied, int n_threads, Volume& vol) {
+void fusion_tsdf_hist_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, bool unobserved_is_occupied, int n_threads, Volume& vol) {
   TsdfHistFusionFunctor functor(truncation, unknown_is_free, bin_centers, n_bins, unobserved_is_occupied);
-  fusion_cpu(views, functor, vx_size, n_threads, vol);
+  fusion_cpu(views, functor, vx_size, origin, n_threads, vol);
+}
+
+
+// Histogram fusion for bins that are uniformly spaced between bin_min and
+// bin_max. The bin of each sample is computed directly instead of searched
+// for and the histogram of each voxel is accumulated on the stack and only
+// written once, normalized by the number of valid views and scaled to
+// [0, max_count]. Thus, divided by max_count, the bins of every observed
+// voxel sum to 1 like those of fusion_tsdf_hist_cpu and the weight of the
+// TV-L1 data term does not depend on the type. Only the depth slices [d_begin, d_end) of the
+// depth x height x width grid are fused, the counts are stored as
+// n_bins x (d_end - d_begin) x height x width.
+template <typename CountT>
+void fusion_tsdf_hist_uniform_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, float max_count, int depth, int height, int width, int d_begin, int d_end, int n_threads, CountT* counts) {
+  const long slab_size = long(d_end - d_begin) * height * width;
+  const float inv_bin_width = (n_bins - 1) / (bin_max - bin_min);
+
+#if defined(_OPENMP)
+  omp_set_num_threads(n_threads);
+#endif
+  #pragma omp parallel for
+  for(long idx = 0; idx < slab_size; ++idx) {
+    int d,h,w;
+    fusion_idx2dhw(idx, width,height, d,h,w);
+    float x,y,z;
+    fusion_dhw2xyz(d + d_begin,h,w, vx_size, origin, x,y,z);
+
+    float hist[FUSION_MAX_BINS] = {0};
+    int n_valid_views = 0;
+    for(int vidx = 0; vidx < views.n_views_; ++vidx) {
+      float ur, vr, vx_d;
+      fusion_project(&views, vidx, x,y,z, ur,vr,vx_d);
+
+      int u = int(ur + 0.5f);
+      int v = int(vr + 0.5f);
+      if(u < 0 || v < 0 || u >= views.cols_ || v >= views.rows_) {
+        continue;
+      }
+      float dm_depth = views.depthmaps_[(vidx * views.rows_ + v) * views.cols_ + u];
+      if(unknown_is_free && dm_depth < 0) {
+        dm_depth = 1e9;
+      }
+      float dist = dm_depth - vx_d;
+      if(dm_depth <= 0 || dist < -truncation) {
+        continue;
+      }
+
+      n_valid_views++;
+      float t = (dist - bin_min) * inv_bin_width;
+      if(t <= 0) {
+        hist[0] += 1;
+      }
+      else if(t >= n_bins - 1) {
+        hist[n_bins - 1] += 1;
+      }
+      else {
+        // Linear interpolation between the two closest bins
+        int bin = int(t);
+        float frac = t - bin;
+        hist[bin] += 1 - frac;
+        hist[bin + 1] += frac;
+      }
+    }
+
+    if(n_valid_views > 0) {
+      float scale = max_count / n_valid_views;
+      for(int bin = 0; bin < n_bins; ++bin) {
+        counts[bin * slab_size + idx] = fusion_quantize<CountT>(hist[bin] * scale);
+      }
+    }
+    else {
+      for(int bin = 0; bin < n_bins; ++bin) {
+        counts[bin * slab_size + idx] = 0;
+      }
+      if(unobserved_is_occupied) {
+        counts[idx] = fusion_quantize<CountT>(max_count);
+      }
+    }
+  }
+}
+
+void fusion_tsdf_hist_uniform_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, float* counts) {
+  fusion_tsdf_hist_uniform_cpu<float>(views, vx_size, origin, truncation, unknown_is_free, bin_min, bin_max, n_bins, unobserved_is_occupied, 1.0f, depth, height, width, d_begin, d_end, n_threads, counts);
+}
+
+void fusion_tsdf_hist_uniform_u16_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, unsigned short* counts) {
+  fusion_tsdf_hist_uniform_cpu<unsigned short>(views, vx_size, origin, truncation, unknown_is_free, bin_min, bin_max, n_bins, unobserved_is_occupied, 65535.0f, depth, height, width, d_begin, d_end, n_threads, counts);
+}
+
+void fusion_tsdf_hist_uniform_u8_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, unsigned char* counts) {
+  fusion_tsdf_hist_uniform_cpu<unsigned char>(views, vx_size, origin, truncation, unknown_is_free, bin_min, bin_max, n_bins, unobserved_is_occupied, 255.0f, depth, height, width, d_begin, d_end, n_threads, counts);
+}
+
+
+// Squared distance transform of the samples f[0], f[stride], ... of a line
+// of length n, in place. v and z are buffers of n and n + 1 elements.
+static void fusion_edt_1d(float* f, long stride, int n, float* line, int* v, float* z) {
+  for(int q = 0; q < n; ++q) {
+    line[q] = f[q * stride];
+  }
+  // The lower envelope of the parabolas rooted at (q, line[q])
+  int k = 0;
+  v[0] = 0;
+  z[0] = -1e20f;
+  z[1] = 1e20f;
+  for(int q = 1; q < n; ++q) {
+    float s = ((line[q] + q * q) - (line[v[k]] + v[k] * v[k])) / (2 * q - 2 * v[k]);
+    while(s <= z[k]) {
+      k--;
+      s = ((line[q] + q * q) - (line[v[k]] + v[k] * v[k])) / (2 * q - 2 * v[k]);
+    }
+    k++;
+    v[k] = q;
+    z[k] = s;
+    z[k + 1] = 1e20f;
+  }
+  k = 0;
+  for(int q = 0; q < n; ++q) {
+    while(z[k + 1] < q) {
+      k++;
+    }
+    f[q * stride] = (q - v[k]) * (q - v[k]) + line[v[k]];
+  }
+}
+
+// Squared distance of every voxel to the nearest voxel with f = 0, where the
+// other voxels are initialized to cap, which bounds the result
+static void fusion_edt_3d(float* f, int depth, int height, int width, int n_threads) {
+  int n = depth > height ? depth : height;
+  n = n > width ? n : width;
+
+#if defined(_OPENMP)
+  omp_set_num_threads(n_threads);
+#endif
+  #pragma omp parallel
+  {
+    std::vector<float> line(n);
+    std::vector<int> v(n);
+    std::vector<float> z(n + 1);
+
+    // Along the width, the height and the depth
+    #pragma omp for
+    for(long i = 0; i < long(depth) * height; ++i) {
+      fusion_edt_1d(f + i * width, 1, width, line.data(), v.data(), z.data());
+    }
+    #pragma omp for
+    for(long i = 0; i < long(depth) * width; ++i) {
+      long d = i / width, w = i % width;
+      fusion_edt_1d(f + d * height * width + w, width, height, line.data(), v.data(), z.data());
+    }
+    #pragma omp for
+    for(long i = 0; i < long(height) * width; ++i) {
+      fusion_edt_1d(f + i, long(height) * width, depth, line.data(), v.data(), z.data());
+    }
+  }
+}
+
+void fusion_signed_edt_cpu(const float* occupancy, int depth, int height, int width, float vx_size, float truncation, int n_threads, float* sdf) {
+  const long n = long(depth) * height * width;
+  // Distances beyond the truncation are not needed
+  const float band = truncation / vx_size + 1;
+  const float cap = band * band;
+
+  // The squared distance to the nearest occupied and free voxel
+  std::vector<float> to_occupied(n);
+  std::vector<float> to_free(n);
+  for(long idx = 0; idx < n; ++idx) {
+    bool occupied = occupancy[idx] > 0.5f;
+    to_occupied[idx] = occupied ? 0 : cap;
+    to_free[idx] = occupied ? cap : 0;
+  }
+  fusion_edt_3d(to_occupied.data(), depth, height, width, n_threads);
+  fusion_edt_3d(to_free.data(), depth, height, width, n_threads);
+
+  #pragma omp parallel for
+  for(long idx = 0; idx < n; ++idx) {
+    float dist = occupancy[idx] > 0.5f
+      ? 0.5f - sqrtf(to_free[idx])
+      : sqrtf(to_occupied[idx]) - 0.5f;
+    dist *= vx_size;
+    sdf[idx] = fminf(fmaxf(dist, -truncation), truncation);
+  }
+}
+
+void fusion_trilinear_cpu(const float* vol, int depth, int height, int width, const double* points, long n_points, const float* origin, float vx_size, bool padded, float pad_value, int n_threads, float* values, float* gradients) {
+  const int shape[3] = {depth, height, width};
+  const long strides[3] = {long(height) * width, width, 1};
+
+#if defined(_OPENMP)
+  omp_set_num_threads(n_threads);
+#endif
+  #pragma omp parallel for
+  for(long idx = 0; idx < n_points; ++idx) {
+    // The first sample of the cell of the point and the position inside it
+    int i0[3];
+    float t[3];
+    for(int a = 0; a < 3; ++a) {
+      // The samples are at the centers of the voxels
+      float c = (points[3 * idx + a] - origin[a]) / vx_size - 0.5f;
+      // Far from the volume all the corners are padded or the nearest ones
+      c = padded
+        ? fminf(fmaxf(c, -2), shape[a] + 1)
+        : fminf(fmaxf(c, 0), shape[a] - 1);
+      float c0 = floorf(c);
+      // Keep the last sample inside of the cell
+      if(!padded && c0 >= shape[a] - 1) {
+        c0 = shape[a] - 2 > 0 ? shape[a] - 2 : 0;
+      }
+      i0[a] = int(c0);
+      t[a] = c - c0;
+    }
+
+    // The 8 corners of the cell, outside of the volume they are padded
+    float corner[2][2][2];
+    for(int dd = 0; dd < 2; ++dd) {
+      for(int hh = 0; hh < 2; ++hh) {
+        for(int ww = 0; ww < 2; ++ww) {
+          int d = i0[0] + dd, h = i0[1] + hh, w = i0[2] + ww;
+          bool inside = d >= 0 && h >= 0 && w >= 0 && d < depth && h < height && w < width;
+          if(!inside && !padded) {
+            d = d < depth ? d : depth - 1;
+            h = h < height ? h : height - 1;
+            w = w < width ? w : width - 1;
+            inside = true;
+          }
+          corner[dd][hh][ww] = inside
+            ? vol[d * strides[0] + h * strides[1] + w * strides[2]]
+            : pad_value;
+        }
+      }
+    }
+
+    // Interpolate along the width, then the height and the depth
+    float c00 = corner[0][0][0] + t[2] * (corner[0][0][1] - corner[0][0][0]);
+    float c01 = corner[0][1][0] + t[2] * (corner[0][1][1] - corner[0][1][0]);
+    float c10 = corner[1][0][0] + t[2] * (corner[1][0][1] - corner[1][0][0]);
+    float c11 = corner[1][1][0] + t[2] * (corner[1][1][1] - corner[1][1][0]);
+    float c0 = c00 + t[1] * (c01 - c00);
+    float c1 = c10 + t[1] * (c11 - c10);
+    values[idx] = c0 + t[0] * (c1 - c0);
+
+    if(gradients != NULL) {
+      float gd = c1 - c0;
+      float gh = (1 - t[0]) * (c01 - c00) + t[0] * (c11 - c10);
+      float gw = 0;
+      for(int dd = 0; dd < 2; ++dd) {
+        for(int hh = 0; hh < 2; ++hh) {
+          float weight = (dd ? t[0] : 1 - t[0]) * (hh ? t[1] : 1 - t[1]);
+          gw += weight * (corner[dd][hh][1] - corner[dd][hh][0]);
+        }
+      }
+      gradients[3 * idx + 0] = gd / vx_size;
+      gradients[3 * idx + 1] = gh / vx_size;
+      gradients[3 * idx + 2] = gw / vx_size;
+    }
+  }
 }
@@ -97,6 +97,16 @@ inline void fusion_dhw2xyz(int d, int h, int w, float vx_size, float& x, float&
   z = ((d + 0.5) * vx_size) - 0.5;
 }
 
+FUSION_FUNCTION
+inline void fusion_dhw2xyz(int d, int h, int w, float vx_size, const float* origin, float& x, float& y, float& z) {
+  // Same as above for a grid whose first voxel corner is at origin (x,y,z)
+  // instead of at (-0.5,-0.5,-0.5), which allows to fuse a volume that only
+  // covers part of the unit cube
+  x = ((w + 0.5) * vx_size) + origin[0];
+  y = ((h + 0.5) * vx_size) + origin[1];
+  z = ((d + 0.5) * vx_size) + origin[2];
+}
+
 FUSION_FUNCTION
 inline void fusion_project(const Views* views, int vidx, float x, float y, float z, float& u, float& v, float& d) {
   float* K = views->Ks_ + vidx * 9;
@@ -134,7 +144,7 @@ struct ProjectionMaskFusionFunctor : public FusionFunctor {
   }
 };
 
-void fusion_projectionmask_cpu(const Views& views, float vx_size, bool unknown_is_free, int n_threads, Volume& vol);
+void fusion_projectionmask_cpu(const Views& views, float vx_size, const float* origin, bool unknown_is_free, int n_threads, Volume& vol);
 
 struct OccupancyFusionFunctor : public FusionFunctor {
   float truncation_;
@@ -163,7 +173,7 @@ struct OccupancyFusionFunctor : public FusionFunctor {
   }
 };
 
-void fusion_occupancy_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
+void fusion_occupancy_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
 
 struct TsdfMaskFusionFunctor : public FusionFunctor {
   float truncation_;
@@ -185,7 +195,7 @@ struct TsdfMaskFusionFunctor : public FusionFunctor {
   }
 };
 
-void fusion_tsdfmask_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
+void fusion_tsdfmask_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
 
 struct TsdfFusionFunctor : public FusionFunctor {
   float truncation_;
@@ -225,7 +235,9 @@ struct TsdfFusionFunctor : public FusionFunctor {
   }
 };
 
-void fusion_tsdf_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, int n_threads, Volume& vol);
+// With pad > 0, vol is the fused volume surrounded by pad voxels on every
+// side, which are left untouched
+void fusion_tsdf_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, int n_threads, Volume& vol, int pad = 0);
 
 struct TsdfHistFusionFunctor : public FusionFunctor {
   float truncation_;
@@ -278,6 +290,56 @@ struct TsdfHistFusionFunctor : public FusionFunctor {
   }
 };
 
-void fusion_tsdf_hist_cpu(const Views& views, float vx_size, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, bool unobserved_is_occupied, int n_threads, Volume& vol);
+void fusion_tsdf_hist_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, bool unobserved_is_occupied, int n_threads, Volume& vol);
+
+// The maximum number of bins of the uniform histogram fusion
+const int FUSION_MAX_BINS = 64;
+
+template <typename CountT>
+inline CountT fusion_quantize(float val) {
+  return CountT(val + 0.5f);
+}
+
+template <>
+inline float fusion_quantize<float>(float val) {
+  return val;
+}
+
+// Histogram fusion with uniformly spaced bins stored as float32, uint16 or
+// uint8, see fusion.cpp.
+void fusion_tsdf_hist_uniform_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, float* counts);
+void fusion_tsdf_hist_uniform_u16_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, unsigned short* counts);
+void fusion_tsdf_hist_uniform_u8_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float bin_min, float bin_max, int n_bins, bool unobserved_is_occupied, int depth, int height, int width, int d_begin, int d_end, int n_threads, unsigned char* counts);
+
+// Signed distance of the voxels of a depth x height x width occupancy volume
+// (> 0.5 is occupied) to the boundary between the occupied and the free
+// voxels, positive outside, in the same units as vx_size and truncated to
+// [-truncation, truncation]. The boundary lies halfway between neighboring
+// occupied and free voxels. The squared distances are computed exactly with
+// the separable distance transform of Felzenszwalb and Huttenlocher.
+void fusion_signed_edt_cpu(const float* occupancy, int depth, int height, int width, float vx_size, float truncation, int n_threads, float* sdf);
+
+// Trilinear interpolation of a depth x height x width volume at n_points
+// points. The points and the origin are given per array axis, the sample
+// vol[d,h,w] is at the voxel center origin + ((d,h,w) + 0.5) * vx_size as in
+// fusion_dhw2xyz, which is also the convention of the meshes extracted with
+// marching cubes. The samples outside of the volume are
+// pad_value if padded, otherwise the nearest sample. If gradients is not NULL,
+// it receives the gradient of the interpolant at every point, again per array
+// axis.
+void fusion_trilinear_cpu(const float* vol, int depth, int height, int width, const double* points, long n_points, const float* origin, float vx_size, bool padded, float pad_value, int n_threads, float* values, float* gradients);
+
+// TV-L1 refinement of the histogram fusion, see fusion_zach_tvl1.cpp. The
+// functions return the number of iterations that were run before the largest
+// update fell below the tolerance. The sparse versions take the histogram of
+// tsdf_hist_sparse_cpu, i.e. the bin of every voxel with all of its counts
+// and the n_indices x n_bins values of the voxels at the sorted flat indices.
+int fusion_hist_zach_tvl1_cpu(const Volume& hist, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol);
+int fusion_hist_u16_zach_tvl1_cpu(const unsigned short* hist, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol);
+int fusion_hist_u8_zach_tvl1_cpu(const unsigned char* hist, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol);
+int fusion_sparse_hist_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const float* values, long n_indices, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol);
+int fusion_sparse_hist_u16_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const unsigned short* values, long n_indices, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol);
+int fusion_sparse_hist_u8_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const unsigned char* values, long n_indices, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol);
+int fusion_zach_tvl1_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, float lambda, int iterations, float tolerance, int n_threads, Volume& vol);
 
 #endif
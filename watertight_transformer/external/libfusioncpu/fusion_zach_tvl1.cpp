@@ -0,0 +1,266 @@
+#include "fusion.h"
+
+#include <algorithm>
+#include <cmath>
+#include <vector>
+
+#if defined(_OPENMP)
+#include <omp.h>
+#endif
+
+// CPU port of the primal-dual TV-L1 histogram fusion of libfusiongpu, see
+// fusion_zach_tvl1.cu. Both steps only read the variable that the other step
+// writes, so every voxel can be updated independently. The volume is swept
+// in blocks of contiguous rows along the width, so that the inner loop
+// streams through memory and the neighbours along h and d stay in cache.
+
+
+static void zach_tvl1_dual(const Volume& u, float* p, float sigma) {
+  const int D = u.depth_, H = u.height_, W = u.width_;
+  const long HW = long(H) * W;
+  const long vx_res3 = D * HW;
+  float* p0 = p;
+  float* p1 = p + vx_res3;
+  float* p2 = p + 2 * vx_res3;
+
+  #pragma omp parallel for collapse(2) schedule(static)
+  for(int d = 0; d < D; ++d) {
+    for(int h = 0; h < H; ++h) {
+      const long row = d * HW + long(h) * W;
+      const float* u_row = u.data_ + row;
+      for(int w = 0; w < W; ++w) {
+        const long idx = row + w;
+        float u_curr = u_row[w];
+
+        float u_x = (w < W-1) ? u_row[w + 1] - u_curr : 0;
+        float u_y = (h < H-1) ? u_row[w + W] - u_curr : 0;
+        float u_z = (d < D-1) ? u_row[w + HW] - u_curr : 0;
+
+        float p0_new = p0[idx] + sigma * u_x;
+        float p1_new = p1[idx] + sigma * u_y;
+        float p2_new = p2[idx] + sigma * u_z;
+
+        float denom = fmaxf(1.0f, sqrtf(p0_new*p0_new + p1_new*p1_new + p2_new*p2_new));
+
+        p0[idx] = p0_new / denom;
+        p1[idx] = p1_new / denom;
+        p2[idx] = p2_new / denom;
+      }
+    }
+  }
+}
+
+// A histogram stored as n_bins x depth x height x width values of HistT.
+// The counts of the voxels of a row are read through a cursor returned by
+// row(), which reads the voxels in increasing order.
+template <typename HistT>
+struct DenseHist {
+  const HistT* hist_;
+  int n_bins_;
+  long vx_res3_;
+
+  struct Cursor {
+    const DenseHist* h_;
+    void counts(long idx, float* out) {
+      for(int i = 0; i < h_->n_bins_; ++i) {
+        out[i] = h_->hist_[i * h_->vx_res3_ + idx];
+      }
+    }
+  };
+
+  Cursor row(long row_begin) const {
+    return Cursor{this};
+  }
+};
+
+// The sparse histogram of tsdf_hist_sparse_cpu: the bin of every voxel that
+// has all of the max_count in it and the n_bins values of the voxels at the
+// sorted flat indices, which have their counts spread over several bins
+template <typename HistT>
+struct SparseHist {
+  const unsigned char* modes_;
+  const long long* indices_;
+  const HistT* values_;
+  long n_indices_;
+  int n_bins_;
+  float max_count_;
+
+  struct Cursor {
+    const SparseHist* h_;
+    long k_;
+    void counts(long idx, float* out) {
+      while(k_ < h_->n_indices_ && h_->indices_[k_] < idx) {
+        k_++;
+      }
+      if(k_ < h_->n_indices_ && h_->indices_[k_] == idx) {
+        const HistT* values = h_->values_ + k_ * h_->n_bins_;
+        for(int i = 0; i < h_->n_bins_; ++i) {
+          out[i] = values[i];
+        }
+      }
+      else {
+        std::fill(out, out + h_->n_bins_, 0.0f);
+        out[h_->modes_[idx]] = h_->max_count_;
+      }
+    }
+  };
+
+  Cursor row(long row_begin) const {
+    long k = std::lower_bound(indices_, indices_ + n_indices_, row_begin) - indices_;
+    return Cursor{this, k};
+  }
+};
+
+// Returns the largest change of u, which is used to test for convergence.
+// The counts of the histogram, see DenseHist and SparseHist, are multiplied
+// by hist_scale to get the bin weights. The weights of every observed voxel
+// sum to 1, thus lambda weighs the data term the same for every type.
+template <typename Hist>
+static float zach_tvl1_primal(Volume& u, const float* p, const Hist& hist, int n_bins, float hist_scale, float tau, float lambda) {
+  const int D = u.depth_, H = u.height_, W = u.width_;
+  const long HW = long(H) * W;
+  const long vx_res3 = D * HW;
+  const float* p0 = p;
+  const float* p1 = p + vx_res3;
+  const float* p2 = p + 2 * vx_res3;
+
+  // The bin centers normalized to [-1, 1]
+  std::vector<float> levels(n_bins);
+  for(int i = 0; i < n_bins; ++i) {
+    levels[i] = ((2.0f * i) / (n_bins - 1.0f)) - 1.0f;
+  }
+
+  float max_change = 0;
+  #pragma omp parallel reduction(max:max_change)
+  {
+    // The n_bins levels and the n_bins+1 proximal candidates, whose median
+    // is the solution of the proximal step
+    std::vector<float> candidates(2 * n_bins + 1);
+    std::vector<float> counts(n_bins);
+
+    #pragma omp for collapse(2) schedule(static)
+    for(int d = 0; d < D; ++d) {
+      for(int h = 0; h < H; ++h) {
+        const long row = d * HW + long(h) * W;
+        typename Hist::Cursor cursor = hist.row(row);
+        for(int w = 0; w < W; ++w) {
+          const long idx = row + w;
+
+          float px = (w > 0 ? p0[idx - 1] : 0) - p0[idx];
+          float py = (h > 0 ? p1[idx - W] : 0) - p1[idx];
+          float pz = (d > 0 ? p2[idx - HW] : 0) - p2[idx];
+
+          float u_old = u.data_[idx];
+          float divergence = px + py + pz;
+          float u_new = u_old - tau * divergence;
+
+          // W_i = -sum_{j<i} w_j + sum_{j>=i} w_j = total - 2 * prefix_i
+          cursor.counts(idx, counts.data());
+          float total = 0;
+          for(int i = 0; i < n_bins; ++i) {
+            total += counts[i];
+          }
+          total *= hist_scale;
+          float prefix = 0;
+          for(int i = 0; i <= n_bins; ++i) {
+            candidates[i] = u_new + tau * lambda * (total - 2 * prefix);
+            if(i < n_bins) {
+              prefix += counts[i] * hist_scale;
+            }
+          }
+          std::copy(levels.begin(), levels.end(), candidates.begin() + n_bins + 1);
+          std::nth_element(candidates.begin(), candidates.begin() + n_bins, candidates.end());
+
+          float u_res = fminf(1.0f, fmaxf(-1.0f, candidates[n_bins]));
+          u.data_[idx] = u_res;
+          max_change = fmaxf(max_change, fabsf(u_res - u_old));
+        }
+      }
+    }
+  }
+  return max_change;
+}
+
+template <typename Hist>
+static int zach_tvl1_hist(const Hist& hist, int n_bins, float hist_scale, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+#if defined(_OPENMP)
+  omp_set_num_threads(n_threads);
+#endif
+  long vx_res3 = long(vol.depth_) * vol.height_ * vol.width_;
+
+  // primal-dual algorithm, u is updated in place starting from the values
+  // of vol
+  std::vector<float> p(3 * vx_res3, 0);
+
+  float tau = 1.0/sqrt(6.0f)/3;
+  float sigma = 1.0/sqrt(6.0f)*3;
+
+  int iter = 0;
+  while(iter < iterations) {
+    zach_tvl1_dual(vol, p.data(), sigma);
+    float max_change = zach_tvl1_primal(vol, p.data(), hist, n_bins, hist_scale, tau, lambda);
+    ++iter;
+    if(max_change < tolerance) {
+      break;
+    }
+  }
+
+  #pragma omp parallel for
+  for(long idx = 0; idx < vx_res3; ++idx) {
+    vol.data_[idx] *= truncation;
+  }
+  return iter;
+}
+
+template <typename HistT>
+static int zach_tvl1_dense_hist(const HistT* hist, int n_bins, float max_count, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  long vx_res3 = long(vol.depth_) * vol.height_ * vol.width_;
+  DenseHist<HistT> dense{hist, n_bins, vx_res3};
+  return zach_tvl1_hist(dense, n_bins, 1.0f / max_count, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
+
+template <typename HistT>
+static int zach_tvl1_sparse_hist(const unsigned char* modes, const long long* indices, const HistT* values, long n_indices, int n_bins, float max_count, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  SparseHist<HistT> sparse{modes, indices, values, n_indices, n_bins, max_count};
+  return zach_tvl1_hist(sparse, n_bins, 1.0f / max_count, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
+
+int fusion_hist_zach_tvl1_cpu(const Volume& hist, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  return zach_tvl1_dense_hist(hist.data_, hist.channels_, 1.0f, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
+
+int fusion_hist_u16_zach_tvl1_cpu(const unsigned short* hist, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  return zach_tvl1_dense_hist(hist, n_bins, 65535.0f, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
+
+int fusion_hist_u8_zach_tvl1_cpu(const unsigned char* hist, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  return zach_tvl1_dense_hist(hist, n_bins, 255.0f, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
+
+int fusion_sparse_hist_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const float* values, long n_indices, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  return zach_tvl1_sparse_hist(modes, indices, values, n_indices, n_bins, 1.0f, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
+
+int fusion_sparse_hist_u16_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const unsigned short* values, long n_indices, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  return zach_tvl1_sparse_hist(modes, indices, values, n_indices, n_bins, 65535.0f, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
+
+int fusion_sparse_hist_u8_zach_tvl1_cpu(const unsigned char* modes, const long long* indices, const unsigned char* values, long n_indices, int n_bins, float truncation, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  return zach_tvl1_sparse_hist(modes, indices, values, n_indices, n_bins, 255.0f, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
+
+int fusion_zach_tvl1_cpu(const Views& views, float vx_size, const float* origin, float truncation, bool unknown_is_free, float* bin_centers, int n_bins, float lambda, int iterations, float tolerance, int n_threads, Volume& vol) {
+  //compute hist
+  long vx_res3 = long(vol.depth_) * vol.height_ * vol.width_;
+  std::vector<float> hist_data(n_bins * vx_res3);
+  Volume hist;
+  hist.channels_ = n_bins;
+  hist.depth_ = vol.depth_;
+  hist.height_ = vol.height_;
+  hist.width_ = vol.width_;
+  hist.data_ = hist_data.data();
+  bool unobserved_is_occupied = true;
+  fusion_tsdf_hist_cpu(views, vx_size, origin, truncation, unknown_is_free, bin_centers, n_bins, unobserved_is_occupied, n_threads, hist);
+
+  return fusion_hist_zach_tvl1_cpu(hist, truncation, lambda, iterations, tolerance, n_threads, vol);
+}
@@ -1,2 +1,3 @@
-from .mcubes import marching_cubes, marching_cubes_func
+from .mcubes import marching_cubes, marching_cubes_func, \
+    marching_cubes_func_slabs
 from .exporter import export_mesh, export_obj, export_off
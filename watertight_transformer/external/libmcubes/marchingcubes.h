@@ -36,7 +36,8 @@ void marching_cubes(const vector3& lower, const vector3& upper,
     coord_type dy = (upper[1] - lower[1])/static_cast<coord_type>(numy);
     coord_type dz = (upper[2] - lower[2])/static_cast<coord_type>(numz);
 
-    size_t* shared_indices = new size_t[2*numy*numz*3];
+    // A vector, so that it is released when the formula throws
+    std::vector<size_t> shared_indices(2*numy*numz*3);
     const int z3 = numz*3;
     const int yz3 = numy*z3;
 
@@ -188,8 +189,6 @@ void marching_cubes(const vector3& lower, const vector3& upper,
             }
         }
     }
-
-    delete [] shared_indices;
 }
 
 template<typename coord_type, typename vector3, typename formula>
@@ -14,14 +14,19 @@ cimport numpy as np
 np.import_array()
 
 cdef extern from "pywrapper.h":
-    cdef object c_marching_cubes "marching_cubes"(np.ndarray, double) except +
+    cdef object c_marching_cubes "marching_cubes"(np.ndarray, double, bint) except +
     cdef object c_marching_cubes2 "marching_cubes2"(np.ndarray, double) except +
     cdef object c_marching_cubes3 "marching_cubes3"(np.ndarray, double) except +
     cdef object c_marching_cubes_func "marching_cubes_func"(tuple, tuple, int, int, int, object, double) except +
+    cdef object c_marching_cubes_func_slabs "marching_cubes_func_slabs"(tuple, tuple, int, int, int, object, double, int) except +
 
-def marching_cubes(np.ndarray volume, float isovalue):
-    
-    verts, faces = c_marching_cubes(volume, isovalue)
+def marching_cubes(np.ndarray volume, float isovalue, bint negate=False):
+    """Extract the isovalue level set of the volume, or with negate of
+    -volume without allocating it. The volume is read in place in any memory
+    layout, float32 and float64 volumes without converting the samples."""
+    if not volume.dtype.isnative:
+        volume = volume.astype(volume.dtype.newbyteorder("="))
+    verts, faces = c_marching_cubes(volume, isovalue, negate)
     verts.shape = (-1, 3)
     faces.shape = (-1, 3)
     return verts, faces
@@ -46,3 +51,14 @@ def marching_cubes_func(tuple lower, tuple upper, int numx, int numy, int numz,
     verts.shape = (-1, 3)
     faces.shape = (-1, 3)
     return verts, faces
+
+def marching_cubes_func_slabs(tuple lower, tuple upper, int numx, int numy, int numz, object f, double isovalue, int planes_per_call=16):
+    """Same as marching_cubes_func(), but f is vectorized. It takes an
+    np.array of shape (N, 3) with the points of planes_per_call planes of
+    constant x at once and returns their N values. Every sample is only
+    evaluated once and at most planes_per_call + 1 planes are kept in memory,
+    since every slab is extracted as soon as it is evaluated."""
+    verts, faces = c_marching_cubes_func_slabs(lower, upper, numx, numy, numz, f, isovalue, planes_per_call)
+    verts.shape = (-1, 3)
+    faces.shape = (-1, 3)
+    return verts, faces
@@ -3,6 +3,8 @@
 
 #include "marchingcubes.h"
 
+#include <algorithm>
+#include <cmath>
 #include <stdexcept>
 
 struct PythonToCFunc
@@ -76,26 +78,237 @@ PyObject* marching_cubes_func(PyObject* lower, PyObject* upper,
     return res;
 }
 
+// Thrown when the Python function fails, the Python error is already set
+struct PythonError {};
+
+// Evaluates a vectorized Python function on slabs of planes_per_call planes
+// of constant x at once and serves the samples of marching cubes from them.
+// Marching cubes visits the planes in increasing order and every layer of
+// cells needs two consecutive planes, thus the last plane of a slab is kept
+// for the next one and every sample is evaluated exactly once.
+struct PythonSlabFunc
+{
+    PyObject* func;
+    double lower[3];
+    double step[3];
+    int num[3];
+    int planes_per_call;
+    std::vector<double> values;
+    int first;
+    int count;
+
+    PythonSlabFunc(PyObject* func, const double* lower, const double* upper,
+        int numx, int numy, int numz, int planes_per_call)
+        : func(func), planes_per_call(planes_per_call), first(0), count(0)
+    {
+        num[0] = numx; num[1] = numy; num[2] = numz;
+        for(int i=0; i<3; ++i)
+        {
+            this->lower[i] = lower[i];
+            step[i] = (upper[i] - lower[i]) / (num[i] - 1);
+        }
+    }
+
+    // The index of the sample at the coordinate c, marching_cubes() samples
+    // at lower + step*(i + 1/2)
+    int index(double c, int axis) const
+    {
+        return static_cast<int>(std::lround((c - lower[axis]) / step[axis] - 0.5));
+    }
+
+    void evaluate(int start, int end, double* out)
+    {
+        const npy_intp plane_size = static_cast<npy_intp>(num[1]) * num[2];
+        npy_intp dims[2] = {(end - start) * plane_size, 3};
+        PyArrayObject* points = reinterpret_cast<PyArrayObject*>(
+            PyArray_SimpleNew(2, dims, NPY_DOUBLE));
+        if(points == NULL)
+            throw PythonError();
+        double* p = reinterpret_cast<double*>(PyArray_DATA(points));
+        for(int i=start; i<end; ++i)
+            for(int j=0; j<num[1]; ++j)
+                for(int k=0; k<num[2]; ++k)
+                {
+                    *p++ = lower[0] + step[0]*i + step[0]/2;
+                    *p++ = lower[1] + step[1]*j + step[1]/2;
+                    *p++ = lower[2] + step[2]*k + step[2]/2;
+                }
+
+        PyObject* res = PyObject_CallFunctionObjArgs(
+            func, reinterpret_cast<PyObject*>(points), NULL);
+        Py_DECREF(points);
+        if(res == NULL)
+            throw PythonError();
+        PyArrayObject* arr = reinterpret_cast<PyArrayObject*>(PyArray_FROMANY(
+            res, NPY_DOUBLE, 0, 0, NPY_ARRAY_IN_ARRAY));
+        Py_DECREF(res);
+        if(arr == NULL)
+            throw PythonError();
+        if(PyArray_SIZE(arr) != dims[0])
+        {
+            PyErr_Format(PyExc_ValueError,
+                "The function returned %zd values for %zd points",
+                static_cast<Py_ssize_t>(PyArray_SIZE(arr)),
+                static_cast<Py_ssize_t>(dims[0]));
+            Py_DECREF(arr);
+            throw PythonError();
+        }
+        std::copy(
+            reinterpret_cast<double*>(PyArray_DATA(arr)),
+            reinterpret_cast<double*>(PyArray_DATA(arr)) + dims[0],
+            out);
+        Py_DECREF(arr);
+    }
+
+    void fetch(int plane)
+    {
+        const size_t plane_size = static_cast<size_t>(num[1]) * num[2];
+        int start = plane;
+        int kept = 0;
+        if(count > 0 && plane == first + count)
+        {
+            // Keep the corner values shared with the previous slab
+            std::copy(
+                values.begin() + (count - 1) * plane_size,
+                values.begin() + count * plane_size,
+                values.begin());
+            start = plane - 1;
+            kept = 1;
+        }
+        int end = std::min(plane + planes_per_call + 1 - kept, num[0]);
+        values.resize((end - start) * plane_size);
+        evaluate(plane, end, values.data() + kept * plane_size);
+        first = start;
+        count = end - start;
+    }
+
+    double operator()(double x, double y, double z)
+    {
+        int i = index(x, 0);
+        if(i < first || i >= first + count)
+            fetch(i);
+        return values[
+            ((static_cast<size_t>(i - first) * num[1]) + index(y, 1)) * num[2]
+            + index(z, 2)];
+    }
+};
+
+PyObject* marching_cubes_func_slabs(PyObject* lower, PyObject* upper,
+    int numx, int numy, int numz, PyObject* f, double isovalue,
+    int planes_per_call)
+{
+    std::vector<double> vertices;
+    std::vector<size_t> polygons;
+
+    if(planes_per_call < 1)
+        throw std::invalid_argument("planes_per_call must be positive");
+    if(numx < 2 || numy < 2 || numz < 2)
+        throw std::invalid_argument("At least two samples per axis are needed");
+
+    // Copy the lower and upper coordinates to a C array.
+    double lower_[3];
+    double upper_[3];
+    for(int i=0; i<3; ++i)
+    {
+        PyObject* l = PySequence_GetItem(lower, i);
+        if(l == NULL)
+            throw std::runtime_error("error");
+        PyObject* u = PySequence_GetItem(upper, i);
+        if(u == NULL)
+        {
+            Py_DECREF(l);
+            throw std::runtime_error("error");
+        }
+
+        lower_[i] = PyFloat_AsDouble(l);
+        upper_[i] = PyFloat_AsDouble(u);
+
+        Py_DECREF(l);
+        Py_DECREF(u);
+        if(lower_[i]==-1.0 || upper_[i]==-1.0)
+        {
+            if(PyErr_Occurred())
+                throw std::runtime_error("error");
+        }
+    }
+
+    // Marching cubes.
+    try
+    {
+        mc::marching_cubes<double>(lower_, upper_, numx, numy, numz,
+            PythonSlabFunc(f, lower_, upper_, numx, numy, numz, planes_per_call),
+            isovalue, vertices, polygons);
+    }
+    catch(const PythonError&)
+    {
+        return NULL;
+    }
+
+    // Copy the result to two Python ndarrays.
+    npy_intp size_vertices = vertices.size();
+    npy_intp size_polygons = polygons.size();
+    PyArrayObject* verticesarr = reinterpret_cast<PyArrayObject*>(PyArray_SimpleNew(1, &size_vertices, PyArray_DOUBLE));
+    PyArrayObject* polygonsarr = reinterpret_cast<PyArrayObject*>(PyArray_SimpleNew(1, &size_polygons, PyArray_ULONG));
+
+    std::copy(vertices.begin(), vertices.end(),
+        reinterpret_cast<double*>(PyArray_DATA(verticesarr)));
+    std::copy(polygons.begin(), polygons.end(),
+        reinterpret_cast<unsigned long*>(PyArray_DATA(polygonsarr)));
+
+    PyObject* res = Py_BuildValue("(O,O)", verticesarr, polygonsarr);
+    Py_XDECREF(verticesarr);
+    Py_XDECREF(polygonsarr);
+    return res;
+}
+
 struct PyArrayToCFunc
 {
     PyArrayObject* arr;
-    PyArrayToCFunc(PyArrayObject* arr) {this->arr = arr;}
+    double sign;
+    PyArrayToCFunc(PyArrayObject* arr, double sign=1.0)
+    {
+        this->arr = arr;
+        this->sign = sign;
+    }
     double operator()(int x, int y, int z)
     {
         npy_intp c[3] = {x,y,z};
-        return PyArray_SafeGet<double>(arr, c);
+        return sign * PyArray_SafeGet<double>(arr, c);
     }
 };
 
-PyObject* marching_cubes(PyArrayObject* arr, double isovalue)
+// Same as PyArrayToCFunc, but for arrays of a known type, which are read
+// through their strides without looking up the type of every sample
+template<typename T>
+struct TypedPyArrayToCFunc
+{
+    const char* data;
+    npy_intp strides[3];
+    double sign;
+    TypedPyArrayToCFunc(PyArrayObject* arr, double sign=1.0)
+    {
+        data = reinterpret_cast<const char*>(PyArray_DATA(arr));
+        std::copy(PyArray_STRIDES(arr), PyArray_STRIDES(arr) + 3, strides);
+        this->sign = sign;
+    }
+    double operator()(int x, int y, int z)
+    {
+        return sign * *reinterpret_cast<const T*>(
+            data + x*strides[0] + y*strides[1] + z*strides[2]);
+    }
+};
+
+template<typename formula>
+PyObject* marching_cubes_array(PyArrayObject* arr, formula f, double isovalue)
 {
-    if(PyArray_NDIM(arr) != 3)
-        throw std::runtime_error("Only three-dimensional arrays are supported.");
-    
     // Prepare data.
     npy_intp* shape = PyArray_DIMS(arr);
     double lower[3] = {0,0,0};
-    double upper[3] = {shape[0]-1, shape[1]-1, shape[2]-1};
+    double upper[3] = {
+        static_cast<double>(shape[0]-1),
+        static_cast<double>(shape[1]-1),
+        static_cast<double>(shape[2]-1)
+    };
     long numx = upper[0] - lower[0] + 1;
     long numy = upper[1] - lower[1] + 1;
     long numz = upper[2] - lower[2] + 1;
@@ -103,7 +316,7 @@ PyObject* marching_cubes(PyArrayObject* arr, double isovalue)
     std::vector<size_t> polygons;
     
     // Marching cubes.
-    mc::marching_cubes<double>(lower, upper, numx, numy, numz, PyArrayToCFunc(arr), isovalue,
+    mc::marching_cubes<double>(lower, upper, numx, numy, numz, f, isovalue,
                         vertices, polygons);
     
     // Copy the result to two Python ndarrays.
@@ -126,6 +339,24 @@ PyObject* marching_cubes(PyArrayObject* arr, double isovalue)
     return res;
 }
 
+PyObject* marching_cubes(PyArrayObject* arr, double isovalue, bool negate)
+{
+    if(PyArray_NDIM(arr) != 3)
+        throw std::runtime_error("Only three-dimensional arrays are supported.");
+    
+    // The level set of the negated volume is extracted by negating the
+    // samples, instead of a negated copy of the volume
+    double sign = negate ? -1.0 : 1.0;
+    bool native = PyArray_ISNOTSWAPPED(arr) && PyArray_ISALIGNED(arr);
+    if(native && PyArray_TYPE(arr) == NPY_FLOAT)
+        return marching_cubes_array(arr,
+            TypedPyArrayToCFunc<float>(arr, sign), isovalue);
+    if(native && PyArray_TYPE(arr) == NPY_DOUBLE)
+        return marching_cubes_array(arr,
+            TypedPyArrayToCFunc<double>(arr, sign), isovalue);
+    return marching_cubes_array(arr, PyArrayToCFunc(arr, sign), isovalue);
+}
+
 PyObject* marching_cubes2(PyArrayObject* arr, double isovalue)
 {
     if(PyArray_NDIM(arr) != 3)
@@ -134,7 +365,11 @@ PyObject* marching_cubes2(PyArrayObject* arr, double isovalue)
     // Prepare data.
     npy_intp* shape = PyArray_DIMS(arr);
     double lower[3] = {0,0,0};
-    double upper[3] = {shape[0]-1, shape[1]-1, shape[2]-1};
+    double upper[3] = {
+        static_cast<double>(shape[0]-1),
+        static_cast<double>(shape[1]-1),
+        static_cast<double>(shape[2]-1)
+    };
     long numx = upper[0] - lower[0] + 1;
     long numy = upper[1] - lower[1] + 1;
     long numz = upper[2] - lower[2] + 1;
@@ -173,7 +408,11 @@ PyObject* marching_cubes3(PyArrayObject* arr, double isovalue)
     // Prepare data.
     npy_intp* shape = PyArray_DIMS(arr);
     double lower[3] = {0,0,0};
-    double upper[3] = {shape[0]-1, shape[1]-1, shape[2]-1};
+    double upper[3] = {
+        static_cast<double>(shape[0]-1),
+        static_cast<double>(shape[1]-1),
+        static_cast<double>(shape[2]-1)
+    };
     long numx = upper[0] - lower[0] + 1;
     long numy = upper[1] - lower[1] + 1;
     long numz = upper[2] - lower[2] + 1;
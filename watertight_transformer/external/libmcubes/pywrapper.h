@@ -7,10 +7,14 @@
 
 #include <vector>
 
-PyObject* marching_cubes(PyArrayObject* arr, double isovalue);
+PyObject* marching_cubes(PyArrayObject* arr, double isovalue,
+    bool negate=false);
 PyObject* marching_cubes2(PyArrayObject* arr, double isovalue);
 PyObject* marching_cubes3(PyArrayObject* arr, double isovalue);
 PyObject* marching_cubes_func(PyObject* lower, PyObject* upper,
     int numx, int numy, int numz, PyObject* f, double isovalue);
+PyObject* marching_cubes_func_slabs(PyObject* lower, PyObject* upper,
+    int numx, int numy, int numz, PyObject* f, double isovalue,
+    int planes_per_call);
 
 #endif // _PYWRAPPER_H
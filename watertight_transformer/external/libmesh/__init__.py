@@ -1,8 +1,10 @@
 from .inside_mesh import (
-    check_mesh_contains, MeshIntersector, TriangleIntersector2d
+    check_mesh_contains, MeshIntersector, TriangleIntersector2d,
+    triangle_hash_path
 )
 
 
 __all__ = [
-    check_mesh_contains, MeshIntersector, TriangleIntersector2d
+    check_mesh_contains, MeshIntersector, TriangleIntersector2d,
+    triangle_hash_path
 ]
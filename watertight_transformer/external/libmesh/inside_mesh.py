@@ -1,15 +1,40 @@
+import hashlib
+import os
+
 import numpy as np
 from .triangle_hash import TriangleHash as _TriangleHash
 
 
-def check_mesh_contains(mesh, points, hash_resolution=512):
-    intersector = MeshIntersector(mesh, hash_resolution)
+def check_mesh_contains(mesh, points, hash_resolution=512, hash_path=None):
+    intersector = MeshIntersector(mesh, hash_resolution, hash_path)
     contains = intersector.query(points)
     return contains
 
 
+def triangle_hash_path(mesh_path):
+    """The path of the triangle hash stored next to a mesh, e.g.
+    model_watertight.obj -> model_watertight_triangle_hash.npz"""
+    return f"{os.path.splitext(mesh_path)[0]}_triangle_hash.npz"
+
+
 class MeshIntersector:
-    def __init__(self, mesh, resolution=512):
+    """Check whether points are inside a watertight mesh by counting the
+    intersections of rays along the z-axis with its triangles.
+
+    The triangles are looked up in a TriangleHash over the xy-plane. With
+    hash_path, the hash is loaded from that file if it was stored for the
+    same triangles and resolution, otherwise it is built and stored there,
+    thus repeated queries against the same mesh, e.g. across the epochs of a
+    training, skip building it.
+
+    Arguments:
+    ----------
+        mesh: trimesh.Trimesh object
+        resolution: The number of cells of the hash along each axis
+        hash_path: Optionally the .npz file of the hash, see
+                   triangle_hash_path()
+    """
+    def __init__(self, mesh, resolution=512, hash_path=None):
         triangles = mesh.vertices[mesh.faces].astype(np.float64)
         n_tri = triangles.shape[0]
 
@@ -24,16 +49,56 @@ class MeshIntersector:
         # assert(np.allclose(triangles.reshape(-1, 3).min(0), 0.5))
         # assert(np.allclose(triangles.reshape(-1, 3).max(0), resolution - 0.5))
 
-        triangles2d = triangles[:, :, :2]
+        triangles2d = np.ascontiguousarray(triangles[:, :, :2])
+        tri_hash = None
+        if hash_path is not None:
+            key = self.hash_key(triangles2d, resolution)
+            tri_hash = self.load_hash(hash_path, key, resolution)
         self._tri_intersector2d = TriangleIntersector2d(
-            triangles2d, resolution)
+            triangles2d, resolution, tri_hash)
+        if hash_path is not None and tri_hash is None:
+            self.save_hash(hash_path, key)
+
+    @staticmethod
+    def hash_key(triangles2d, resolution):
+        """Hash the triangles that the hash is built from."""
+        h = hashlib.sha1(str((triangles2d.shape, resolution)).encode("utf-8"))
+        h.update(np.ascontiguousarray(triangles2d, dtype=np.float64).data)
+        return h.hexdigest()
+
+    @staticmethod
+    def load_hash(path, key, resolution):
+        """Return the TriangleHash stored in path, or None if it is missing
+        or was built for other triangles."""
+        try:
+            with np.load(path) as f:
+                if str(f["key"]) != key:
+                    return None
+                return _TriangleHash.from_arrays(
+                    f["offsets"], f["indices"], resolution
+                )
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save_hash(self, path, key):
+        """Store the hash of the triangles in path, atomically."""
+        tri_hash = self._tri_intersector2d.tri_hash
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                key=key,
+                offsets=tri_hash.offsets,
+                indices=tri_hash.indices
+            )
+        os.replace(tmp_path, path)
 
     def query(self, points):
         # Rescale points
         points = self.rescale(points)
 
         # placeholder result with no hits we'll fill in later
-        contains = np.zeros(len(points), dtype=np.bool)
+        contains = np.zeros(len(points), dtype=bool)
 
         # cull points outside of the axis aligned bounding box
         # this avoids running ray tests unless points are close
@@ -111,9 +176,11 @@ class MeshIntersector:
 
 
 class TriangleIntersector2d:
-    def __init__(self, triangles, resolution=128):
+    def __init__(self, triangles, resolution=128, tri_hash=None):
         self.triangles = triangles
-        self.tri_hash = _TriangleHash(triangles, resolution)
+        if tri_hash is None:
+            tri_hash = _TriangleHash(triangles, resolution)
+        self.tri_hash = tri_hash
 
     def query(self, points):
         point_indices, tri_indices = self.tri_hash.query(points)
@@ -127,7 +194,7 @@ class TriangleIntersector2d:
         return point_indices, tri_indices
 
     def check_triangles(self, points, triangles):
-        contains = np.zeros(points.shape[0], dtype=np.bool)
+        contains = np.zeros(points.shape[0], dtype=bool)
         A = triangles[:, :2] - triangles[:, 2:]
         A = A.transpose([0, 2, 1])
         y = points - triangles[:, 2]
@@ -3,85 +3,167 @@
 import numpy as np
 cimport numpy as np
 cimport cython
-from libcpp.vector cimport vector
-from libc.math cimport floor, ceil
+cimport openmp
+from cython.parallel cimport prange
+
+
+@cython.boundscheck(False)  # Deactivate bounds checking
+@cython.wraparound(False)   # Deactivate negative indexing.
+cdef void _hash_rows(double[:, :, :] triangles, int x_start, int x_end, int resolution, long long[::1] positions, int[::1] indices, bint fill) noexcept nogil:
+    # Count the triangles per cell of the rows x_start to x_end in positions,
+    # or, with fill, write them to indices at positions and advance it
+    cdef int n_tri = triangles.shape[0]
+    cdef int i_tri, j, x, y
+    cdef long long cell
+    cdef int bbox_min[2]
+    cdef int bbox_max[2]
+
+    for i_tri in range(n_tri):
+        # Compute bounding box
+        for j in range(2):
+            bbox_min[j] = <int> min(
+                triangles[i_tri, 0, j], triangles[i_tri, 1, j], triangles[i_tri, 2, j]
+            )
+            bbox_max[j] = <int> max(
+                triangles[i_tri, 0, j], triangles[i_tri, 1, j], triangles[i_tri, 2, j]
+            )
+            bbox_min[j] = min(max(bbox_min[j], 0), resolution - 1)
+            bbox_max[j] = min(max(bbox_max[j], 0), resolution - 1)
+        # Only keep the rows of this thread
+        bbox_min[0] = max(bbox_min[0], x_start)
+        bbox_max[0] = min(bbox_max[0], x_end - 1)
+
+        # Find all voxels where bounding box intersects
+        for x in range(bbox_min[0], bbox_max[0] + 1):
+            for y in range(bbox_min[1], bbox_max[1] + 1):
+                cell = resolution * x + y
+                if fill:
+                    indices[positions[cell]] = i_tri
+                positions[cell] += 1
+
+
+cdef inline int _split(int n, int parts, int i) noexcept nogil:
+    # The start of the i-th of parts contiguous ranges of n items
+    return <int> ((<long long> n) * i // parts)
 
-cdef class TriangleHash:
-    cdef vector[vector[int]] spatial_hash
-    cdef int resolution
 
-    def __cinit__(self, double[:, :, :] triangles, int resolution):
-        self.spatial_hash.resize(resolution * resolution)
+cdef class TriangleHash:
+    """A uniform 2D grid of resolution x resolution cells that lists the
+    triangles whose bounding box overlaps every cell.
+
+    The lists are stored in the compressed sparse row layout, i.e. the
+    triangles of the cell resolution * x + y are
+    indices[offsets[cell]:offsets[cell + 1]] in increasing order, thus the
+    hash is two flat arrays that can be stored with the mesh, see
+    from_arrays().
+    """
+    cdef readonly int resolution
+    cdef readonly object offsets
+    cdef readonly object indices
+    cdef const long long[::1] offsets_view
+    cdef const int[::1] indices_view
+
+    def __cinit__(self, triangles, int resolution, int n_threads=0):
         self.resolution = resolution
-        self._build_hash(triangles)
-
-    @cython.boundscheck(False)  # Deactivate bounds checking
-    @cython.wraparound(False)   # Deactivate negative indexing.
-    cdef int _build_hash(self, double[:, :, :] triangles):
+        if triangles is not None:
+            self._build_hash(triangles, n_threads)
+
+    @staticmethod
+    def from_arrays(offsets, indices, int resolution):
+        """Wrap the offsets and the indices of a hash built before, e.g.
+        loaded from disk, without building it again."""
+        if len(offsets) != resolution * resolution + 1:
+            raise ValueError('offsets must have resolution**2 + 1 entries')
+        tri_hash = TriangleHash(None, resolution)
+        tri_hash._set_arrays(
+            np.asarray(offsets, dtype=np.int64),
+            np.asarray(indices, dtype=np.int32)
+        )
+        return tri_hash
+
+    def _set_arrays(self, offsets, indices):
+        self.offsets = offsets
+        self.indices = indices
+        self.offsets_view = offsets
+        self.indices_view = indices
+
+    def _build_hash(self, double[:, :, :] triangles, int n_threads):
         assert(triangles.shape[1] == 3)
         assert(triangles.shape[2] == 2)
 
-        cdef int n_tri = triangles.shape[0]
-        cdef int bbox_min[2]
-        cdef int bbox_max[2]
-        
-        cdef int i_tri, j, x, y
-        cdef int spatial_idx
-
-        for i_tri in range(n_tri):
-            # Compute bounding box
-            for j in range(2):
-                bbox_min[j] = <int> min(
-                    triangles[i_tri, 0, j], triangles[i_tri, 1, j], triangles[i_tri, 2, j]
-                )
-                bbox_max[j] = <int> max(
-                    triangles[i_tri, 0, j], triangles[i_tri, 1, j], triangles[i_tri, 2, j]
-                )
-                bbox_min[j] = min(max(bbox_min[j], 0), self.resolution - 1)
-                bbox_max[j] = min(max(bbox_max[j], 0), self.resolution - 1)
-
-            # Find all voxels where bounding box intersects
-            for x in range(bbox_min[0], bbox_max[0] + 1):
-                for y in range(bbox_min[1], bbox_max[1] + 1):
-                    spatial_idx = self.resolution * x + y
-                    self.spatial_hash[spatial_idx].push_back(i_tri)
+        cdef int resolution = self.resolution
+        if n_threads <= 0:
+            n_threads = openmp.omp_get_max_threads()
+        # Every thread owns a band of rows of the grid and scans all the
+        # triangles in order, thus the triangles of every cell are filled in
+        # increasing order and the threads share a single array of counts
+        n_threads = max(1, min(n_threads, resolution))
+
+        positions_np = np.zeros(resolution * resolution, dtype=np.int64)
+        cdef long long[::1] positions = positions_np
+        cdef int[::1] indices_view = np.empty(0, dtype=np.int32)
+        cdef int t
+
+        # Count the triangles of every cell
+        for t in prange(n_threads, nogil=True, num_threads=n_threads, schedule='static', chunksize=1):
+            _hash_rows(
+                triangles, _split(resolution, n_threads, t), _split(resolution, n_threads, t + 1),
+                resolution, positions, indices_view, False
+            )
+
+        offsets = np.zeros(resolution * resolution + 1, dtype=np.int64)
+        np.cumsum(positions_np, out=offsets[1:])
+        indices = np.empty(offsets[-1], dtype=np.int32)
+        indices_view = indices
+        positions_np[...] = offsets[:-1]
+
+        # Fill the triangles of every cell
+        for t in prange(n_threads, nogil=True, num_threads=n_threads, schedule='static', chunksize=1):
+            _hash_rows(
+                triangles, _split(resolution, n_threads, t), _split(resolution, n_threads, t + 1),
+                resolution, positions, indices_view, True
+            )
+
+        self._set_arrays(offsets, indices)
 
     @cython.boundscheck(False)  # Deactivate bounds checking
     @cython.wraparound(False)   # Deactivate negative indexing.
     cpdef query(self, double[:, :] points):
         assert(points.shape[1] == 2)
         cdef int n_points = points.shape[0]
-
-        cdef vector[int] points_indices
-        cdef vector[int] tri_indices
-        # cdef int[:] points_indices_np
-        # cdef int[:] tri_indices_np
-
-        cdef int i_point, k, x, y
-        cdef int spatial_idx
-
+        cdef int i_point, x, y
+        cdef long long k, n_hits
+        cdef long long spatial_idx
+
+        # The cell of every point, -1 outside of the grid
+        cells_np = np.full(n_points, -1, dtype=np.int64)
+        cdef long long[::1] cells = cells_np
+        n_hits = 0
         for i_point in range(n_points):
             x = int(points[i_point, 0])
             y = int(points[i_point, 1])
             if not (0 <= x < self.resolution and 0 <= y < self.resolution):
                 continue
+            spatial_idx = self.resolution * x + y
+            cells[i_point] = spatial_idx
+            n_hits += (
+                self.offsets_view[spatial_idx + 1]
+                - self.offsets_view[spatial_idx]
+            )
+
+        points_indices_np = np.empty(n_hits, dtype=np.int32)
+        tri_indices_np = np.empty(n_hits, dtype=np.int32)
+        cdef int[::1] points_indices_view = points_indices_np
+        cdef int[::1] tri_indices_view = tri_indices_np
+
+        n_hits = 0
+        for i_point in range(n_points):
+            spatial_idx = cells[i_point]
+            if spatial_idx < 0:
+                continue
+            for k in range(self.offsets_view[spatial_idx], self.offsets_view[spatial_idx + 1]):
+                points_indices_view[n_hits] = i_point
+                tri_indices_view[n_hits] = self.indices_view[k]
+                n_hits += 1
 
-            spatial_idx = self.resolution * x +  y
-            for i_tri in self.spatial_hash[spatial_idx]:
-                points_indices.push_back(i_point)
-                tri_indices.push_back(i_tri)
-
-        points_indices_np = np.zeros(points_indices.size(), dtype=np.int32)
-        tri_indices_np = np.zeros(tri_indices.size(), dtype=np.int32)
-
-        cdef int[:] points_indices_view = points_indices_np
-        cdef int[:] tri_indices_view = tri_indices_np
-
-        for k in range(points_indices.size()):
-            points_indices_view[k] = points_indices[k]
-
-        for k in range(tri_indices.size()):
-            tri_indices_view[k] = tri_indices[k]
-            
         return points_indices_np, tri_indices_np
-
@@ -131,11 +131,8 @@ void cameraSetup(double zNear, double zFar, double *intrinsics, unsigned int img
   glViewport(0, 0, imgWidth, imgHeight);
 }
 
-void drawPatchToDepthBuffer(GLuint listName, unsigned char *imageBuffer, float *depthBuffer, bool *maskBuffer,
-        unsigned int imgHeight, unsigned int imgWidth, double *zNearFarV, bool coloring = true) {
-
-  glCallList(listName);
-  glFlush();
+void readBuffers(unsigned char *imageBuffer, float *depthBuffer, bool *maskBuffer,
+        unsigned int imgHeight, unsigned int imgWidth, double *zNearFarV, bool coloring) {
 
   // bug fix for Nvidia
   unsigned int paddedWidth = imgWidth % 4;
@@ -181,6 +178,14 @@ void drawPatchToDepthBuffer(GLuint listName, unsigned char *imageBuffer, float *
   free(dataBuffer_rgb);
 }
 
+void drawPatchToDepthBuffer(GLuint listName, unsigned char *imageBuffer, float *depthBuffer, bool *maskBuffer,
+        unsigned int imgHeight, unsigned int imgWidth, double *zNearFarV, bool coloring = true) {
+
+  glCallList(listName);
+  glFlush();
+  readBuffers(imageBuffer, depthBuffer, maskBuffer, imgHeight, imgWidth, zNearFarV, coloring);
+}
+
 void renderDepthMesh(double *FM, int fNum, double *VM, int vNum, double *CM, double *intrinsics, int *imgSizeV, double *zNearFarV, unsigned char * imgBuffer, float *depthBuffer, bool *maskBuffer, double linewidth, bool coloring) {
   //createGLContext();
   OffscreenGL offscreenGL(imgSizeV[0], imgSizeV[1]);
@@ -193,3 +198,84 @@ void renderDepthMesh(double *FM, int fNum, double *VM, int vNum, double *CM, dou
   }
   //deleteGLContext();
 }
+
+
+DepthRenderer::DepthRenderer(const unsigned int *faces, int fNum, int height, int width) :
+  offscreenGL_(height, width), fNum_(fNum), vNum_(0), height_(height), width_(width) {
+
+  glGenBuffers(1, &vertexBuffer_);
+  glGenBuffers(1, &indexBuffer_);
+  glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, indexBuffer_);
+  glBufferData(GL_ELEMENT_ARRAY_BUFFER, 3 * fNum * sizeof(unsigned int), faces, GL_STATIC_DRAW);
+}
+
+DepthRenderer::~DepthRenderer() {
+  glDeleteBuffers(1, &vertexBuffer_);
+  glDeleteBuffers(1, &indexBuffer_);
+}
+
+void DepthRenderer::setVertices(const float *vertices, int vNum) {
+  glBindBuffer(GL_ARRAY_BUFFER, vertexBuffer_);
+  if (vNum == vNum_) {
+    glBufferSubData(GL_ARRAY_BUFFER, 0, 3 * vNum * sizeof(float), vertices);
+  } else {
+    glBufferData(GL_ARRAY_BUFFER, 3 * vNum * sizeof(float), vertices, GL_DYNAMIC_DRAW);
+    vNum_ = vNum;
+  }
+}
+
+void multModelMatrix(const double *R, const double *T) {
+  // The view transform follows the view matrix of cameraSetup(), which is
+  // the same as transforming the vertices before rendering them
+  double modelMat[] = {
+    R[0], R[3], R[6], 0,
+    R[1], R[4], R[7], 0,
+    R[2], R[5], R[8], 0,
+    T[0], T[1], T[2], 1
+  };
+  glMatrixMode(GL_MODELVIEW);
+  glMultMatrixd(modelMat);
+}
+
+void DepthRenderer::render(const double *R, const double *T, double *intrinsics, double *zNearFarV, float *depthBuffer, bool *maskBuffer) {
+  cameraSetup(zNearFarV[0], zNearFarV[1], intrinsics, height_, width_);
+  multModelMatrix(R, T);
+
+  glBindBuffer(GL_ARRAY_BUFFER, vertexBuffer_);
+  glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, indexBuffer_);
+  glEnableClientState(GL_VERTEX_ARRAY);
+  glVertexPointer(3, GL_FLOAT, 0, 0);
+  glDrawElements(GL_TRIANGLES, 3 * fNum_, GL_UNSIGNED_INT, 0);
+  glDisableClientState(GL_VERTEX_ARRAY);
+  glBindBuffer(GL_ARRAY_BUFFER, 0);
+  glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0);
+  glFlush();
+
+  readBuffers(NULL, depthBuffer, maskBuffer, height_, width_, zNearFarV, false);
+}
+
+
+ChunkedDepthRenderer::ChunkedDepthRenderer(int height, int width) :
+  offscreenGL_(height, width), height_(height), width_(width) {
+}
+
+void ChunkedDepthRenderer::begin(const double *R, const double *T, double *intrinsics, double *zNearFarV) {
+  cameraSetup(zNearFarV[0], zNearFarV[1], intrinsics, height_, width_);
+  multModelMatrix(R, T);
+}
+
+void ChunkedDepthRenderer::draw(const float *vertices, int vNum, const unsigned int *faces, int fNum) {
+  // The batch is drawn from client memory, which OpenGL has consumed when
+  // glDrawElements() returns, thus the caller can free it right after
+  glBindBuffer(GL_ARRAY_BUFFER, 0);
+  glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0);
+  glEnableClientState(GL_VERTEX_ARRAY);
+  glVertexPointer(3, GL_FLOAT, 0, vertices);
+  glDrawElements(GL_TRIANGLES, 3 * fNum, GL_UNSIGNED_INT, faces);
+  glDisableClientState(GL_VERTEX_ARRAY);
+}
+
+void ChunkedDepthRenderer::end(double *zNearFarV, float *depthBuffer, bool *maskBuffer) {
+  glFlush();
+  readBuffers(NULL, depthBuffer, maskBuffer, height_, width_, zNearFarV, false);
+}
@@ -23,4 +23,54 @@ private:
 
 void renderDepthMesh(double *FM, int fNum, double *VM, int vNum, double *CM, double *intrinsics, int *imgSizeV, double *zNearFarV, unsigned char * imgBuffer, float *depthBuffer, bool *maskBuffer, double linewidth, bool coloring);
 
+// Renders the depth maps of a mesh with a fixed topology from many views. The
+// faces are uploaded once as an index buffer, the vertices only when they
+// change and every view is applied as a modelview transform, so that a
+// sequence of frames only updates the vertex positions.
+class DepthRenderer {
+
+public:
+  // faces is a row-major fNum x 3 array of 0-based vertex indices
+  DepthRenderer(const unsigned int *faces, int fNum, int height, int width);
+  ~DepthRenderer();
+
+  // vertices is a row-major vNum x 3 array
+  void setVertices(const float *vertices, int vNum);
+  // Render the mesh transformed by the row-major 3x3 rotation R and the
+  // translation T into the column-major depth and mask buffers, as
+  // renderDepthMesh()
+  void render(const double *R, const double *T, double *intrinsics, double *zNearFarV, float *depthBuffer, bool *maskBuffer);
+
+private:
+  OffscreenGL offscreenGL_;
+  GLuint vertexBuffer_;
+  GLuint indexBuffer_;
+  int fNum_;
+  int vNum_;
+  int height_;
+  int width_;
+};
+
+// Renders the depth map of a mesh that is drawn in several batches, so that
+// only one batch of triangles has to be in memory at a time. The batches are
+// drawn into the same depth buffer and the depth test merges them.
+class ChunkedDepthRenderer {
+
+public:
+  ChunkedDepthRenderer(int height, int width);
+
+  // Clear the buffers and set up the view, as DepthRenderer::render()
+  void begin(const double *R, const double *T, double *intrinsics, double *zNearFarV);
+  // Draw a batch, vertices is a row-major vNum x 3 array and faces a
+  // row-major fNum x 3 array of 0-based indices into it
+  void draw(const float *vertices, int vNum, const unsigned int *faces, int fNum);
+  // Read the merged depth and mask buffers, as DepthRenderer::render()
+  void end(double *zNearFarV, float *depthBuffer, bool *maskBuffer);
+
+private:
+  OffscreenGL offscreenGL_;
+  int height_;
+  int width_;
+};
+
 #endif
\ No newline at end of file
@@ -49,3 +49,121 @@ def render(double[:,::1] vertices, double[:,::1] faces, double[::1] cam_intr, do
   renderDepthMesh(FM, fNum, VM, vNum, CM, intrinsics, imgSize, zNearVarV, imgBuffer, depthBuffer, maskBuffer, 0, coloring);
 
   return depth.T, mask.T, img.transpose((2,1,0))
+
+
+cdef extern from "offscreen.h":
+  cdef cppclass DepthRenderer:
+    DepthRenderer(const unsigned int* faces, int fNum, int height, int width)
+    void setVertices(const float* vertices, int vNum)
+    void render(const double* R, const double* T, double* intrinsics, double* zNearFarV, float* depthBuffer, bool* maskBuffer)
+
+
+cdef class MeshRenderer:
+  """Render the depth maps of meshes that share the same faces, e.g. the
+  frames of a sequence. The faces are only uploaded once and set_vertices()
+  only updates the vertex positions. The views are applied as rigid
+  transforms, which is the same as render() with the transformed vertices."""
+  cdef DepthRenderer* renderer
+  cdef double[::1] cam_intr
+  cdef double[::1] znf
+  cdef int height
+  cdef int width
+
+  def __cinit__(self, faces, double[::1] cam_intr, double[::1] znf, int[::1] img_size):
+    if cam_intr.shape[0] != 4:
+      raise Exception('cam_intr must be a 4x1 double vector')
+    if img_size.shape[0] != 2:
+      raise Exception('img_size must be a 2x1 int vector')
+    cdef unsigned int[:,::1] faces_view = np.ascontiguousarray(faces, dtype=np.uint32)
+    if faces_view.shape[1] != 3:
+      raise Exception('faces must be a Mx3 array')
+    self.cam_intr = cam_intr
+    self.znf = znf
+    self.height = img_size[0]
+    self.width = img_size[1]
+    self.renderer = new DepthRenderer(&(faces_view[0,0]), faces_view.shape[0], self.height, self.width)
+
+  def __dealloc__(self):
+    del self.renderer
+
+  def set_vertices(self, vertices):
+    cdef float[:,::1] vertices_view = np.ascontiguousarray(vertices, dtype=np.float32)
+    if vertices_view.shape[1] != 3:
+      raise Exception('vertices must be a Nx3 array')
+    self.renderer.setVertices(&(vertices_view[0,0]), vertices_view.shape[0])
+
+  def render(self, R, T):
+    """Render the vertices transformed by the 3x3 rotation R and the
+    translation T and return the depth map and the mask as render()."""
+    cdef double[:,::1] R_view = np.ascontiguousarray(R, dtype=np.float64)
+    cdef double[::1] T_view = np.ascontiguousarray(T, dtype=np.float64)
+    depth = np.empty((self.width, self.height), dtype=np.float32)
+    mask  = np.empty((self.width, self.height), dtype=np.uint8)
+    cdef float[:,::1] depth_view = depth
+    cdef unsigned char[:,::1] mask_view = mask
+    self.renderer.render(&(R_view[0,0]), &(T_view[0]), &(self.cam_intr[0]), &(self.znf[0]), &(depth_view[0,0]), <bool*> &(mask_view[0,0]))
+    return depth.T, mask.T
+
+
+cdef extern from "offscreen.h":
+  cdef cppclass ChunkedDepthRenderer:
+    ChunkedDepthRenderer(int height, int width)
+    void begin(const double* R, const double* T, double* intrinsics, double* zNearFarV)
+    void draw(const float* vertices, int vNum, const unsigned int* faces, int fNum)
+    void end(double* zNearFarV, float* depthBuffer, bool* maskBuffer)
+
+
+cdef class ChunkedMeshRenderer:
+  """Render the depth maps of meshes that are drawn in batches, e.g. meshes
+  that are too large to be held in memory at once. Every view starts with
+  begin(), draws any number of batches with draw() and returns the merged
+  depth map and mask with end(), which are the same as render() with the
+  transformed vertices of the whole mesh."""
+  cdef ChunkedDepthRenderer* renderer
+  cdef double[::1] cam_intr
+  cdef double[::1] znf
+  cdef int height
+  cdef int width
+
+  def __cinit__(self, double[::1] cam_intr, double[::1] znf, int[::1] img_size):
+    if cam_intr.shape[0] != 4:
+      raise Exception('cam_intr must be a 4x1 double vector')
+    if img_size.shape[0] != 2:
+      raise Exception('img_size must be a 2x1 int vector')
+    self.cam_intr = cam_intr
+    self.znf = znf
+    self.height = img_size[0]
+    self.width = img_size[1]
+    self.renderer = new ChunkedDepthRenderer(self.height, self.width)
+
+  def __dealloc__(self):
+    del self.renderer
+
+  def begin(self, R, T):
+    """Clear the buffers and set up the view of the 3x3 rotation R and the
+    translation T."""
+    cdef double[:,::1] R_view = np.ascontiguousarray(R, dtype=np.float64)
+    cdef double[::1] T_view = np.ascontiguousarray(T, dtype=np.float64)
+    self.renderer.begin(&(R_view[0,0]), &(T_view[0]), &(self.cam_intr[0]), &(self.znf[0]))
+
+  def draw(self, vertices, faces):
+    """Draw the Mx3 faces, which index the Nx3 vertices of the batch."""
+    cdef float[:,::1] vertices_view = np.ascontiguousarray(vertices, dtype=np.float32)
+    cdef unsigned int[:,::1] faces_view = np.ascontiguousarray(faces, dtype=np.uint32)
+    if vertices_view.shape[1] != 3:
+      raise Exception('vertices must be a Nx3 array')
+    if faces_view.shape[1] != 3:
+      raise Exception('faces must be a Mx3 array')
+    if faces_view.shape[0] == 0:
+      return
+    self.renderer.draw(&(vertices_view[0,0]), vertices_view.shape[0], &(faces_view[0,0]), faces_view.shape[0])
+
+  def end(self):
+    """Return the depth map and the mask of the batches drawn since
+    begin()."""
+    depth = np.empty((self.width, self.height), dtype=np.float32)
+    mask  = np.empty((self.width, self.height), dtype=np.uint8)
+    cdef float[:,::1] depth_view = depth
+    cdef unsigned char[:,::1] mask_view = mask
+    self.renderer.end(&(self.znf[0]), &(depth_view[0,0]), <bool*> &(mask_view[0,0]))
+    return depth.T, mask.T
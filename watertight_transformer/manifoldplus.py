@@ -1,8 +1,37 @@
+import os
+import shutil
+import signal
 import subprocess
+from tempfile import TemporaryDirectory, gettempdir
 
-import trimesh
 
-from simple_3dviz import Mesh
+def default_staging_directory():
+    """Return a RAM-backed directory for the intermediate files, if there is
+    one, otherwise the default temporary directory."""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return gettempdir()
+
+
+def _kill_group(process):
+    # The process was started in its own process group, kill the processes
+    # it started together with it
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Already exited together with its children
+        pass
+    except PermissionError:
+        process.kill()
+
+
+def _check_returncode(returncode, stderr):
+    if returncode != 0:
+        raise RuntimeError(
+            "ManifoldPlus exited with code {}: {}".format(
+                returncode, stderr.decode(errors="replace").strip()
+            )
+        )
 
 
 class ManifoldPlus:
@@ -11,20 +40,178 @@ class ManifoldPlus:
     [1] ManifoldPlus: A Robust and Scalable Watertight Manifold Surface
     Generation Method for Triangle Soups, by Huang, Jingwei and Zhou, Yichao
     and Guibas, Leonidas
+
+    Arguments:
+    ----------
+        manifoldplus_script: Path to the ManifoldPlus executable
+        depth: Number of depth values used in the Manifold algorithm
+        timeout: Seconds after which a ManifoldPlus call is killed, None
+                 waits forever
+        staging_directory: Directory for the intermediate mesh files, by
+                           default a RAM-backed directory is used if available
     """
     def __init__(
         self,
         manifoldplus_script,
         depth=10,
+        timeout=None,
+        staging_directory=None,
     ):
         self.manifoldplus_script = manifoldplus_script
         self.depth = depth
+        self.timeout = timeout
+        if staging_directory is None:
+            staging_directory = default_staging_directory()
+        self.staging_directory = staging_directory
 
-    def to_watertight(self, path_to_mesh, path_to_watertight, file_type="off"):
-        subprocess.call([
+    def command(self, path_to_mesh, path_to_watertight):
+        return [
             self.manifoldplus_script,
             "--input", path_to_mesh,
             "--output", path_to_watertight,
             "--depth", str(self.depth),
-        ], stdout=subprocess.DEVNULL)
+        ]
+
+    def estimate_peak_memory(self, n_faces, resolutions=None):
+        """Estimate the peak memory in bytes of converting a mesh with
+        n_faces faces, including the ManifoldPlus process.
+
+        The mesh is kept in memory while ManifoldPlus loads its own copy and
+        builds an octree, whose leaves cover the surface, thus their number
+        grows with 4^depth. The resolutions are ignored.
+        """
+        # The interpreter and the imported libraries
+        base = 200 * 1024**2
+        # The trimesh object and the copy of ManifoldPlus
+        mesh = (150 + 300) * n_faces
+        # The octree cells and the faces of the output mesh
+        octree = 200 * 4**self.depth
+        return int(base + mesh + octree)
+
+    def to_watertight(self, path_to_mesh, path_to_watertight, file_type="off"):
+        """Run ManifoldPlus on path_to_mesh. Raises subprocess.TimeoutExpired
+        after killing a hanging process and a RuntimeError with the exit code
+        and the stderr if it fails."""
+        # In its own process group, so that the processes it starts are
+        # killed with it
+        with subprocess.Popen(
+            self.command(path_to_mesh, path_to_watertight),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            start_new_session=True
+        ) as process:
+            try:
+                _, stderr = process.communicate(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                _kill_group(process)
+                process.wait()
+                raise
+        _check_returncode(process.returncode, stderr)
+
+    def mesh_to_watertight(self, mesh, path_to_watertight=None, file_type="off"):
+        """Convert a trimesh.Trimesh object and return the watertight mesh.
+
+        The input and the output of ManifoldPlus are staged in a temporary
+        directory that is removed afterwards. The watertight mesh is also
+        moved to path_to_watertight, if provided.
+        """
+        with TemporaryDirectory(dir=self.staging_directory) as tmp_dir:
+            path_to_mesh = os.path.join(tmp_dir, "input." + file_type)
+            path_to_output = os.path.join(tmp_dir, "output." + file_type)
+            mesh.export(path_to_mesh, file_type=file_type)
+            self.to_watertight(path_to_mesh, path_to_output, file_type)
+            wat_mesh = _load_output(path_to_output)
+            if path_to_watertight is not None:
+                shutil.move(path_to_output, path_to_watertight)
+        return wat_mesh
+
+
+def _load_output(path_to_output):
+    if not os.path.exists(path_to_output):
+        raise RuntimeError("ManifoldPlus did not produce an output mesh")
+    import trimesh
+    return trimesh.load(path_to_output, process=False, force="mesh")
+
+
+class ManifoldPlusPool(ManifoldPlus):
+    """Run many ManifoldPlus conversions concurrently.
+
+    The subprocesses are driven from an asyncio event loop and at most
+    max_concurrency of them run at the same time. Every conversion is staged
+    in its own temporary directory, is killed if it exceeds the timeout and
+    its output is read back into memory. Any executable that accepts the same
+    command line arguments as ManifoldPlus can be used in its place, which
+    makes it easy to exercise with a stub.
+
+    Arguments:
+    ----------
+        max_concurrency: The maximum number of concurrent ManifoldPlus
+                         processes, defaults to the number of CPUs
+    """
+    def __init__(
+        self,
+        manifoldplus_script,
+        depth=10,
+        timeout=None,
+        staging_directory=None,
+        max_concurrency=None,
+    ):
+        super().__init__(
+            manifoldplus_script,
+            depth=depth,
+            timeout=timeout,
+            staging_directory=staging_directory
+        )
+        self.max_concurrency = max_concurrency or os.cpu_count()
+
+    async def _convert(self, semaphore, mesh, file_type):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            with TemporaryDirectory(dir=self.staging_directory) as tmp_dir:
+                path_to_mesh = os.path.join(tmp_dir, "input." + file_type)
+                path_to_output = os.path.join(tmp_dir, "output." + file_type)
+                # Serialization is CPU-bound, keep it off the event loop
+                await loop.run_in_executor(
+                    None, lambda: mesh.export(path_to_mesh, file_type=file_type)
+                )
+                # In its own process group, so that the processes it starts
+                # are killed with it
+                process = await asyncio.create_subprocess_exec(
+                    *self.command(path_to_mesh, path_to_output),
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True
+                )
+                try:
+                    _, stderr = await asyncio.wait_for(
+                        process.communicate(), self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    # A surviving child would keep stderr open and wait()
+                    # would block until it exits
+                    _kill_group(process)
+                    await process.wait()
+                    raise subprocess.TimeoutExpired(
+                        self.manifoldplus_script, self.timeout
+                    )
+                _check_returncode(process.returncode, stderr)
+                return await loop.run_in_executor(
+                    None, _load_output, path_to_output
+                )
+
+    async def convert_many(self, meshes, file_type="off"):
+        """Convert the meshes concurrently and return the watertight meshes in
+        the same order. A failed conversion is returned as the exception that
+        caused it instead of cancelling the rest."""
+        import asyncio
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await asyncio.gather(
+            *[self._convert(semaphore, m, file_type) for m in meshes],
+            return_exceptions=True
+        )
 
+    def map(self, meshes, file_type="off"):
+        """Blocking version of convert_many()."""
+        import asyncio
+        return asyncio.run(self.convert_many(meshes, file_type))
@@ -0,0 +1,103 @@
+import numpy as np
+
+
+class SDFVolume:
+    """Answer signed distance queries at arbitrary points from a fused volume.
+
+    The values between the voxels are interpolated trilinearly, in parallel
+    native code, thus millions of points can be queried at once. The points
+    are given in the coordinates of the meshes returned by
+    TSDFFusion.to_watertight(), i.e. the [-0.5, 0.5]^3 cube for the default
+    grid, and the zero level set of the interpolated field is the surface of
+    that mesh. The distances are positive outside of the mesh and truncated.
+
+    Arguments:
+    ----------
+        tsdf: np.array of shape (D, H, W) with the fused signed distances, e.g.
+              from TSDFFusion.to_tsdf()
+        voxel_size: The size of a voxel
+        origin: The origin of the volume per array axis, see
+                TSDFFusion.grid(), by default the corner of the unit cube
+        truncation: The truncation of the fusion. The points outside of the
+                    volume are at this distance, by default the largest
+                    absolute value of tsdf
+        padded: If True, the volume is padded with PAD_VALUE, as for the
+                marching cubes, thus the zero level set also matches the
+                mesh where it is clipped by the border of the volume, and
+                the distances are clamped to the truncation. Otherwise the
+                points outside of the volume get the value of the nearest
+                voxel
+        n_threads: The number of threads used for the queries
+    """
+    def __init__(
+        self,
+        tsdf,
+        voxel_size,
+        origin=None,
+        truncation=None,
+        padded=True,
+        n_threads=8
+    ):
+        self.tsdf = np.ascontiguousarray(tsdf, dtype=np.float32)
+        if self.tsdf.ndim != 3:
+            raise ValueError("Expected a volume of shape (D, H, W)")
+        self.voxel_size = voxel_size
+        self.origin = (-0.5,) * 3 if origin is None else tuple(origin)
+        if truncation is None:
+            truncation = float(np.abs(self.tsdf).max())
+        self.truncation = truncation
+        self.padded = padded
+        self.n_threads = n_threads
+
+    @property
+    def shape(self):
+        return self.tsdf.shape
+
+    def query(self, points, gradient=False):
+        """Return the signed distances at the points.
+
+        Arguments:
+        ----------
+            points: np.array of shape (N, 3)
+            gradient: If True, also return the gradients of the interpolated
+                      distances as an np.array of shape (N, 3). Their norm is
+                      close to 1 near the surface and 0 where the distance is
+                      truncated
+
+        Returns:
+        --------
+            The np.array of the N distances and optionally the gradients
+        """
+        from .external.libfusioncpu import cyfusion as libfusion
+        from .tsdf_fusion import PAD_VALUE
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        values = libfusion.trilinear_cpu(
+            self.tsdf,
+            points,
+            self.voxel_size,
+            origin=self.origin,
+            padded=self.padded,
+            pad_value=PAD_VALUE,
+            gradient=gradient,
+            n_threads=self.n_threads
+        )
+        if gradient:
+            values, gradients = values
+        if self.padded:
+            # Only the cells next to the padding exceed the truncation, the
+            # sign and thus the zero crossings are kept
+            clamped = np.abs(values) > self.truncation
+            np.clip(values, -self.truncation, self.truncation, out=values)
+            if gradient:
+                gradients[clamped] = 0
+        if gradient:
+            return values, gradients
+        return values
+
+    def __call__(self, points):
+        return self.query(points)
+
+    def contains(self, points):
+        """Whether the points are inside of the surface."""
+        return self.query(points) < 0
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import time
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+
+# Temporary files older than this are left behind by crashed writers
+STALE_TMP_SECONDS = 3600
+# Evicting frees the cache down to this fraction of its maximum size, thus it
+# only scans the cache directory again after that much more was written
+EVICT_TO_FRACTION = 0.9
+
+
+def stage_key(*parts):
+    """Hash the given parts, which are the key of the upstream stage followed
+    by the parameters that a stage uses, into a hex digest.
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def mesh_key(vertices, faces):
+    """Hash the content of a mesh, which is the root of the conversion DAG."""
+    h = hashlib.sha1()
+    for a in (vertices, faces):
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str, a.shape)).encode("utf-8"))
+        h.update(a.data)
+    return h.hexdigest()
+
+
+class StageCache:
+    """On-disk cache for the intermediate results of the conversion.
+
+    Every stage of the conversion (e.g. the depth maps, the fused volume and
+    the raw marching cubes mesh) is stored as an .npz file named after the
+    stage and a key. The key of a stage hashes the key of its upstream stage
+    together with only the parameters that the stage uses, thus changing a
+    parameter only recomputes the stages downstream of it. The cache can be
+    shared among processes, since every file is written atomically. When the
+    cache grows larger than max_size_gb, the least recently used files are
+    evicted, together with the temporary files left behind by crashed
+    writers.
+
+    The size of the cache is only scanned when it is first needed and after
+    an eviction. In between, every process adds the sizes of the files that
+    it writes to its running total, thus the files written by the other
+    processes may take the cache over max_size_gb until the next scan.
+
+    Arguments:
+    ----------
+        cache_dir: Directory to store the cached arrays in
+        max_size_gb: The maximum size of the cache in GB, None for unbounded
+    """
+    def __init__(self, cache_dir, max_size_gb=None):
+        self.cache_dir = cache_dir
+        self.max_size_gb = max_size_gb
+        os.makedirs(cache_dir, exist_ok=True)
+        # The running total of the size of the cache, None until scanned
+        self._size = None
+
+    def _path(self, stage, key):
+        return os.path.join(self.cache_dir, f"{stage}-{key}.npz")
+
+    def get(self, stage, key):
+        """Return the dictionary of arrays stored for stage and key or None.
+        """
+        path = self._path(stage, key)
+        try:
+            with np.load(path) as data:
+                arrays = {k: data[k] for k in data.files}
+            # Mark the file as recently used for the eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            # Missing, evicted by another process or partially written
+            return None
+        return arrays
+
+    def put(self, stage, key, **arrays):
+        with NamedTemporaryFile(
+            dir=self.cache_dir, suffix=".tmp", delete=False
+        ) as f:
+            np.savez(f, **arrays)
+            f.flush()
+            written = os.fstat(f.fileno()).st_size
+        os.replace(f.name, self._path(stage, key))
+        if self.max_size_gb is None:
+            return
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += written
+        if self._size > self.max_size_gb * 1024**3:
+            self.evict()
+
+    def get_or_compute(self, stage, key, compute):
+        """Return the cached arrays of a stage or compute them by calling
+        compute(), which should return a dictionary of arrays, and store them.
+        """
+        arrays = self.get(stage, key)
+        if arrays is None:
+            arrays = compute()
+            self.put(stage, key, **arrays)
+        return arrays
+
+    def size(self):
+        """The total size of the cached and the temporary files in bytes."""
+        return sum(
+            size for suffix in (".npz", ".tmp")
+            for _, _, size in self._entries(suffix)
+        )
+
+    def _entries(self, suffix=".npz"):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def evict(self):
+        """Remove the stale temporary files and the least recently used files
+        until the cache fits in EVICT_TO_FRACTION of max_size_gb."""
+        if self.max_size_gb is None:
+            return
+        now = time.time()
+        # The temporary files that are being written count towards the size
+        total = 0
+        for mtime, path, size in self._entries(".tmp"):
+            if now - mtime <= STALE_TMP_SECONDS:
+                total += size
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        max_size = EVICT_TO_FRACTION * self.max_size_gb * 1024**3
+        entries = sorted(self._entries())
+        total += sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
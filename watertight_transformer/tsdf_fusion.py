@@ -1,20 +1,56 @@
 import math
+import tempfile
 
 import numpy as np
-import trimesh
-from scipy import ndimage
 
-from .external.libfusioncpu import cyfusion as libfusion
-from .external.libfusioncpu.cyfusion import tsdf_cpu as compute_tsdf
-from .external.libmcubes import mcubes
-from .external.librender import pyrender
+from .chunked_mesh import ChunkedMesh
+from .stage_cache import mesh_key, stage_key
 from .utils import read_hdf5, write_hdf5
+from .volume_store import NarrowBandVolume
+
+# The value of the voxels around the fused volumes, which are outside of the
+# mesh, so that marching cubes closes the surface at the border
+PAD_VALUE = 1e6
+
+# The type of the histograms that the sparse histogram keeps
+SPARSE_HIST_DTYPE = np.uint16
 
 
 class TSDFFusion:
     """Perform the TSDF fusion.
     Code adapted from
     https://github.com/davidstutz/mesh-fusion/blob/master/2_fusion.py
+
+    Arguments:
+    ----------
+        fusion_method: tsdf for averaging the truncated distances of all views,
+                       zach_tvl1 for the TV-L1 refinement of a histogram
+                       of the truncated distances or visual_hull for the
+                       signed distance to the voxels that no view sees as
+                       free, which is cheaper but only approximate
+        n_bins: The number of histogram bins for zach_tvl1
+        tvl1_lambda: The weight of the data term for zach_tvl1, whose
+                     histogram is normalized to a sum of 1 per voxel for
+                     every hist_dtype
+        tvl1_iterations: The maximum number of iterations for zach_tvl1
+        tvl1_tolerance: zach_tvl1 stops early when no voxel changes more than
+                        tvl1_tolerance*truncation in an iteration
+        hist_dtype: float32, uint16, uint8 or sparse, the type used to store
+                    the histogram for zach_tvl1. The quantized types need 2x
+                    or 4x less memory, at the cost of some precision. sparse
+                    stores the bin of the voxels that have all their counts
+                    in one bin, which are most voxels, and the uint16
+                    histograms of the rest, see tsdf_hist_sparse_cpu
+        adaptive_grid: If True, only fuse the voxels inside the bounding box
+                       of the mesh enlarged by the truncation, instead of the
+                       whole [-0.5, 0.5]^3 cube. The voxels remain cubic, thus
+                       flat or elongated objects need far fewer voxels
+        cache: Optionally a StageCache to store the depth maps, the fused
+               volumes and the raw meshes, so that they are only recomputed
+               when the mesh or the parameters they depend on change
+        render_chunk_size: If given, the meshes are rendered in batches of
+                           this many faces from a ChunkedMesh, which bounds
+                           the memory of the renderer for very large meshes
     """
     def __init__(
         self,
@@ -27,8 +63,23 @@ class TSDFFusion:
         resolution=256,
         truncation_factor=15,
         n_views=100,
-        depth_offset_factor=1.5
+        depth_offset_factor=1.5,
+        fusion_method="tsdf",
+        n_bins=10,
+        tvl1_lambda=1.0,
+        tvl1_iterations=500,
+        tvl1_tolerance=1e-4,
+        hist_dtype="float32",
+        adaptive_grid=False,
+        cache=None,
+        render_chunk_size=None
     ):
+        if fusion_method not in ["tsdf", "zach_tvl1", "visual_hull"]:
+            raise NotImplementedError(
+                f"{fusion_method} is not a valid fusion method"
+            )
+        if hist_dtype not in ["float32", "uint16", "uint8", "sparse"]:
+            raise ValueError(f"{hist_dtype} is not a valid histogram dtype")
         self.fx = focal_length_x
         self.fy = focal_length_y
         self.ppx = principal_point_x
@@ -39,6 +90,15 @@ class TSDFFusion:
         self.truncation_factor = truncation_factor
         self.n_views = n_views
         self.depth_offset_factor = depth_offset_factor
+        self.fusion_method = fusion_method
+        self.n_bins = n_bins
+        self.tvl1_lambda = tvl1_lambda
+        self.tvl1_iterations = tvl1_iterations
+        self.tvl1_tolerance = tvl1_tolerance
+        self.hist_dtype = hist_dtype
+        self.adaptive_grid = adaptive_grid
+        self.cache = cache
+        self.render_chunk_size = render_chunk_size
 
         self.render_intrinsics = np.array([
             self.fx, self.fy, self.ppx, self.ppy
@@ -114,15 +174,39 @@ class TSDFFusion:
 
         return Rs
 
-    def render(self, mesh, Rs, output_path=None):
-        """Render the given mesh using the generated views.
+    def render_raw(self, mesh, Rs):
+        """Render the given mesh using the generated views and erode the depth
+        maps, without offsetting them. The result does not depend on the
+        resolution and can be reused to fuse the mesh at any resolution.
+
+        A ChunkedMesh, or any mesh if render_chunk_size is given, is rendered
+        in batches, see render_raw_chunked().
 
         Arguments:
         -----------
-            mesh: trimesh.Mesh object
+            mesh: trimesh.Mesh object or ChunkedMesh
             Rs: rotation matrices
-            output_path: path to store the computed depth maps
         """
+        if isinstance(mesh, ChunkedMesh):
+            return self.render_raw_chunked(mesh, Rs)
+        if self.render_chunk_size is not None:
+            # Spill the batches to disk, so that only one of them is in
+            # memory while rendering
+            with tempfile.TemporaryDirectory() as directory:
+                return self.render_raw_chunked(
+                    ChunkedMesh.from_arrays(
+                        mesh.vertices,
+                        mesh.faces,
+                        directory,
+                        self.render_chunk_size
+                    ),
+                    Rs
+                )
+
+        # The renderer needs an OpenGL context, thus it is only loaded when
+        # rendering
+        from .external.librender import pyrender
+
         depthmaps = []
         for i in range(len(Rs)):
             np_vertices = Rs[i].dot(mesh.vertices.astype(np.float64).T)
@@ -138,27 +222,140 @@ class TSDFFusion:
                 self.znf,
                 self.image_size
             )
+            depthmaps.append(self.erode_depthmap(depthmap))
+        return depthmaps
+
+    def render_raw_chunked(self, mesh, Rs):
+        """Render the batches of the ChunkedMesh one after the other into the
+        same depth buffer, where the depth test keeps the closest surface of
+        all of them, and return the same depth maps as render_raw().
 
-            # This is mainly result of experimenting.
-            # The core idea is that the volume of the object is enlarged slightly
-            # (by subtracting a constant from the depth map).
-            # Dilation additionally enlarges thin structures (e.g. for chairs).
-            depthmap -= self.depth_offset_factor * self.voxel_size
-            depthmap = ndimage.morphology.grey_erosion(depthmap, size=(3, 3))
-            depthmaps.append(depthmap)
+        Only one batch is read from disk at a time, thus the memory does not
+        grow with the size of the mesh. Every view reads the batches in the
+        opposite order of the previous one, so that it starts from the
+        batches that are still in the page cache.
+
+        Arguments:
+        -----------
+            mesh: ChunkedMesh object
+            Rs: rotation matrices
+        """
+        from .external.librender import pyrender
+
+        renderer = pyrender.ChunkedMeshRenderer(
+            self.render_intrinsics, self.znf, self.image_size
+        )
+        depthmaps = []
+        for i in range(len(Rs)):
+            renderer.begin(Rs[i], [0, 0, 1])
+            for vertices, faces in mesh.chunks(reverse=i % 2 == 1):
+                renderer.draw(vertices, faces)
+            depthmap, mask = renderer.end()
+            depthmaps.append(self.erode_depthmap(depthmap))
+        return depthmaps
+
+    @staticmethod
+    def erode_depthmap(depthmap):
+        from scipy import ndimage
+
+        # Dilation additionally enlarges thin structures (e.g. for chairs).
+        return ndimage.morphology.grey_erosion(depthmap, size=(3, 3))
+
+    def offset_depthmaps(self, depthmaps, resolution=None):
+        """Offset the depth maps returned by render_raw() for the given
+        resolution.
+
+        This is mainly result of experimenting. The core idea is that the
+        volume of the object is enlarged slightly (by subtracting a constant
+        from the depth map). The erosion commutes with subtracting a constant,
+        so this is the same as offsetting before the erosion.
+        """
+        resolution = resolution or self.resolution
+        offset = self.depth_offset_factor / resolution
+        return [depthmap - offset for depthmap in depthmaps]
+
+    def render(self, mesh, Rs, output_path=None):
+        """Render the given mesh using the generated views.
+
+        Arguments:
+        -----------
+            mesh: trimesh.Mesh object
+            Rs: rotation matrices
+            output_path: path to store the computed depth maps
+        """
+        depthmaps = self.offset_depthmaps(self.render_raw(mesh, Rs))
 
         if output_path is not None:
             write_hdf5(output_path, np.array(depthmaps))
         return depthmaps
 
-    def fusion(self, depthmaps, Rs):
+    def grid(self, mesh, resolution=None):
+        """Return the shape and the origin of the grid to fuse the mesh into.
+
+        Both are given per array axis (depth, height, width), which correspond
+        to the z, y and x axes, and the center of the voxel with index i along
+        an axis is at (i + 0.5) * voxel_size + origin. By default the grid
+        covers the [-0.5, 0.5]^3 cube. With adaptive_grid it only covers the
+        bounding box of the mesh enlarged by the truncation and the depth
+        offset, snapped to the voxels of the full grid. The fused values of
+        these voxels are the same as in the full grid.
+        """
+        resolution = resolution or self.resolution
+        if not self.adaptive_grid:
+            return (resolution,) * 3, (-0.5,) * 3
+        shape, origin, _ = self.box_grid(
+            np.asarray(mesh.vertices).min(axis=0),
+            np.asarray(mesh.vertices).max(axis=0),
+            resolution
+        )
+        return shape, origin
+
+    def box_grid(self, bbox_min, bbox_max, resolution=None):
+        """Return the shape, the origin and the index of the first voxel of
+        the part of the full grid that covers the box from bbox_min to
+        bbox_max, given as (x, y, z), enlarged by the truncation and the
+        depth offset. See grid() for the conventions."""
+        resolution = resolution or self.resolution
+        voxel_size = 1.0 / resolution
+        margin = (
+            self.truncation_factor + self.depth_offset_factor + 1
+        ) * voxel_size
+        # Reverse the vertex coordinates to the order of the array axes
+        bbox_min = np.asarray(bbox_min)[::-1] - margin
+        bbox_max = np.asarray(bbox_max)[::-1] + margin
+        begin = np.floor((bbox_min + 0.5) / voxel_size).astype(int)
+        end = np.ceil((bbox_max + 0.5) / voxel_size).astype(int)
+        begin = np.clip(begin, 0, resolution - 1)
+        end = np.clip(end, begin + 1, resolution)
+
+        shape = tuple(int(n) for n in end - begin)
+        origin = tuple(float(b * voxel_size - 0.5) for b in begin)
+        return shape, origin, tuple(int(b) for b in begin)
+
+    def fusion(self, depthmaps, Rs, resolution=None, grid=None, pad=0):
         """Fuse the rendered depth maps.
 
         Arguments:
         -----------
             depthmaps: np.array of depth maps
             Rs: rotation matrices
+            resolution: the resolution of the fused volume, by default
+                        self.resolution
+            grid: the (shape, origin) of the fused volume as returned by
+                  grid(), by default the whole [-0.5, 0.5]^3 cube
+            pad: surround the fused volume with pad voxels of PAD_VALUE on
+                 every side, which marching_cubes() reads in place with
+                 padded=True. The tsdf method fuses the volume in place into
+                 the padded one
         """
+        resolution = resolution or self.resolution
+        voxel_size = 1.0 / resolution
+        truncation = self.truncation_factor * voxel_size
+        if grid is None:
+            grid = ((resolution,) * 3, (-0.5,) * 3)
+        (depth, height, width), origin = grid
+
+        from .external.libfusioncpu import cyfusion as libfusion
 
         Ks = self.fusion_intrisics.reshape((1, 3, 3))
         Ks = np.repeat(Ks, len(depthmaps), axis=0).astype(np.float32)
@@ -172,36 +369,646 @@ class TSDFFusion:
         Rs = np.array(Rs).astype(np.float32)
 
         depthmaps = np.array(depthmaps).astype(np.float32)
+        if self.fusion_method == "visual_hull":
+            # The background is rendered at the far plane. Mark it as unknown,
+            # which is treated as free, so that it also carves the voxels
+            # behind the far plane
+            offset = self.depth_offset_factor * voxel_size
+            depthmaps[depthmaps >= self.znf[1] - offset - 1e-4] = -1
         views = libfusion.PyViews(depthmaps, Ks, Rs, Ts)
 
-        # Note that this is an alias defined as libfusiongpu.tsdf_gpu or
-        # libfusioncpu.tsdf_cpu!
-        return compute_tsdf(
-            views,
-            self.resolution,
-            self.resolution,
-            self.resolution,
-            self.voxel_size,
-            self.truncation,
-            False
+        if self.fusion_method == "visual_hull":
+            # A voxel is carved as soon as one view sees it in front of the
+            # surface, thus most voxels are decided by the first few views
+            occupancy = libfusion.occupancy_cpu(
+                views,
+                depth,
+                height,
+                width,
+                voxel_size,
+                0,
+                True,
+                origin=origin
+            )
+            # The voxels that are outside of every view are not carved,
+            # although nothing is known about them
+            occupancy *= libfusion.projmask_cpu(
+                views,
+                depth,
+                height,
+                width,
+                voxel_size,
+                True,
+                origin=origin
+            )
+            # Keep the outermost voxels free, since marching cubes places the
+            # vertices next to the padding almost on the voxel centers, where
+            # they are merged into non-manifold vertices
+            occupancy[:, [0, -1]] = 0
+            occupancy[:, :, [0, -1]] = 0
+            occupancy[:, :, :, [0, -1]] = 0
+            volume = libfusion.signed_edt_cpu(
+                occupancy[0], voxel_size, truncation
+            )[None]
+        elif self.fusion_method == "zach_tvl1" and \
+                self.hist_dtype == "sparse":
+            # Only the histograms of the voxels that are not entirely in one
+            # bin are stored and the TV-L1 refinement reads them in place
+            modes, indices, values = libfusion.tsdf_hist_sparse_cpu(
+                views,
+                depth,
+                height,
+                width,
+                voxel_size,
+                truncation,
+                False,
+                self.n_bins,
+                dtype=SPARSE_HIST_DTYPE,
+                origin=origin
+            )
+            volume = libfusion.zach_tvl1_sparse_hist_cpu(
+                modes,
+                indices,
+                values,
+                truncation,
+                self.tvl1_lambda,
+                self.tvl1_iterations,
+                self.tvl1_tolerance
+            )
+        elif self.fusion_method == "zach_tvl1":
+            # The bins are uniformly spaced in [-truncation, truncation], thus
+            # each distance is binned in constant time
+            hist = libfusion.tsdf_hist_uniform_cpu(
+                views,
+                depth,
+                height,
+                width,
+                voxel_size,
+                truncation,
+                False,
+                self.n_bins,
+                dtype=np.dtype(self.hist_dtype),
+                origin=origin
+            )
+            volume = libfusion.zach_tvl1_hist_cpu(
+                hist,
+                truncation,
+                self.tvl1_lambda,
+                self.tvl1_iterations,
+                self.tvl1_tolerance
+            )
+        else:
+            return libfusion.tsdf_cpu(
+                views,
+                depth,
+                height,
+                width,
+                voxel_size,
+                truncation,
+                False,
+                origin=origin,
+                pad=pad,
+                pad_value=PAD_VALUE
+            )
+
+        if pad > 0:
+            volume = np.pad(
+                volume,
+                [(0, 0)] + [(pad, pad)] * 3,
+                "constant",
+                constant_values=PAD_VALUE
+            )
+        return volume
+
+    def _memoize(self, stage, key, compute):
+        if self.cache is None:
+            return compute()
+        return self.cache.get_or_compute(stage, key, compute)
+
+    def depth_key(self, mesh):
+        """The cache key of the depth maps rendered by render_raw()."""
+        if self.cache is None:
+            return None
+        return stage_key(
+            "depth",
+            mesh_key(mesh.vertices, mesh.faces),
+            self.n_views,
+            self.image_size.tolist(),
+            self.render_intrinsics.tolist(),
+            self.znf.tolist()
+        )
+
+    def tsdf_key(self, depth_key, resolution):
+        """The cache key of the volume fused from the depth maps."""
+        if self.cache is None:
+            return None
+        params = [
+            resolution,
+            self.truncation_factor,
+            self.depth_offset_factor,
+            self.fusion_method,
+            self.adaptive_grid
+        ]
+        if self.fusion_method == "zach_tvl1":
+            params += [
+                self.n_bins,
+                self.tvl1_lambda,
+                self.tvl1_iterations,
+                self.tvl1_tolerance,
+                self.hist_dtype
+            ]
+        return stage_key("tsdf", depth_key, *params)
+
+    def pooled_tsdf_key(self, fine_tsdf_key, resolution):
+        """The cache key of a volume derived with pool_tsdf()."""
+        if self.cache is None:
+            return None
+        return stage_key(
+            "tsdf",
+            fine_tsdf_key,
+            "pool",
+            resolution,
+            self.truncation_factor,
+            self.depth_offset_factor
+        )
+
+    def _cached_render_raw(self, mesh, Rs, depth_key):
+        return self._memoize(
+            "depth",
+            depth_key,
+            lambda: {
+                "depthmaps": np.array(
+                    self.render_raw(mesh, Rs), dtype=np.float32
+                )
+            }
+        )["depthmaps"]
+
+    def _cached_mesh(self, tsdf_key, resolution, origin, get_padded_tsdf):
+        # The marching cubes only depend on the volume
+        arrays = self._memoize(
+            "mesh",
+            None if tsdf_key is None else stage_key("mesh", tsdf_key),
+            lambda: self.marching_cubes(
+                get_padded_tsdf(), resolution, origin, padded=True
+            )
+        )
+        import trimesh
+        return trimesh.Trimesh(
+            vertices=arrays["vertices"], faces=arrays["faces"]
         )
-    
-    def to_watertight(self, mesh, output_path=None, file_type="off"):
+
+    def to_tsdf(self, mesh, resolution=None):
+        """Render and fuse the mesh into a TSDF volume.
+
+        Return the volume and its origin. The shape and the origin of the
+        volume are the ones of grid(), thus with adaptive_grid the volume
+        only covers the bounding box of the mesh instead of the
+        (resolution, resolution, resolution) cube.
+        """
+        resolution = resolution or self.resolution
         # Get the views that we will use for the rendering
         Rs = self.get_views()
-        # Render the depth maps
-        depths = self.render(mesh, Rs)
-        tsdf = self.fusion(depths, Rs)[0]
+        depth_key = self.depth_key(mesh)
+        _, origin = self.grid(mesh, resolution)
+        padded = self._cached_padded_tsdf(mesh, Rs, depth_key, resolution)
+        return padded[1:-1, 1:-1, 1:-1], origin
+
+    def to_sdf_volume(self, mesh, resolution=None, padded=True):
+        """Render and fuse the mesh and return an SDFVolume that answers
+        signed distance queries in the coordinates of the watertight mesh."""
+        from .sdf_query import SDFVolume
+
+        resolution = resolution or self.resolution
+        voxel_size = 1.0 / resolution
+        tsdf, origin = self.to_tsdf(mesh, resolution)
+        return SDFVolume(
+            tsdf,
+            voxel_size,
+            origin=origin,
+            truncation=self.truncation_factor * voxel_size,
+            padded=padded
+        )
+
+    def _cached_padded_tsdf(self, mesh, Rs, depth_key, resolution):
+        # The volume surrounded by a voxel of PAD_VALUE, which is what
+        # marching_cubes() reads, its interior is the fused volume
+        def fuse():
+            # Render the depth maps
+            depthmaps = self._cached_render_raw(mesh, Rs, depth_key)
+            depthmaps = self.offset_depthmaps(depthmaps, resolution)
+            return {"tsdf": self.fusion(
+                depthmaps,
+                list(Rs),
+                resolution,
+                self.grid(mesh, resolution),
+                pad=1
+            )[0]}
+        return self._memoize(
+            "padded_tsdf", self.tsdf_key(depth_key, resolution), fuse
+        )["tsdf"]
+
+    def to_watertight(
+        self,
+        mesh,
+        output_path=None,
+        file_type="off",
+        tsdf_output_path=None,
+        tsdf_dtype="int8"
+    ):
+        """Convert the mesh to a watertight mesh.
+
+        Arguments:
+        -----------
+            mesh: trimesh.Mesh object
+            output_path: path to store the watertight mesh
+            file_type: the file type of the watertight mesh
+            tsdf_output_path: directory to store the narrow band of the fused
+                              TSDF volume as a NarrowBandVolume
+            tsdf_dtype: int8 or float16, the type of the stored TSDF values
+        """
+        Rs = self.get_views()
+        depth_key = self.depth_key(mesh)
+        _, origin = self.grid(mesh)
+
+        tsdfs = []
+
+        def get_padded_tsdf():
+            # The volume is fused at most once, also without a cache
+            if len(tsdfs) == 0:
+                tsdfs.append(self._cached_padded_tsdf(
+                    mesh, Rs, depth_key, self.resolution
+                ))
+            return tsdfs[0]
+
+        if tsdf_output_path is not None:
+            NarrowBandVolume.write(
+                tsdf_output_path,
+                get_padded_tsdf()[1:-1, 1:-1, 1:-1],
+                self.truncation,
+                dtype=tsdf_dtype,
+                voxel_size=self.voxel_size,
+                origin=origin
+            )
+        tr_mesh = self._cached_mesh(
+            self.tsdf_key(depth_key, self.resolution),
+            self.resolution,
+            origin,
+            get_padded_tsdf
+        )
+        if output_path is not None:
+            tr_mesh.export(output_path, file_type)
+        return tr_mesh
+
+    def tsdf_to_mesh(self, tsdf, resolution=None, origin=None, padded=False):
+        """Extract the zero level set of a fused volume with marching cubes
+        and normalize it to the [-0.5, 0.5]^3 cube. The origin of the volume
+        is given per array axis, see grid(). With padded, tsdf is a volume
+        fused with pad=1, see marching_cubes()."""
+        arrays = self.marching_cubes(tsdf, resolution, origin, padded)
+        import trimesh
+        return trimesh.Trimesh(
+            vertices=arrays["vertices"], faces=arrays["faces"]
+        )
+
+    def marching_cubes(self, tsdf, resolution=None, origin=None, padded=False):
+        """Same as tsdf_to_mesh() but returns a dictionary with the raw
+        vertices and faces.
+
+        With padded, tsdf is already surrounded by a voxel of PAD_VALUE on
+        every side, e.g. it was fused with pad=1, and it is read in place.
+        Otherwise a padded copy is made. The origin is the one of the
+        unpadded volume.
+        """
+        resolution = resolution or self.resolution
+        if origin is None:
+            origin = (-0.5,) * 3
+        from .external.libmcubes import mcubes
+
         # To ensure that the final mesh is indeed watertight
-        tsdf = np.pad(tsdf, 1, "constant", constant_values=1e6)
-        vertices, triangles = mcubes.marching_cubes(-tsdf, 0)
+        if not padded:
+            tsdf = np.pad(tsdf, 1, "constant", constant_values=PAD_VALUE)
+        # The outside is positive, thus the surface is extracted from the
+        # negated volume, which is negated while it is read
+        vertices, triangles = mcubes.marching_cubes(tsdf, 0, negate=True)
         # Remove padding offset
         vertices -= 1
         # Normalize to [-0.5, 0.5]^3 cube
-        vertices /= self.resolution
-        vertices -= 0.5
+        vertices /= resolution
+        vertices += np.asarray(origin)
 
-        tr_mesh = trimesh.Trimesh(vertices=vertices, faces=triangles)
-        if output_path is not None:
-            tr_mesh.export(output_path, file_type)
-        return tr_mesh
+        return {"vertices": vertices, "faces": triangles}
+
+    def estimate_peak_memory(self, n_faces, resolutions=None):
+        """Estimate the peak memory in bytes of converting a mesh with
+        n_faces faces at the given resolutions.
+
+        This is an upper bound derived from the arrays that are alive at the
+        same time: the input mesh and its copies for the renderer, or a
+        single batch of it with render_chunk_size, a few copies of the depth
+        maps, the padded fused volumes, which are all kept until the end for
+        several resolutions, and the output of marching cubes, which reads
+        the padded volume in place. The adaptive grid is ignored since its
+        size depends on the shape of the mesh.
+        """
+        resolutions = resolutions or [self.resolution]
+        # The interpreter and the imported libraries
+        base = 200 * 1024**2
+        if self.render_chunk_size is None:
+            # The trimesh object and the float64 copies of the renderer
+            mesh = 150 * n_faces
+        else:
+            # A single batch of a ChunkedMesh and its unique vertices, the
+            # mesh itself is read through the page cache
+            mesh = 100 * min(n_faces, self.render_chunk_size)
+        # The eroded depth maps, their offsetted copies and the float32 array
+        # passed to the fusion
+        depthmaps = 3 * 4 * self.n_views * self.image_height * self.image_width
+
+        volumes, transient = 0, 0
+        for resolution in resolutions:
+            voxels = resolution**3
+            padded = 4 * (resolution + 2)**3
+            volumes += padded
+            # The histogram of zach_tvl1 and the variables of the TV-L1
+            # iterations, or the occupancy and the two squared distance
+            # transforms of visual_hull, together with the unpadded volume
+            fusion = 0
+            if self.fusion_method == "zach_tvl1" and \
+                    self.hist_dtype == "sparse":
+                # The bin of every voxel, the histograms of the voxels in the
+                # truncation band around the surface and a dense slab
+                band = min(
+                    voxels, 16 * resolution**2 * 2 * self.truncation_factor
+                )
+                hist_size = np.dtype(SPARSE_HIST_DTYPE).itemsize
+                fusion = (
+                    (1 + 5 * 4) * voxels +
+                    (self.n_bins * hist_size + 8) * band +
+                    16 * self.n_bins * hist_size * resolution**2
+                )
+            elif self.fusion_method == "zach_tvl1":
+                hist_size = np.dtype(self.hist_dtype).itemsize
+                fusion = (self.n_bins * hist_size + 5 * 4) * voxels
+            elif self.fusion_method == "visual_hull":
+                fusion = 4 * 4 * voxels
+            # Roughly 16 faces of ~100 bytes each per surface voxel and the
+            # padded copy of a volume that is loaded from the cache
+            marching_cubes = 16 * 100 * resolution**2
+            if self.cache is not None:
+                marching_cubes += padded
+            transient = max(transient, fusion, marching_cubes)
+        return int(base + mesh + depthmaps + volumes + transient)
+
+    def can_pool(self, fine_resolution, resolution):
+        """Whether the volume at resolution can be derived from the volume at
+        fine_resolution, see pool_tsdf()."""
+        if fine_resolution <= resolution or fine_resolution % resolution:
+            return False
+        # The adaptive grids of different resolutions are not aligned
+        if self.adaptive_grid:
+            return False
+        # The depth offset of the coarse volume is larger and the difference
+        # has to stay inside the truncation band of the fine volume
+        k = fine_resolution // resolution
+        return (k - 1) * self.depth_offset_factor < self.truncation_factor
+
+    def pool_tsdf(self, tsdf, fine_resolution, resolution):
+        """Derive the volume at resolution from the volume at fine_resolution.
+
+        Every coarse voxel center is the center of a cube of k^3 fine voxels,
+        thus its distance is approximated by their mean. The distances are
+        then shifted by the difference of the depth offsets of the two
+        resolutions and truncated with the coarse truncation. This is an
+        approximation, as the fine volume is truncated more tightly.
+        """
+        k = fine_resolution // resolution
+        R = resolution
+        pooled = tsdf.reshape(R, k, R, k, R, k).mean(axis=(1, 3, 5))
+        pooled -= self.depth_offset_factor * (1.0 / R - 1.0 / fine_resolution)
+        truncation = self.truncation_factor / R
+        return np.clip(pooled, -truncation, truncation).astype(np.float32)
+
+    def to_watertight_multires(
+        self,
+        mesh,
+        resolutions,
+        output_paths=None,
+        file_type="off",
+        pool=True
+    ):
+        """Convert the mesh to a watertight mesh at several resolutions.
+
+        The mesh is rendered only once and the depth maps are fused at every
+        resolution. If pool is True, the volume of a resolution that divides
+        an already fused finer resolution is derived from the finer volume
+        instead (see pool_tsdf()).
+
+        Arguments:
+        -----------
+            mesh: trimesh.Mesh object
+            resolutions: list of resolutions
+            output_paths: optional list of paths, one per resolution, to store
+                          the watertight meshes
+            file_type: the file type of the watertight meshes
+            pool: derive the coarser volumes from the finer ones when possible
+
+        Returns:
+        --------
+            The list of the watertight meshes in the order of resolutions
+        """
+        if output_paths is not None and len(output_paths) != len(resolutions):
+            raise ValueError("Expected one output path per resolution")
+
+        Rs = self.get_views()
+        depth_key = self.depth_key(mesh)
+
+        # Decide which volumes are fused and which ones are pooled from a
+        # finer one, before computing anything, so that with a cache only the
+        # stages that are missing are computed
+        sources, keys = {}, {}
+        for resolution in sorted(set(resolutions), reverse=True):
+            finer = [r for r in sources if self.can_pool(r, resolution)]
+            if pool and len(finer) > 0:
+                sources[resolution] = max(finer)
+                keys[resolution] = self.pooled_tsdf_key(
+                    keys[sources[resolution]], resolution
+                )
+            else:
+                sources[resolution] = None
+                keys[resolution] = self.tsdf_key(depth_key, resolution)
+
+        depthmaps = []
+        tsdfs = {}
+
+        def get_tsdf(resolution):
+            if resolution in tsdfs:
+                return tsdfs[resolution]
+            fine_resolution = sources[resolution]
+            if fine_resolution is not None:
+                compute = lambda: {"tsdf": np.pad(
+                    self.pool_tsdf(
+                        get_tsdf(fine_resolution)[1:-1, 1:-1, 1:-1],
+                        fine_resolution,
+                        resolution
+                    ),
+                    1,
+                    "constant",
+                    constant_values=PAD_VALUE
+                )}
+            else:
+                def compute():
+                    # The depth maps are rendered at most once
+                    if len(depthmaps) == 0:
+                        depthmaps.append(
+                            self._cached_render_raw(mesh, Rs, depth_key)
+                        )
+                    return {"tsdf": self.fusion(
+                        self.offset_depthmaps(depthmaps[0], resolution),
+                        list(Rs),
+                        resolution,
+                        self.grid(mesh, resolution),
+                        pad=1
+                    )[0]}
+            # Every volume is kept surrounded by a voxel of PAD_VALUE, see
+            # marching_cubes()
+            tsdfs[resolution] = self._memoize(
+                "padded_tsdf", keys[resolution], compute
+            )["tsdf"]
+            return tsdfs[resolution]
+
+        tr_meshes = []
+        for i, resolution in enumerate(resolutions):
+            tr_mesh = self._cached_mesh(
+                keys[resolution],
+                resolution,
+                self.grid(mesh, resolution)[1],
+                lambda: get_tsdf(resolution)
+            )
+            if output_paths is not None:
+                tr_mesh.export(output_paths[i], file_type)
+            tr_meshes.append(tr_mesh)
+        return tr_meshes
+
+    def render_frame(self, renderer, vertices, Rs):
+        """Render the depth maps of a frame with a pyrender.MeshRenderer that
+        already holds the faces of the sequence, see render_raw()."""
+        renderer.set_vertices(vertices)
+        depthmaps = []
+        for R in Rs:
+            depthmap, _ = renderer.render(R, [0, 0, 1])
+            depthmaps.append(self.erode_depthmap(depthmap))
+        return depthmaps
+
+    def to_watertight_sequence(
+        self,
+        meshes,
+        output_paths=None,
+        file_type="off",
+        incremental=False,
+        keyframe_interval=10,
+        tolerance_factor=0
+    ):
+        """Convert the frames of a sequence and yield the watertight meshes in
+        the same order.
+
+        The frames of a sequence share their faces and move only slightly
+        between frames. Thus the views are computed once, the faces are
+        uploaded to the renderer once and only the vertices are updated for
+        every frame. A frame whose vertices did not move since the last
+        fusion reuses the previous mesh. With a positive tolerance_factor, a
+        frame whose vertices moved at most tolerance_factor voxels is
+        considered static too, which is an approximation.
+
+        With incremental, only the bounding box of the vertices that moved,
+        enlarged by the truncation and the depth offset, is fused again and
+        the rest of the volume is kept. This is an approximation, since a
+        moving part also changes which voxels outside of the box it occludes,
+        thus the whole volume is fused again every keyframe_interval frames.
+        Only the tsdf fusion method is fused incrementally, since zach_tvl1
+        and visual_hull depend on the whole volume.
+
+        The volumes cover the whole [-0.5, 0.5]^3 cube, the adaptive grid and
+        the cache are not used.
+
+        Arguments:
+        -----------
+            meshes: An iterable of trimesh.Trimesh objects
+            output_paths: optional list of paths, one per frame, to store the
+                          watertight meshes
+            file_type: the file type of the watertight meshes
+            incremental: only fuse the region that changed since the last
+                         fusion
+            keyframe_interval: fuse the whole volume at least every that many
+                               frames with incremental
+            tolerance_factor: vertices that moved at most
+                              tolerance_factor*voxel_size are considered
+                              static, by default only the ones that did not
+                              move at all
+        """
+        from .external.librender import pyrender
+
+        incremental = incremental and self.fusion_method == "tsdf"
+        tolerance = tolerance_factor * self.voxel_size
+        Rs = self.get_views()
+        renderer, faces = None, None
+        volume, reference, tr_mesh = None, None, None
+        since_keyframe = 0
+
+        for i, mesh in enumerate(meshes):
+            vertices = np.asarray(mesh.vertices, dtype=np.float64)
+            if faces is None or not np.array_equal(faces, mesh.faces):
+                # A new topology starts a new sequence
+                faces = np.array(mesh.faces)
+                renderer = pyrender.MeshRenderer(
+                    faces,
+                    self.render_intrinsics,
+                    self.znf,
+                    self.image_size
+                )
+                volume, reference = None, None
+
+            moved = None
+            if reference is not None:
+                moved = np.linalg.norm(vertices - reference, axis=1) > tolerance
+            if moved is not None and not moved.any():
+                # Nothing changed since the last fusion
+                pass
+            elif volume is None or not incremental or \
+                    since_keyframe + 1 >= keyframe_interval:
+                depthmaps = self.offset_depthmaps(
+                    self.render_frame(renderer, vertices, Rs)
+                )
+                volume = self.fusion(depthmaps, list(Rs), pad=1)
+                reference = vertices.copy()
+                since_keyframe = 0
+                tr_mesh = None
+            else:
+                depthmaps = self.offset_depthmaps(
+                    self.render_frame(renderer, vertices, Rs)
+                )
+                changed = np.concatenate([reference[moved], vertices[moved]])
+                shape, origin, begin = self.box_grid(
+                    changed.min(axis=0), changed.max(axis=0)
+                )
+                # The volume is padded by one voxel
+                region = tuple(
+                    slice(b + 1, b + 1 + n) for b, n in zip(begin, shape)
+                )
+                volume[(slice(None),) + region] = self.fusion(
+                    depthmaps, list(Rs), grid=(shape, origin)
+                )
+                # The vertices in the fused region are up to date now
+                in_region = np.all(
+                    (vertices >= changed.min(axis=0)) &
+                    (vertices <= changed.max(axis=0)),
+                    axis=1
+                )
+                reference[in_region] = vertices[in_region]
+                since_keyframe += 1
+                tr_mesh = None
+
+            if tr_mesh is None:
+                tr_mesh = self.tsdf_to_mesh(volume[0], padded=True)
+            if output_paths is not None:
+                tr_mesh.export(output_paths[i], file_type)
+            yield tr_mesh
@@ -1,11 +1,13 @@
+import os
+
 import numpy as np
-import h5py
 
 
 def write_hdf5(file, tensor, key = 'tensor'):
     """Write a simple tensor, i.e. numpy array ,to HDF5.
     """
     assert type(tensor) == np.ndarray, 'expects numpy.ndarray'
+    import h5py
 
     h5f = h5py.File(file, 'w')
     chunks = list(tensor.shape)
@@ -26,6 +28,7 @@ def read_hdf5(file, key = 'tensor'):
     """Read a tensor, i.e. numpy array, from HDF5.
     """
     assert os.path.exists(file), 'file %s not found' % file
+    import h5py
     h5f = h5py.File(file, 'r')
     assert key in h5f.keys(), 'key %s not found in file %s' % (key, file)
     tensor = h5f[key][()]
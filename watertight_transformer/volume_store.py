@@ -0,0 +1,191 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# Entries of the block table for the blocks that are not stored because all
+# their voxels are truncated
+OUTSIDE_BLOCK = -1
+INSIDE_BLOCK = -2
+
+
+def _replace_dir(src, dst):
+    # A directory can only be renamed over an empty one, thus an existing
+    # volume is first moved aside. Readers that already opened it keep their
+    # memory maps
+    try:
+        os.rename(src, dst)
+        return
+    except OSError:
+        if not os.path.isdir(dst):
+            raise
+    old = tempfile.mkdtemp(
+        dir=os.path.dirname(dst) or ".",
+        prefix=os.path.basename(dst) + ".",
+        suffix=".old"
+    )
+    os.rename(dst, os.path.join(old, "volume"))
+    os.rename(src, dst)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+class NarrowBandVolume:
+    """A TSDF volume that only stores the narrow band around the surface.
+
+    The volume is split into cubic blocks and only the blocks that contain at
+    least one voxel closer to the surface than the truncation are stored. The
+    values are normalized by the truncation and quantized to int8 or float16.
+    A block table with one entry per block either points to the stored block
+    or marks it as entirely outside or inside. All arrays are stored as .npy
+    files inside a directory and are memory-mapped, thus single blocks can be
+    read without loading the whole volume.
+
+    Arguments:
+    ----------
+        path: Path to the directory written by NarrowBandVolume.write()
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.block_table = np.load(
+            os.path.join(path, "block_table.npy"), mmap_mode="r"
+        )
+        self.blocks = np.load(
+            os.path.join(path, "blocks.npy"), mmap_mode="r"
+        )
+
+    @property
+    def shape(self):
+        return tuple(self.meta["shape"])
+
+    @property
+    def block_size(self):
+        return self.meta["block_size"]
+
+    @property
+    def truncation(self):
+        return self.meta["truncation"]
+
+    @property
+    def n_blocks(self):
+        return len(self.blocks)
+
+    @staticmethod
+    def write(
+        path,
+        tsdf,
+        truncation,
+        block_size=8,
+        dtype="int8",
+        voxel_size=None,
+        origin=None
+    ):
+        """Store the narrow band of a dense TSDF volume.
+
+        The files are written into a temporary sibling directory that is
+        renamed to path, thus readers never see the block table of one
+        volume together with the blocks or the metadata of another. A volume
+        that already exists at path is replaced.
+
+        Arguments:
+        ----------
+            path: Directory to store the volume in
+            tsdf: np.array of shape (D, H, W) with the signed distances
+            truncation: The truncation used for the fusion
+            block_size: The side of the cubic blocks in voxels
+            dtype: int8 or float16, the type of the stored values
+            voxel_size: Optionally the voxel size, stored as metadata
+            origin: Optionally the volume origin per array axis, stored as
+                    metadata
+        """
+        if dtype not in ["int8", "float16"]:
+            raise ValueError(f"{dtype} is not a valid narrow band dtype")
+        tsdf = np.asarray(tsdf)
+        shape = tsdf.shape
+        B = block_size
+
+        # Pad to a multiple of the block size and split into blocks
+        pad = [(0, (-s) % B) for s in shape]
+        padded = np.pad(tsdf, pad, mode="edge")
+        nb = [s // B for s in padded.shape]
+        blocks = padded.reshape(nb[0], B, nb[1], B, nb[2], B)
+        blocks = blocks.transpose(0, 2, 4, 1, 3, 5).reshape(-1, B, B, B)
+
+        in_band = (np.abs(blocks) < truncation).any(axis=(1, 2, 3))
+        block_table = np.where(
+            blocks.mean(axis=(1, 2, 3)) > 0, OUTSIDE_BLOCK, INSIDE_BLOCK
+        ).astype(np.int32)
+        block_table[in_band] = np.arange(in_band.sum(), dtype=np.int32)
+
+        values = np.clip(blocks[in_band] / truncation, -1, 1)
+        if dtype == "int8":
+            values = np.round(values * 127).astype(np.int8)
+        else:
+            values = values.astype(np.float16)
+
+        path = os.path.normpath(path)
+        parent = os.path.dirname(path) or "."
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(
+            dir=parent, prefix=os.path.basename(path) + ".", suffix=".tmp"
+        )
+        try:
+            np.save(
+                os.path.join(tmp_path, "block_table.npy"),
+                block_table.reshape(nb)
+            )
+            np.save(os.path.join(tmp_path, "blocks.npy"), values)
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump({
+                    "shape": list(shape),
+                    "block_size": B,
+                    "truncation": float(truncation),
+                    "dtype": dtype,
+                    "voxel_size": voxel_size,
+                    "origin": None if origin is None else list(origin)
+                }, f)
+            _replace_dir(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        return NarrowBandVolume(path)
+
+    def _decode(self, values):
+        values = np.asarray(values, dtype=np.float32)
+        if self.meta["dtype"] == "int8":
+            values /= 127
+        return values * self.truncation
+
+    def read_block(self, i, j, k):
+        """Return the (B, B, B) float32 block with block coordinates i, j, k.
+        Blocks at the far end of the volume contain padding.
+        """
+        entry = self.block_table[i, j, k]
+        if entry == OUTSIDE_BLOCK:
+            return np.full((self.block_size,) * 3, self.truncation, np.float32)
+        if entry == INSIDE_BLOCK:
+            return np.full((self.block_size,) * 3, -self.truncation, np.float32)
+        return self._decode(self.blocks[entry])
+
+    def to_dense(self):
+        """Reconstruct the dense float32 TSDF volume."""
+        B = self.block_size
+        nb = self.block_table.shape
+        table = np.asarray(self.block_table).ravel()
+
+        dense = np.empty((len(table), B, B, B), dtype=np.float32)
+        dense[table == OUTSIDE_BLOCK] = self.truncation
+        dense[table == INSIDE_BLOCK] = -self.truncation
+        stored = table >= 0
+        dense[stored] = self._decode(self.blocks[table[stored]])
+
+        dense = dense.reshape(nb[0], nb[1], nb[2], B, B, B)
+        dense = dense.transpose(0, 3, 1, 4, 2, 5)
+        dense = dense.reshape(nb[0] * B, nb[1] * B, nb[2] * B)
+        D, H, W = self.shape
+        return np.ascontiguousarray(dense[:D, :H, :W])
@@ -0,0 +1,161 @@
+import json
+import os
+
+import numpy as np
+
+
+def edge_manifold_stats(faces):
+    """Count the boundary and the non-manifold edges of a triangle mesh.
+
+    The undirected edges of all faces are encoded as a single integer key and
+    sorted, so that the number of faces sharing each edge is simply the length
+    of each run of equal keys.
+
+    Arguments:
+    ----------
+        faces: np.array of shape (F, 3) with the vertex indices of each face
+
+    Returns:
+    --------
+        n_boundary: The number of edges that belong to a single face
+        n_non_manifold: The number of edges shared by more than two faces
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    if len(faces) == 0:
+        return 0, 0
+
+    edges = faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+    edges.sort(axis=1)
+    keys = edges[:, 0] * (int(faces.max()) + 1) + edges[:, 1]
+    keys.sort()
+
+    # Find the start of each run of equal keys and derive the run lengths
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    return int((counts == 1).sum()), int((counts > 2).sum())
+
+
+def is_watertight(faces):
+    """A mesh is watertight when every edge is shared by exactly two faces.
+    """
+    if len(faces) == 0:
+        return False
+    n_boundary, n_non_manifold = edge_manifold_stats(faces)
+    return n_boundary == 0 and n_non_manifold == 0
+
+
+def read_off_counts(f):
+    """Read the header of an OFF file and return its numbers of vertices and
+    faces, leaving f at the first vertex.
+
+    Raises a ValueError for a file that ends before the counts, e.g. one that
+    was truncated after its header.
+    """
+    header = f.readline().strip()
+    if header != "OFF":
+        # The counts are sometimes on the same line as the header
+        counts = header[3:].split()
+    else:
+        counts = []
+        while len(counts) == 0 or counts[0].startswith("#"):
+            line = f.readline()
+            if line == "":
+                raise ValueError("The OFF file ends before its counts")
+            counts = line.split()
+    if len(counts) < 2:
+        raise ValueError("The OFF file has no vertex and face counts")
+    return int(counts[0]), int(counts[1])
+
+
+def _load_off_faces(path_to_mesh):
+    with open(path_to_mesh, "r") as f:
+        n_vertices, n_faces = read_off_counts(f)
+        for _ in range(n_vertices):
+            f.readline()
+        faces = np.loadtxt(f, dtype=np.int64, max_rows=n_faces, ndmin=2)
+
+    if n_faces == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    if np.any(faces[:, 0] != 3):
+        raise ValueError(f"{path_to_mesh} contains non-triangular faces")
+    return faces[:, 1:4]
+
+
+def load_faces(path_to_mesh):
+    """Load only the face array of a mesh file.
+
+    OFF files, which is what we generate, are parsed directly without reading
+    the vertices; every other format falls back to trimesh.
+    """
+    if path_to_mesh.endswith(".off"):
+        try:
+            return _load_off_faces(path_to_mesh)
+        except ValueError:
+            pass
+
+    import trimesh
+    mesh = trimesh.load(path_to_mesh, process=False, force="mesh")
+    return np.asarray(mesh.faces)
+
+
+def check_watertightness(path_to_mesh):
+    """Return whether the mesh stored in path_to_mesh is watertight.
+
+    A file that cannot be read, e.g. a truncated or corrupted one, is reported
+    and counts as not watertight instead of raising, so that a single bad file
+    does not abort a check of the whole dataset.
+    """
+    try:
+        faces = load_faces(path_to_mesh)
+    except Exception as e:
+        print(f"Failed to read mesh file: {path_to_mesh} ({e!r})")
+        return False
+    return is_watertight(faces)
+
+
+class VerdictStore:
+    """Cache of watertightness verdicts stored as a JSON file.
+
+    Every verdict is keyed on the path of the mesh together with its size and
+    its modification time, thus a verdict is invalidated as soon as the file
+    is rewritten.
+    """
+    def __init__(self, path_to_store):
+        self.path_to_store = path_to_store
+        self._verdicts = {}
+        if os.path.exists(path_to_store):
+            with open(path_to_store, "r") as f:
+                self._verdicts = json.load(f)
+
+    def __len__(self):
+        return len(self._verdicts)
+
+    @staticmethod
+    def _file_key(path_to_mesh):
+        stat = os.stat(path_to_mesh)
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, path_to_mesh):
+        """Return the cached verdict or None if the file has changed since."""
+        entry = self._verdicts.get(path_to_mesh)
+        if entry is None or not os.path.exists(path_to_mesh):
+            return None
+        if (entry["size"], entry["mtime"]) != self._file_key(path_to_mesh):
+            return None
+        return entry["watertight"]
+
+    def set(self, path_to_mesh, watertight):
+        size, mtime = self._file_key(path_to_mesh)
+        self._verdicts[path_to_mesh] = {
+            "size": size,
+            "mtime": mtime,
+            "watertight": bool(watertight)
+        }
+
+    def save(self):
+        # Write to a temporary file first so that an interrupted run never
+        # leaves a corrupted store behind
+        tmp_path = self.path_to_store + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._verdicts, f)
+        os.replace(tmp_path, self.path_to_store)